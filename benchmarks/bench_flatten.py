@@ -0,0 +1,71 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+ Benchmark for the plugin_utils flatten() helper
+
+ Compares the original level-by-level implementation with the single pass,
+ stack-based iflatten on wide and on deep inputs.
+ run with python benchmarks/bench_flatten.py
+
+"""
+
+from itertools import chain
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'modules'))
+import plugin_utils  # noqa: E402
+
+
+def legacy_flatten(items, seqtypes=(list, tuple)):
+    """
+    The original implementation, rebuilding the whole list for each level.
+    """
+    def islist(obj):
+        return list(obj) if isinstance(obj, seqtypes) else [obj]
+
+    while any(isinstance(i, seqtypes) for i in items):
+        items = list(chain.from_iterable([islist(i) for i in items]))
+    return items
+
+
+def make_wide(count):
+    """
+    Return a list of count short sublists (one level of nesting).
+    """
+    return [[i, (i, i), i] for i in range(count)]
+
+
+def make_deep(depth):
+    """
+    Return a list nested depth levels deep, with one item on each level.
+    """
+    data = [0]
+    for i in range(1, depth):
+        data = [data, i]
+    return data
+
+
+def run(number=3):
+    """
+    Return a list of (label, input, seconds) timings.
+    """
+    results = []
+    inputs = [('wide 100k', make_wide(100000)),
+              ('deep 500', make_deep(500)),
+              ('deep 2000', make_deep(2000))]
+    for name, data in inputs:
+        assert legacy_flatten(data) == plugin_utils.flatten(data)
+        for label, func in (('legacy', legacy_flatten),
+                            ('flatten', plugin_utils.flatten)):
+            secs = min(timeit.repeat(lambda: func(data), number=1,
+                                     repeat=number))
+            results.append((label, name, secs))
+    return results
+
+
+if __name__ == '__main__':
+    for label, name, secs in run():
+        print('{:>8} {:>10}: {:8.4f}s'.format(label, name, secs))
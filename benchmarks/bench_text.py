@@ -0,0 +1,97 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+ Benchmark for the plugin_utils text normalization helpers
+
+ Compares the original kitchen-based capitalize, capitalize_first, lowercase
+ and firstletter with the str-native versions, called one at a time and via
+ the cached batch variants, on a repetitive Greek and English token stream.
+ run with python benchmarks/bench_text.py
+
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'modules'))
+import plugin_utils_core as core  # noqa: E402
+
+
+def legacy_makeutf8(rawstring):
+    try:
+        rawstring = rawstring.decode('utf8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        rawstring = rawstring
+    except (AttributeError, TypeError):
+        rawstring = 'None'
+    return rawstring
+
+
+def legacy_capitalize(letter):
+    from kitchen.text.converters import to_unicode, to_bytes
+    letter = to_unicode(letter, encoding='utf8')
+    newletter = letter.upper()
+    newletter = to_bytes(letter, encoding='utf8')
+    return newletter
+
+
+def legacy_capitalize_first(mystring):
+    from kitchen.text.converters import to_unicode, to_bytes
+    mystring = to_unicode(mystring, encoding='utf8')
+    first, rest = mystring[:1], mystring[1:]
+    first = first.upper()
+    newstring = u'{}{}'.format(first, rest)
+    return to_bytes(newstring, encoding='utf8')
+
+
+def legacy_lowercase(letter):
+    return legacy_makeutf8(letter).lower()
+
+
+def legacy_firstletter(mystring):
+    mystring = legacy_makeutf8(mystring)
+    return mystring[:1], mystring[1:]
+
+
+VOCAB = ['λόγος', 'ἀγάπη', 'ᾠδή', 'ἄνθρωπος', 'εἶπεν', 'καὶ', 'τοῦ', 'θεοῦ',
+         'the', 'and', 'Word', 'beginning', 'God', 'was', 'with', 'light']
+
+
+def make_tokens(count, vocab_size=2000, seed=0):
+    """
+    Return count tokens drawn with a Zipf-like skew from a generated vocabulary.
+    """
+    rnd = random.Random(seed)
+    vocab = ['{}{}'.format(rnd.choice(VOCAB), i % 97 or '')
+             for i in range(vocab_size)]
+    weights = [1.0 / (rank + 1) for rank in range(vocab_size)]
+    return rnd.choices(vocab, weights, k=count)
+
+
+def run(count=200000, number=3):
+    """
+    Return a list of (helper, variant, seconds) timings.
+    """
+    tokens = make_tokens(count)
+    results = []
+    for name in ('capitalize', 'capitalize_first', 'lowercase',
+                 'firstletter'):
+        legacy = globals()['legacy_' + name]
+        func = getattr(core, name)
+        batch = getattr(core, name + '_many')
+        variants = [('legacy', lambda: [legacy(t) for t in tokens]),
+                    ('per call', lambda: [func(t) for t in tokens]),
+                    ('batch', lambda: list(batch(tokens, cache_size=0))),
+                    ('cached batch', lambda: list(batch(tokens)))]
+        for label, call in variants:
+            secs = min(timeit.repeat(call, number=1, repeat=number))
+            results.append((name, label, secs))
+    return results
+
+
+if __name__ == '__main__':
+    for name, label, secs in run():
+        print('{:>16} {:>12}: {:8.4f}s'.format(name, label, secs))
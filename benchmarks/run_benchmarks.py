@@ -0,0 +1,345 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+ Benchmark suite for plugin_utils
+
+ Times the hot helpers (multiple_replace, flatten, deep_getsizeof, make_json,
+ islist, clr and the text helpers) on small, medium and large synthetic
+ inputs, and the engines behind the replace_in_field, bulk_update and
+ migrate_field actions (replace_field_values, chunked_update and
+ migrate_field) on a generated table in an in-memory sqlite DAL.
+
+ Results are written as json so that runs can be compared between releases:
+
+     python benchmarks/run_benchmarks.py -o before.json
+     python benchmarks/run_benchmarks.py -o after.json --compare before.json
+
+ With --compare the script exits with status 1 if any benchmark is slower
+ than the baseline by more than the --threshold ratio.
+
+"""
+
+import argparse
+from contextlib import redirect_stdout
+import datetime
+from decimal import Decimal
+import io
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import time
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'modules'))
+from gluon import current  # noqa: E402
+from pydal import DAL, Field  # noqa: E402
+import plugin_utils  # noqa: E402
+
+SIZES = {'small': 100, 'medium': 10000, 'large': 100000}
+DB_SIZES = {'small': 100, 'medium': 5000, 'large': 50000}
+BENCHMARKS = []
+
+
+def benchmark(name, db=False):
+    """
+    Register a benchmark setup function under 'name'.
+
+    The setup function takes the number of items to generate and returns a
+    callable to time. For db benchmarks it takes a DAL connection as well,
+    and a fresh database is generated (untimed) before each repetition.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, setup, db))
+        return setup
+    return register
+
+
+def random_words(count, seed=0, length=8):
+    """
+    Return a list of count random lowercase words (reproducibly).
+    """
+    rnd = random.Random(seed)
+    return [''.join(rnd.choice(string.ascii_lowercase) for _ in range(length))
+            for _ in range(count)]
+
+
+def random_text(count, seed=0, words=12):
+    """
+    Return a list of count strings of random words, with some accented text.
+    """
+    vocab = random_words(200, seed) + ['ἀγάπη', 'λόγος', 'café', 'naïve']
+    rnd = random.Random(seed)
+    return [' '.join(rnd.choice(vocab) for _ in range(words))
+            for _ in range(count)]
+
+
+REPLACEMENTS = dict(zip(random_words(20, seed=1, length=4),
+                        random_words(20, seed=2, length=6)))
+REPLACEMENTS.update({'café': 'coffee', 'λόγος': 'word'})
+
+
+@benchmark('multiple_replace')
+def bench_multiple_replace(count):
+    text = random_text(count)
+
+    def run():
+        for line in text:
+            plugin_utils.multiple_replace(line, REPLACEMENTS)
+    return run
+
+
+@benchmark('multiple_replace_many')
+def bench_multiple_replace_many(count):
+    text = random_text(count)
+    return lambda: list(plugin_utils.multiple_replace_many(text,
+                                                           REPLACEMENTS))
+
+
+@benchmark('flatten')
+def bench_flatten(count):
+    data = [[i, (i, [i, i]), i] for i in range(count // 4)]
+    return lambda: plugin_utils.flatten(data)
+
+
+def make_records(count, seed=0):
+    """
+    Return a list of count dicts of mixed types, as from Rows.as_list().
+    """
+    words = random_words(count, seed)
+    base = datetime.datetime(2020, 1, 1)
+    return [{'id': i, 'name': words[i], 'tags': set(words[i:i + 3]),
+             'created': base + datetime.timedelta(minutes=i),
+             'price': Decimal(i) / 100, 'active': bool(i % 2)}
+            for i in range(count)]
+
+
+@benchmark('deep_getsizeof')
+def bench_deep_getsizeof(count):
+    data = {'records': make_records(count // 10),
+            'index': {w: i for i, w in enumerate(random_words(count))}}
+    return lambda: plugin_utils.deep_getsizeof(data)
+
+
+@benchmark('deep_getsizeof_sampled')
+def bench_deep_getsizeof_sampled(count):
+    data = {'records': make_records(count // 10),
+            'index': {w: i for i, w in enumerate(random_words(count))}}
+    return lambda: plugin_utils.deep_getsizeof(data, sample=100)
+
+
+@benchmark('make_json')
+def bench_make_json(count):
+    data = make_records(count // 10)
+    return lambda: plugin_utils.make_json(data)
+
+
+@benchmark('make_json_compact')
+def bench_make_json_compact(count):
+    data = make_records(count // 10)
+    return lambda: plugin_utils.make_json(data, compact=True)
+
+
+@benchmark('islist')
+def bench_islist(count):
+    data = (random_words(count // 2) + list(range(count // 4)) +
+            [(i, i) for i in range(count // 4)])
+
+    def run():
+        for item in data:
+            plugin_utils.islist(item)
+    return run
+
+
+@benchmark('clr')
+def bench_clr(count):
+    data = random_text(count, words=4)
+
+    def run():
+        for line in data:
+            plugin_utils.clr(line, 'green')
+    return run
+
+
+@benchmark('text_helpers')
+def bench_text_helpers(count):
+    data = random_words(count // 2) + random_text(count // 2, words=1)
+
+    def run():
+        for word in data:
+            plugin_utils.capitalize(word)
+            plugin_utils.capitalize_first(word)
+            plugin_utils.lowercase(word)
+            plugin_utils.firstletter(word)
+    return run
+
+
+def make_db(count, seed=0):
+    """
+    Return an in-memory sqlite DAL holding a bench_docs table of count rows.
+    """
+    db = DAL('sqlite:memory')
+    db.define_table('bench_docs',
+                    Field('body', 'text'),
+                    Field('body_copy', 'text'),
+                    Field('status'))
+    text = random_text(count, seed)
+    db.bench_docs.bulk_insert([{'body': t, 'status': ('old', 'new')[i % 2]}
+                               for i, t in enumerate(text)])
+    db.commit()
+    return db
+
+
+@benchmark('replace_field_values', db=True)
+def bench_replace_field_values(count, db):
+    return lambda: plugin_utils.replace_field_values(
+        'bench_docs', 'body', REPLACEMENTS, testing=False, db=db)
+
+
+@benchmark('chunked_update', db=True)
+def bench_chunked_update(count, db):
+    return lambda: plugin_utils.chunked_update(
+        'bench_docs', db.bench_docs.status == 'old', {'status': 'done'},
+        db=db)
+
+
+@benchmark('migrate_field', db=True)
+def bench_migrate_field(count, db):
+    return lambda: plugin_utils.migrate_field(
+        fields={'bench_docs': ('body', 'body_copy')}, db=db)
+
+
+@benchmark('migrate_field_transform', db=True)
+def bench_migrate_field_transform(count, db):
+    return lambda: plugin_utils.migrate_field(
+        fields={'bench_docs': ('body', 'body_copy')}, transform=str.upper,
+        db=db)
+
+
+def time_helper(setup, count, repeat):
+    """
+    Return the best time per call of a helper benchmark, in seconds.
+    """
+    timer = timeit.Timer(setup(count))
+    number = timer.autorange()[0]
+    return min(timer.repeat(repeat, number)) / number
+
+
+def time_db(setup, count, repeat):
+    """
+    Return the best time of a db benchmark, each run on a fresh table.
+    """
+    best = None
+    for _ in range(repeat):
+        db = make_db(count)
+        current.db = db
+        func = setup(count, db)
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            secs = time.perf_counter() - start
+        db.close()
+        best = secs if best is None else min(best, secs)
+    return best
+
+
+def git_revision():
+    """
+    Return the current git commit of the repository, if available.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=('small', 'medium', 'large'), names=None, repeat=3,
+        verbose=False):
+    """
+    Run the registered benchmarks and return the results as a dictionary.
+
+    Only the benchmarks whose names contain one of the strings in 'names' are
+    run, if it is given. Each result is keyed as 'name[size]'.
+    """
+    results = {}
+    for name, setup, is_db in BENCHMARKS:
+        if names and not any(n in name for n in names):
+            continue
+        for size in sizes:
+            count = (DB_SIZES if is_db else SIZES)[size]
+            timer = time_db if is_db else time_helper
+            secs = timer(setup, count, repeat)
+            key = '{}[{}]'.format(name, size)
+            results[key] = {'seconds': secs, 'items': count}
+            if verbose:
+                print('{:>36}: {:10.6f}s'.format(key, secs))
+    return {'meta': {'timestamp': datetime.datetime.now().isoformat(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'revision': git_revision(),
+                     'repeat': repeat},
+            'results': results}
+
+
+def compare(results, baseline, threshold=1.2):
+    """
+    Return (key, baseline seconds, seconds, ratio) for the shared benchmarks,
+    and the list of keys slower than the baseline by more than threshold.
+    """
+    rows, regressions = [], []
+    for key, res in sorted(results['results'].items()):
+        base = baseline['results'].get(key)
+        if not base:
+            continue
+        ratio = res['seconds'] / base['seconds']
+        rows.append((key, base['seconds'], res['seconds'], ratio))
+        if ratio > threshold:
+            regressions.append(key)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('-s', '--sizes', default='small,medium,large',
+                        help='comma separated sizes to run ({})'.format(
+                            ', '.join(SIZES)))
+    parser.add_argument('-k', '--names', default='',
+                        help='comma separated substrings of benchmark names')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='write the results here')
+    parser.add_argument('-c', '--compare', help='a results file to compare')
+    parser.add_argument('-t', '--threshold', type=float, default=1.2,
+                        help='slowdown ratio counted as a regression')
+    args = parser.parse_args(argv)
+
+    results = run(sizes=[s for s in args.sizes.split(',') if s],
+                  names=[n for n in args.names.split(',') if n],
+                  repeat=args.repeat, verbose=True)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        rows, regressions = compare(results, baseline, args.threshold)
+        print('\n{:>36}  {:>10}  {:>10}  {:>6}'.format('benchmark', 'baseline',
+                                                      'current', 'ratio'))
+        for key, base, secs, ratio in rows:
+            print('{:>36}  {:10.6f}  {:10.6f}  {:6.2f}{}'.format(
+                key, base, secs, ratio,
+                ' !' if key in regressions else ''))
+        if regressions:
+            print('\n{} regression(s) over {:.2f}x'.format(len(regressions),
+                                                          args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,14 +8,46 @@ web2py projects (controllers file).
 '''
 
 if 0:
-    from gluon import current, BEAUTIFY
+    from gluon import current, BEAUTIFY, HTTP
     from gluon.sqlhtml import SQLFORM
     from gluon.validators import IS_IN_SET
     from gluon.dal import Field
     request = current.request
     auth = current.auth
-from plugin_utils import flatten, makeutf8
+from plugin_utils import flatten, makeutf8, util_interface, action_stats_table
+from plugin_utils import UTIL_ACTIONS, TRUE_STRINGS
 #from pprint import pprint
 import re
 
 
+@auth.requires_membership('administrators')
+def util():
+    """
+    Display the form and output of one plugin_utils action.
+
+    The action is named by the first url arg (e.g. plugin_utils/util/
+    memory_report) and is loaded via ajax from the action controller. Since
+    the actions can evaluate submitted python and rewrite whole tables, both
+    functions are restricted to members of the administrators group.
+    """
+    if request.args(0) not in UTIL_ACTIONS:
+        raise HTTP(404)
+    return dict()
+
+
+@auth.requires_membership('administrators')
+def action():
+    """
+    Run the util_interface action named by the first url arg.
+
+    Along with the action's form and output the view receives a table of
+    the time and db queries the request took. Its peak memory is measured
+    too if the url has a true trace_memory var (e.g. plugin_utils/util/
+    replace_in_field?trace_memory=1), which slows the action down.
+    """
+    if request.args(0) not in UTIL_ACTIONS:
+        raise HTTP(404)
+    trace_memory = str(request.vars.trace_memory).lower() in TRUE_STRINGS
+    form, output, stats = util_interface(request.args(0),
+                                         trace_memory=trace_memory)
+    return dict(form=form, output=output, stats=action_stats_table(stats))
@@ -11,10 +11,15 @@
     app's business logic, providing helper functions for common tasks. They can
     also, however, be accessed via the
 
+    The pure helpers (clr through iter_json_records below, as well as
+    deep_getsizeof) live in plugin_utils_core, which does not import gluon;
+    they are re-exported here.
+
     This module file holds most of the business logic accessed through the
     controller functions. It exposes one main interface through the
     util_interface function. Through this function the following specific actions
-    can be called:
+    can be called (other plugins can add their own with the util_action
+    decorator, and each call is timed by run_instrumented):
 
     clr         :Surround a string with ansi color sequences for console output.
     islist      :Ensure that an object is a list if it was not one already.
@@ -22,8 +27,15 @@
     lowercase   :Convert string to lower case in utf-8 safe way.
     firstletter :Isolate the first letter of a byte-encoded unicode string.
     flatten     :Convert an arbitrarily deep nested list into a single flat list.
+    iflatten    :Lazily yield the items of an arbitrarily deep nested list.
+    multiple_replace      :Perform several string replacements simultaneously.
+    multiple_replace_many :Lazily apply multiple_replace to many strings.
     make_json   :Return a json object representing the provided dictionary, with
-                extra logic to handle datetime objects.
+                extra logic to handle dates, Decimals, sets and DAL rows.
+    iter_json   :Yield a json representation in chunks, streaming large lists.
+    dump_json   :Write a json representation to a file object in chunks.
+    load_json   :Parse json, optionally restoring dates and Decimals.
+    iter_json_records :Yield records one at a time from a json file.
 
     do_backup       :Calling copy_to_backup from plugin_sqlite_backup
     bulk_update     :Controller function to perform a programmatic update to a
@@ -31,6 +43,14 @@
     migrate_field   :
     migrate_table   :
     migrate_back    :
+    memory_report   :Controller function to snapshot and compare the memory
+                     held by module globals, the ram cache and the session.
+    replace_in_field:Make string replacements in every value of one db field,
+                     streaming through the table in chunks (see
+                     replace_field_values).
+    make_rows_from_filenames:Create a row for each file in a folder, walking
+                     it with os.scandir (see iter_files and
+                     rows_from_filenames).
 
     When called via the plugin_utils/util controller, which accesses the
     util_interface clearinghouse function, a form for input and a view of the
@@ -41,22 +61,40 @@
 
     ErrorReport     : a utility class for emailing custom error reports to an
                       administrator.
+    ReportQueue     : delivers ErrorReport emails from a background thread,
+                      batching them into digests.
+    ReportThrottle  : limits ErrorReport emails to one per error per time
+                      window, with periodic summaries of the rest.
 
 '''
 
-from ast import literal_eval
-from collections.abc import Mapping, Container
-import csv
+from collections import deque, OrderedDict
+from collections.abc import Hashable
 import datetime
+from decimal import Decimal
+from fnmatch import fnmatch
+from functools import partial
 from gluon import current, BEAUTIFY, SQLFORM, Field, IS_IN_SET
-from itertools import chain, zip_longest
+from gluon import TABLE, TR, TH, TD
+import hashlib
+from itertools import chain, islice
 import json
-from kitchen.text.converters import to_unicode, to_bytes
 import os
-from pprint import pprint
+from queue import Queue, Empty, Full
 import re
 import sys
-import traceback
+import threading
+import time
+
+from plugin_utils_core import (  # noqa: F401
+    _NO_DEFAULT, _bounded_map, capitalize, capitalize_first,
+    capitalize_first_many, capitalize_many, chunked, chunked_by_bytes, clr,
+    deep_getsizeof, dump_json, encodeutf8, estimate_sizeof, firstletter,
+    firstletter_many, flatten, get_replacer, grouper, iflatten, islist,
+    iter_json, iter_json_records, load_json, lowercase, lowercase_many,
+    make_json, makeutf8, multiple_replace, multiple_replace_many,
+    normalize_many, payload_size, print_sizes, Replacer, SizeEstimate,
+    sizeof_fmt)
 
 
 class ErrorReport(object):
@@ -64,16 +102,31 @@ class ErrorReport(object):
     Basic class for sending an emailed error report with a generic message.
 
     '''
-    def __init__(self, mail=None):
+    def __init__(self, mail=None, queue=None, throttle=None):
         """
         Initialize an ErrorReport object.
 
         The mail sending relies on web2py's built-in mail handler. This must
         be set up elsewhere, preferably in the models/db.py file.
 
+        If a 'queue' is supplied (a ReportQueue, or True to use the shared one
+        from get_report_queue) reports are handed to it and delivered in the
+        background instead of being sent during the failing request.
+
+        If a 'throttle' is supplied (a ReportThrottle, or True to use the
+        shared one from get_report_throttle) repeated reports of the same
+        error are only sent once per time window, and the suppressed
+        occurrences are reported periodically in a summary with counts. The
+        summary is sent by the throttle's timer thread, so it goes out even
+        if no further report arrives.
+
         """
         self.mail = current.mail if not mail else mail
         self.sender = self.mail.settings.sender
+        self.queue = get_report_queue(self.mail) if queue is True else queue
+        self.throttle = get_report_throttle() if throttle is True else throttle
+        if self.throttle is not None:
+            self.throttle.start_timer(self._deliver)
 
     def _get_message_frame(self, callingClass, callingMethod, callingUser,
                            callingRequest, traceback):
@@ -105,7 +158,6 @@ class ErrorReport(object):
         different specific purposes.
 
         """
-        print('xtra is', xtra)
         title = 'Paideia Error - {}'.format(subtitle) \
             if subtitle else 'Paideia Error'
 
@@ -127,268 +179,906 @@ class ErrorReport(object):
         method in which the error occurred.
 
         The 'mail' argument is only necessary if a mailer object was not
-        assigned earlier to self.mail.
+        assigned earlier to self.mail. If this ErrorReport has a queue and no
+        'mail' or 'sender' is given, the report is queued for background
+        delivery and this returns immediately.
+
+        If this ErrorReport has a throttle, a report whose fingerprint (see
+        report_fingerprint) was already sent in the current window is only
+        counted, and this returns False. The message body is only built for
+        reports that are actually sent.
 
         """
-        mail = self.mail if not mail else mail
-        sender = self.sender if not sender else sender
+        if self.throttle is not None:
+            fingerprint = report_fingerprint(callingClass, callingMethod,
+                                             traceback)
+            where = '{}.{}'.format(callingClass, callingMethod)
+            allowed = self.throttle.allow(fingerprint, where)
+            summary = self.throttle.pop_summary()
+            if summary:
+                self._deliver(SUMMARY_TITLE, summary, mail, sender)
+            if not allowed:
+                return False
         title, body = self._build_message(callingClass, callingMethod,
                                           callingUser, callingRequest,
                                           traceback, subtitle, xtra)
-        mail.send(sender, title, body)
+        self._deliver(title, body, mail, sender)
         return True
 
+    def _deliver(self, title, body, mail=None, sender=None):
+        """
+        Send one message, via the queue if there is one.
+        """
+        if self.queue is not None and not mail and not sender:
+            self.queue.put(title, body)
+            return
+        mail = self.mail if not mail else mail
+        sender = self.sender if not sender else sender
+        mail.send(sender, title, body)
+
+
+SUMMARY_TITLE = 'Paideia Error summary'
 
-def util_interface(funcname):
+
+def report_fingerprint(callingClass, callingMethod, traceback=''):
     """
-    Interface function for accessing util logic via the plugin_utils/util view.
+    Return a short hash identifying one kind of error.
 
-    The one required argument 'funcname' should be a string containing the name
-    of a function in this module.
+    The fingerprint combines the calling class and method with a normalized
+    form of the traceback text, in which line numbers, memory addresses and
+    the exception message (but not the exception type) are removed. So the
+    same bug gives the same fingerprint even if the values involved differ
+    or the code has moved a little.
     """
-    funcs = {'gather_from_field': gather_from_field,
-             'bulk_update': bulk_update,
-             'migrate_field': migrate_field,
-             'migrate_table': migrate_table,
-             'import_from_csv': import_from_csv,
-             'make_rows_from_field': make_rows_from_field,
-             'make_rows_from_filenames': make_rows_from_filenames,
-             'replace_in_field': replace_in_field,
-             'print_rows_as_dicts': print_rows_as_dicts}
+    lines = [ln for ln in str(traceback or '').strip().splitlines()
+             if ln.strip()]
+    if lines:
+        lines[-1] = lines[-1].split(':', 1)[0]
+    normalized = re.sub(r'0x[0-9a-fA-F]+', '0x?', '\n'.join(lines))
+    normalized = re.sub(r'line \d+', 'line ?', normalized)
+    mystring = '{}.{}\n{}'.format(callingClass, callingMethod, normalized)
+    return hashlib.sha1(mystring.encode('utf8')).hexdigest()[:16]
 
-    form, output = funcs[funcname]()
 
-    return form, output
+class ReportThrottle(object):
+    '''
+    Count error reports by fingerprint and allow one per time window.
 
+    The first occurrence of a fingerprint in each window of 'window' seconds
+    is allowed; later ones are counted as suppressed. At most 'maxsize'
+    fingerprints are tracked (the least recently seen are dropped first, and
+    their counts kept for the next summary). A summary of the suppressed
+    counts becomes available from pop_summary every 'summary_interval'
+    seconds (by default the same as 'window'). Once start_timer has been
+    called, a daemon thread also sends the summary every 'summary_interval'
+    seconds, so the counts from an error storm are reported after it stops.
 
-def print_rows_as_dicts():
-    """docstring for print_select"""
-    db = current.db
-    message = 'Click to display the query result as a list of dictionaries.'
-    form = SQLFORM.factory(Field('table', 'str'),
-                           Field('field', 'str'),
-                           Field('value', 'str'),
-                           Submit='Evaluate')
-    if form.process().accepted:
-        tbl = form.vars.table
-        fld = form.vars.field
-        val = literal_eval(form.vars.value)
-        rows = db(db[tbl][fld] == val).select().as_list()
-        if not rows:
-            rows = db(db[tbl][fld] == int(val)).select().as_list()
-        message = rows
-    elif form.errors:
-        message = BEAUTIFY(form.errors)
-    print(message)
-    return form, message
+    '''
+    def __init__(self, window=600, maxsize=500, summary_interval=None):
+        self.window = window
+        self.maxsize = maxsize
+        self.summary_interval = window if summary_interval is None \
+            else summary_interval
+        self.entries = OrderedDict()
+        self._pending = []
+        self._last_summary = time.time()
+        self._lock = threading.Lock()
+        self._deliver = None
+        self._timer = None
+        self._stopped = threading.Event()
+
+    def allow(self, fingerprint, where=''):
+        """
+        Record one occurrence and return True if it should be sent.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self.entries.pop(fingerprint, None)
+            if entry and now - entry['window_start'] < self.window:
+                entry['count'] += 1
+                entry['suppressed'] += 1
+                self.entries[fingerprint] = entry
+                return False
+            if entry and entry['suppressed']:
+                self._pending.append(dict(entry))
+            count = entry['count'] + 1 if entry else 1
+            self.entries[fingerprint] = {'where': where,
+                                         'window_start': now,
+                                         'count': count,
+                                         'suppressed': 0}
+            while len(self.entries) > self.maxsize:
+                old = self.entries.popitem(last=False)[1]
+                if old['suppressed']:
+                    self._pending.append(old)
+            return True
+
+    def pop_summary(self, force=False):
+        """
+        Return the text of a summary of suppressed reports, or None.
 
+        A summary is only returned once every 'summary_interval' seconds
+        (unless 'force' is True) and only if something was suppressed. The
+        counts it includes are reset.
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_summary < self.summary_interval:
+                return None
+            self._last_summary = now
+            counted = list(self._pending)
+            self._pending = []
+            for entry in self.entries.values():
+                if entry['suppressed']:
+                    counted.append(dict(entry))
+                    entry['suppressed'] = 0
+        if not counted:
+            return None
+        lines = ['{:>6} more occurrence(s) of the error in {} (first reported '
+                 '{})'.format(e['suppressed'], e['where'],
+                              datetime.datetime.fromtimestamp(
+                                  e['window_start']).isoformat(' ', 'seconds'))
+                 for e in sorted(counted, key=lambda e: -e['suppressed'])]
+        return 'Repeated errors not reported individually:\n\n{}\n' \
+               ''.format('\n'.join(lines))
+
+    def start_timer(self, deliver):
+        """
+        Send summaries in the background via deliver(title, body).
 
-def check_path(path):
-    if os.path.exists(path):
-        return path
-    raise OSError(2, "{}: {}".format(os.strerror(2), path))
+        The timer thread is started the first time only; later calls just
+        replace the delivery function (e.g. with that of a newer ErrorReport).
+        """
+        with self._lock:
+            self._deliver = deliver
+            if self._timer is None or not self._timer.is_alive():
+                self._stopped.clear()
+                self._timer = threading.Thread(target=self._run_timer,
+                                               name='plugin_utils summaries',
+                                               daemon=True)
+                self._timer.start()
+
+    def stop_timer(self):
+        """
+        Stop the summary timer thread (any pending counts are kept).
+        """
+        self._stopped.set()
 
+    def _run_timer(self):
+        while not self._stopped.wait(self.summary_interval):
+            try:
+                self.flush_summary(force=True)
+            except Exception:  # keep the timer alive if a send fails
+                pass
 
-#def do_backup():
-    #"""
-    #Return a form that triggers a backup of the sqlite database with a message.
-    #"""
-    #message = 'Click to perform backup.'
-    #form = SQLFORM.factory(Field('leave_empty', 'text'),
-    #                       Submit='Backup sqlite database now')
-    #if form.process().accepted:
-    #    if form.vars.leave_empty == '':
-    #        message = copy_to_backup()
-    #        if not message:
-    #            message = 'Sorry, the backup failed.'
-    #elif form.errors:
-    #    message = BEAUTIFY(form.errors)
-    #return form, message
+    def flush_summary(self, force=False):
+        """
+        Send the summary (see pop_summary), if there is one, and return it.
+        """
+        summary = self.pop_summary(force)
+        if summary and self._deliver:
+            self._deliver(SUMMARY_TITLE, summary)
+        return summary
 
 
-def islist(obj):
+_shared_report_throttle = None
+
+
+def get_report_throttle(**kwargs):
     """
-    Return the supplied object converted to a list if it is not one already.
+    Return the ReportThrottle shared by this process, creating it if needed.
+
+    Any keyword arguments are passed to ReportThrottle the first time only.
     """
-    if isinstance(obj, (str, int, long, float, unicode)):
-        obj = [obj]
-    else:
-        obj = list(obj)
-    return obj
-
-
-def clr(string, mycol='white'):
-    """
-    Return a string surrounded by ansi colour escape sequences.
-
-    This function is intended to simplify colourizing terminal output.
-    The default color is white. The function can take any number of positional
-    arguments as component strings, which will be joined (space delimited)
-    before being colorized.
-    """
-    col = {'white': '\033[95m',
-           'blue': '\033[94m',
-           'green': '\033[92m',
-           'orange': '\033[93m',
-           'red': '\033[91m',
-           'lightblue': '\033[1;34m',
-           'lightgreen': '\033[1;32m',
-           'lightcyan': '\033[1;36m',
-           'lightred': '\033[1;31m',
-           'lightpurple': '\033[1;35m',
-           'white': '\033[1;37m',
-           'endc': '\033[0m'
-           }
-    thecol = col[mycol]
-    endc = col['endc']
-    if isinstance(string, list):
+    global _shared_report_throttle
+    if _shared_report_throttle is None:
+        _shared_report_throttle = ReportThrottle(**kwargs)
+    return _shared_report_throttle
+
+
+class LocalMailer(object):
+    '''
+    A stand-in for web2py's Mail object which keeps messages instead of
+    sending them.
+
+    Useful for tests and for local development. Like Mail.send, the send
+    method returns False on failure; 'fail_times' makes the first n calls
+    fail, to exercise retry logic.
+
+    '''
+    class _Settings(object):
+        def __init__(self, sender):
+            self.sender = sender
+
+    def __init__(self, sender='errors@localhost', fail_times=0):
+        self.settings = self._Settings(sender)
+        self.sent = []
+        self.fail_times = fail_times
+        self.attempts = 0
+
+    def send(self, to, subject='', message=''):
+        self.attempts += 1
+        if self.attempts <= self.fail_times:
+            return False
+        self.sent.append((to, subject, message))
+        return True
+
+
+class ReportQueue(object):
+    '''
+    Deliver error reports by email from a background thread, in digests.
+
+    Reports are put on an in-memory queue (and, if a 'spool_dir' is given,
+    also written there as json files, so that reports not yet delivered when
+    the process stops are sent by the next ReportQueue using that folder). A
+    daemon worker thread drains the queue, gathering up to 'batch_size'
+    reports that arrive within 'batch_window' seconds of each other into one
+    digest email. Failed sends are retried up to 'max_retries' times,
+    waiting 'backoff' seconds and doubling the wait after each failure.
+
+    Several processes may share one spool folder. Before sending, each spool
+    file is claimed by atomically renaming it, so a report is only sent by
+    the queue that claimed it. Files that cannot be parsed are moved aside
+    with a '.bad' suffix, and a file left claimed by a process that died is
+    released again after 'claim_timeout' seconds.
+
+    '''
+    def __init__(self, mail=None, sender=None, spool_dir=None, batch_size=20,
+                 batch_window=5.0, max_retries=5, backoff=2.0, maxsize=1000,
+                 claim_timeout=3600):
+        """
+        Initialize a ReportQueue object.
+
+        As for ErrorReport, the mailer defaults to current.mail.
+        """
+        self.mail = current.mail if not mail else mail
+        self.sender = self.mail.settings.sender if not sender else sender
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue = Queue(maxsize)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.corrupt = 0
+        self._token = '{}-{}'.format(os.getpid(), id(self))
+        self._lock = threading.Lock()
+        self._thread = None
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+            self._release_stale(claim_timeout)
+            for fname in sorted(os.listdir(spool_dir)):
+                if fname.endswith('.json'):  # loaded once claimed
+                    self._enqueue({'spool': os.path.join(spool_dir, fname)})
+
+    def _release_stale(self, claim_timeout):
+        """
+        Return to the spool any file claimed more than claim_timeout ago.
+        """
+        now = time.time()
+        for fname in os.listdir(self.spool_dir):
+            if not fname.endswith('.sending'):
+                continue
+            path = os.path.join(self.spool_dir, fname)
+            try:
+                if now - os.path.getmtime(path) > claim_timeout:
+                    os.rename(path, path.rsplit('.json.', 1)[0] + '.json')
+            except OSError:  # released or sent by another process meanwhile
+                pass
+
+    def put(self, title, body):
+        """
+        Queue one report (title and body) for delivery.
+        """
+        item = {'title': title, 'body': body,
+                'time': datetime.datetime.utcnow().isoformat(), 'spool': None}
+        if self.spool_dir:
+            fname = '{}-{}.json'.format(time.time_ns(), id(item))
+            path = os.path.join(self.spool_dir, fname)
+            with open(path + '.tmp', 'w', encoding='utf8') as spoolfile:
+                json.dump(item, spoolfile)
+            os.replace(path + '.tmp', path)
+            item['spool'] = path
+        self._enqueue(item)
+
+    def _enqueue(self, item):
         try:
-            string = ' '.join(string)
-        except TypeError:
-            string = ' '.join([str(s) for s in string])
+            self.queue.put_nowait(item)
+        except Full:  # a spooled report stays on disk for the next run
+            self.dropped += 1
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='plugin_utils reports',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except Empty:
+                    break
+            try:
+                self._deliver(batch)
+            except Exception:  # keep the worker thread alive
+                self.failed += len(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _claim(self, item):
+        """
+        Take ownership of a report's spool file, loading it if necessary.
 
-    newstring = '{}{}{}'.format(thecol, string, endc)
-    return newstring
+        Returns the item, or None if another queue claimed the file first or
+        it could not be parsed (it is then renamed with a '.bad' suffix).
+        """
+        path = item.get('spool')
+        if not path:
+            return item
+        claimed = '{}.{}.sending'.format(path, self._token)
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            return None
+        item.update(spool=claimed, source=path)
+        if 'title' not in item:
+            try:
+                with open(claimed, encoding='utf8') as spoolfile:
+                    data = json.load(spoolfile)
+                item.update(title=data['title'], body=data['body'],
+                            time=data.get('time', ''))
+            except (OSError, ValueError, KeyError, TypeError):
+                self.corrupt += 1
+                self._move(claimed, path + '.bad')
+                return None
+        return item
+
+    @staticmethod
+    def _move(path, newpath=None):
+        """
+        Rename (or, without a newpath, remove) a spool file if it still exists.
+        """
+        try:
+            if newpath:
+                os.rename(path, newpath)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def _deliver(self, batch):
+        """
+        Send one batch of reports as a single email, retrying with backoff.
+        """
+        batch = [i for i in (self._claim(item) for item in batch) if i]
+        if not batch:
+            return True
+        title, body = self._digest(batch)
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                ok = self.mail.send(self.sender, title, body)
+            except Exception:
+                ok = False
+            if ok:
+                self.sent += len(batch)
+                for item in batch:
+                    if item.get('spool'):
+                        self._move(item['spool'])
+                return True
+            if attempt < self.max_retries:
+                time.sleep(delay)
+                delay *= 2
+        self.failed += len(batch)
+        for item in batch:  # leave them for a later queue to retry
+            if item.get('spool'):
+                self._move(item['spool'], item['source'])
+        return False
+
+    def _digest(self, batch):
+        """
+        Return the title and body of one email covering a batch of reports.
+        """
+        if len(batch) == 1:
+            return batch[0]['title'], batch[0]['body']
+        title = 'Paideia Error digest - {} reports'.format(len(batch))
+        body = '\n\n{}\n\n'.format('=' * 70).join(
+            '{} ({})\n\n{}'.format(item['title'], item['time'], item['body'])
+            for item in batch)
+        return title, body
+
+    def flush(self):
+        """
+        Block until every queued report has been delivered (or has failed).
+        """
+        self.queue.join()
 
 
-def makeutf8(rawstring):
-    """Return the string decoded as utf8 if it wasn't already."""
-    try:
-        rawstring = rawstring.decode('utf8')
-    except (UnicodeEncodeError, UnicodeDecodeError):  # if already decoded
-        rawstring = rawstring
-    except (AttributeError, TypeError):  # if rawstring is NoneType
-        rawstring = 'None'
-    return rawstring
+_shared_report_queue = None
 
 
-def encodeutf8(rawstring):
-    """Return string encoded as bytestring from utf8 if it wasn't already."""
-    try:
-        newstring = rawstring.encode('utf8')
-    except UnicodeDecodeError:
-        newstring = rawstring
-    except (AttributeError, TypeError):
-        newstring = 'None'
-    return newstring
+def get_report_queue(mail=None, **kwargs):
+    """
+    Return the ReportQueue shared by this process, creating it if necessary.
+
+    Since web2py runs the model files on every request, a queue created there
+    would be replaced each time. This keeps a single queue (and worker
+    thread) for the life of the process. Any keyword arguments are passed to
+    ReportQueue the first time only.
+    """
+    global _shared_report_queue
+    if _shared_report_queue is None:
+        _shared_report_queue = ReportQueue(mail, **kwargs)
+    return _shared_report_queue
+
 
+UTIL_ACTIONS = OrderedDict()
+UNTRACED_ACTIONS = set()
+ACTION_STATS = deque(maxlen=100)
+_TRACING_LOCK = threading.Lock()
+_TRACING = {'users': 0, 'started': False}
 
-def capitalize(letter):
+
+def util_action(func=None, name=None, form=True, trace_memory=True):
     """
-    Convert string to upper case in utf-8 safe way.
+    Decorator registering a function as an action for util_interface.
+
+    The action is registered under its function name unless another 'name'
+    is given. Registered functions normally build their own SQLFORM and
+    return a (form, output) tuple. Functions that take no input and just
+    return a value (like migrate_table) should be registered with form=False;
+    they are then wrapped in a form with a single submit button, so that they
+    only run when that button is clicked. Actions that use tracemalloc
+    themselves (like memory_report) should be registered with
+    trace_memory=False, so that util_interface does not trace them too.
+
+    Other plugins can register their own maintenance actions in the same way:
+
+        from plugin_utils import util_action
+
+        @util_action
+        def my_cleanup():
+            ...
+            return form, output
     """
-    letter = to_unicode(letter, encoding='utf8')
-    newletter = letter.upper()
-    newletter = to_bytes(letter, encoding='utf8')
-    return newletter
+    if func is None:
+        return partial(util_action, name=name, form=form,
+                       trace_memory=trace_memory)
+    name = name or func.__name__
+    UTIL_ACTIONS[name] = func if form else partial(_confirm_action, func, name)
+    if not trace_memory:
+        UNTRACED_ACTIONS.add(name)
+    return func
 
 
-def capitalize_first(mystring):
+def _confirm_action(func, name):
     """
-    Return the supplied string with its first letter capitalized.
+    Run a registered action without a form of its own once confirmed.
+    """
+    out = 'Click to run {}.'.format(name)
+    form = SQLFORM.factory(Submit='Run {}'.format(name))
+    if form.process().accepted:
+        out = BEAUTIFY(func())
+    elif form.errors:
+        out = BEAUTIFY(form.errors)
+    return form, out
+
+
+def _timings_since(timings, mark):
     """
-    mystring = to_unicode(mystring, encoding='utf8')
-    first, rest = mystring[:1], mystring[1:]
-    first = first.upper()
-    newstring = u'{}{}'.format(first, rest)
-    newstring = to_bytes(newstring, encoding='utf8')
+    Return the db._timings entries added after the entry 'mark'.
 
-    return newstring
+    The DAL keeps only the latest timings, so if 'mark' has been dropped from
+    the list all of it is returned and the second value returned is True.
+    """
+    for idx in range(len(timings) - 1, -1, -1):
+        if timings[idx] is mark:
+            return timings[idx + 1:], False
+    return list(timings), mark is not None
 
 
-def lowercase(letter):
+def _start_tracing():
     """
-    Convert string to lower case in utf-8 safe way.
+    Register a user of tracemalloc, starting it if nobody is tracing yet.
+
+    Returns the traced memory at the start of the call. The peak is only
+    reset when there are no other users, so with overlapping calls the peak
+    covers all of them.
     """
-    letter = makeutf8(letter)
-    newletter = letter.lower()
-    return newletter
+    import tracemalloc
+
+    with _TRACING_LOCK:
+        if not _TRACING['users']:
+            _TRACING['started'] = not tracemalloc.is_tracing()
+            if _TRACING['started']:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        _TRACING['users'] += 1
+        return tracemalloc.get_traced_memory()[0]
 
 
-def firstletter(mystring):
+def _stop_tracing(mem_start=0):
     """
-    Find the first letter of a byte-encoded unicode string.
+    Unregister a user of tracemalloc and return its peak memory.
+
+    Tracing is only stopped by the last user, and only if _start_tracing
+    started it (so tracing started elsewhere is left running).
     """
-    mystring = makeutf8(mystring)
-    let, tail = mystring[:1], mystring[1:]
-    return let, tail
+    import tracemalloc
+
+    with _TRACING_LOCK:
+        peak = tracemalloc.get_traced_memory()[1] - mem_start
+        _TRACING['users'] -= 1
+        if not _TRACING['users'] and _TRACING['started']:
+            tracemalloc.stop()
+            _TRACING['started'] = False
+        return max(peak, 0)
 
 
-def flatten(items, seqtypes=(list, tuple)):
+def run_instrumented(func, args=(), kwargs=None, name=None, db=None,
+                     trace_memory=False):
     """
-    Convert an arbitrarily deep nested list into a single flat list.
+    Call func and measure what the call cost.
+
+    Returns the function's result and a dictionary of statistics: the wall
+    and cpu time in seconds, the number of db queries and the time spent in
+    them (read from db._timings, which is current.db unless another 'db' is
+    given), and (if 'trace_memory') the peak memory allocated during the call
+    as measured by tracemalloc. Tracing slows down every allocation, which
+    also inflates the times measured, so it is off unless asked for. It is
+    shared between threads (see _start_tracing), so the peak of calls that
+    overlap in time includes the memory allocated by the others. Since the DAL only keeps its most recent
+    timings, 'queries_truncated' is True if the query counts are incomplete.
+    The statistics are also appended to ACTION_STATS.
     """
-    while any(isinstance(i, seqtypes) for i in items):
-        items = list(chain.from_iterable([islist(i) for i in items]))
-    return items
+    db = getattr(current, 'db', None) if db is None else db
+    timings = db._timings if db is not None else []
+    mark = timings[-1] if timings else None
+    if trace_memory:
+        mem_start = _start_tracing()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        result = func(*args, **(kwargs or {}))
+    finally:
+        stats = OrderedDict([
+            ('action', name or getattr(func, '__name__', repr(func))),
+            ('wall_time', time.perf_counter() - wall_start),
+            ('cpu_time', time.process_time() - cpu_start)])
+        if trace_memory:
+            stats['peak_memory'] = _stop_tracing(mem_start)
+        queries, truncated = _timings_since(timings, mark)
+        stats['queries'] = len(queries)
+        stats['query_time'] = sum(q[1] for q in queries)
+        stats['queries_truncated'] = truncated
+        ACTION_STATS.append(stats)
+    return result, stats
+
+
+def util_interface(funcname, trace_memory=False):
+    """
+    Interface function for accessing util logic via the plugin_utils/util view.
+
+    The one required argument 'funcname' should be a string containing the name
+    of an action registered with the util_action decorator (see UTIL_ACTIONS).
+
+    Returns a (form, output, stats) tuple: the action's form and output,
+    along with a dictionary of timing and query statistics for the call (see
+    run_instrumented). Callers written for the older (form, output) return
+    value need to unpack the third item too. The peak memory is only
+    measured if 'trace_memory' is True, since tracing slows the action down
+    (and is never measured for actions in UNTRACED_ACTIONS).
+    """
+    trace_memory = trace_memory and funcname not in UNTRACED_ACTIONS
+    (form, output), stats = run_instrumented(UTIL_ACTIONS[funcname],
+                                             name=funcname,
+                                             trace_memory=trace_memory)
+    return form, output, stats
 
 
-def make_json(data):
+def action_stats_table(stats):
     """
-    Return json object representing the data provided in dictionary "data".
+    Return a web2py TABLE helper displaying one action's statistics.
     """
-    date_handler = lambda obj: obj.isoformat() \
-        if isinstance(obj, datetime.datetime) else None
-    myjson = json.dumps(data,
-                        default=date_handler,
-                        indent=4,
-                        sort_keys=True)
-    return myjson
+    rows = [TR(TH('wall time'), TD('{:.3f} s'.format(stats['wall_time']))),
+            TR(TH('cpu time'), TD('{:.3f} s'.format(stats['cpu_time']))),
+            TR(TH('db queries'),
+               TD('{}{} ({:.3f} s)'.format(
+                   stats['queries'],
+                   '+' if stats['queries_truncated'] else '',
+                   stats['query_time'])))]
+    if 'peak_memory' in stats:
+        rows.append(TR(TH('peak memory'),
+                       TD(sizeof_fmt(stats['peak_memory']))))
+    return TABLE(*rows, _class='plugin_utils_stats')
+
 
+TRUE_STRINGS = frozenset(['true', 't', 'yes', 'y', 'on', '1'])
 
-def load_json(data):
+
+def coerce_field_value(field, value):
+    """
+    Convert a string typed into a form to a value of the field's DAL type.
+
+    Integer, id and reference fields give an int, double a float, decimal a
+    Decimal, boolean a bool, and date, time and datetime fields are parsed
+    from iso format. For list: fields the value is converted to the type of
+    one list item. The string 'None' (or an empty value) gives None. Other
+    values are returned as strings, without any quotes around them.
+    """
+    if value is None or value.strip() in ('', 'None'):
+        return None
+    value = value.strip()
+    ftype = field.type
+    if ftype.startswith('list:'):
+        ftype = ftype[5:]
+    if ftype in ('id', 'integer', 'bigint') or ftype.startswith('reference'):
+        return int(value)
+    if ftype == 'double':
+        return float(value)
+    if ftype.startswith('decimal'):
+        return Decimal(value)
+    if ftype == 'boolean':
+        return value.lower() in TRUE_STRINGS
+    if ftype == 'date':
+        return datetime.date.fromisoformat(value)
+    if ftype == 'time':
+        return datetime.time.fromisoformat(value)
+    if ftype == 'datetime':
+        return datetime.datetime.fromisoformat(value)
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '\'"':
+        return value[1:-1]
+    return value
+
+
+def field_query(table, fieldname, value):
     """
-    Return a dictionary representing the supplied json string "data".
+    Return a DAL query matching the rows whose field equals the form value.
+
+    The value is converted once by coerce_field_value. For list: fields the
+    query matches rows whose list contains the value.
+    """
+    field = table[fieldname]
+    myval = coerce_field_value(field, value)
+    if field.type.startswith('list:') and myval is not None:
+        return field.contains(myval)
+    return field == myval
+
+
+def iter_query_dicts(tablename, fieldname, value, fields=None,
+                     page_size=1000, after_id=0, db=None):
+    """
+    Lazily yield the rows matching a field value as dictionaries.
+
+    Only the id and the named 'fields' (all fields if none are named) are
+    selected, and the rows are fetched in pages of 'page_size' rows in id
+    order, starting after the id 'after_id'.
+    """
+    db = current.db if db is None else db
+    table = db[tablename]
+    query = field_query(table, fieldname, value)
+    fields = fields or table.fields
+    for rows in iter_table(db, tablename, fields, batch_size=page_size,
+                           query=query, start_id=after_id):
+        for row in rows:
+            yield row.as_dict()
+
+
+def query_page(tablename, fieldname, value, fields=None, page_size=50,
+               after_id=0, db=None):
+    """
+    Return one page of the rows matching a field value, as dictionaries.
+
+    Returns a tuple of the list of rows and the id to pass as 'after_id' to
+    get the next page (or None if this is the last page).
     """
-    myjson = json.loads(data)
-    return myjson
+    page = list(islice(iter_query_dicts(tablename, fieldname, value, fields,
+                                        page_size=page_size + 1,
+                                        after_id=after_id, db=db),
+                       page_size + 1))
+    next_id = page[page_size - 1]['id'] if len(page) > page_size else None
+    return page[:page_size], next_id
 
 
-def gather_from_field(tablename, fieldname, regex_str, exclude,
-                      filter_func=None, unique=True):
+def export_query_json(tablename, fieldname, value, path, fields=None,
+                      page_size=1000, db=None):
+    """
+    Write all the rows matching a field value to a json file at 'path'.
+
+    The rows are read page by page (see iter_query_dicts) and written as a
+    compact json list by dump_json, so the result is never all in memory.
+    Returns the number of rows written.
+    """
+    count = [0]
+
+    def counted(rows):
+        for row in rows:
+            count[0] += 1
+            yield row
+
+    with open(path, 'w', encoding='utf8') as fp:
+        dump_json(counted(iter_query_dicts(tablename, fieldname, value,
+                                           fields, page_size=page_size,
+                                           db=db)), fp)
+    return count[0]
+
+
+@util_action
+def print_rows_as_dicts():
+    """
+    Controller function to inspect the rows whose field has a given value.
+
+    The value is entered as plain text and converted according to the
+    field's type. Only the selected 'columns' (all if none are given) are
+    read, one page of 'page_size' rows at a time; to see the next page,
+    submit again with 'after_id' set to the next_after_id shown. If an
+    'export_path' is given, all the matching rows are also written there as
+    json.
+    """
+    message = 'Click to display the query result as a list of dictionaries.'
+    form = SQLFORM.factory(Field('table', 'str'),
+                           Field('field', 'str'),
+                           Field('value', 'str'),
+                           Field('columns', 'list:string'),
+                           Field('page_size', 'integer', default=50),
+                           Field('after_id', 'integer', default=0),
+                           Field('export_path'),
+                           Submit='Evaluate')
+    if form.process().accepted:
+        vv = form.vars
+        columns = [c.strip() for c in vv.columns or [] if c.strip()]
+        rows, next_id = query_page(vv.table, vv.field, vv.value,
+                                   fields=columns,
+                                   page_size=vv.page_size or 50,
+                                   after_id=vv.after_id or 0)
+        message = {'rows': rows, 'next_after_id': next_id}
+        if vv.export_path:
+            message['exported'] = export_query_json(vv.table, vv.field,
+                                                    vv.value, vv.export_path,
+                                                    fields=columns)
+        message = BEAUTIFY(message)
+    elif form.errors:
+        message = BEAUTIFY(form.errors)
+    return form, message
+
+
+def check_path(path):
+    if os.path.exists(path):
+        return path
+    raise OSError(2, "{}: {}".format(os.strerror(2), path))
+
+
+#def do_backup():
+    #"""
+    #Return a form that triggers a backup of the sqlite database with a message.
+    #"""
+    #message = 'Click to perform backup.'
+    #form = SQLFORM.factory(Field('leave_empty', 'text'),
+    #                       Submit='Backup sqlite database now')
+    #if form.process().accepted:
+    #    if form.vars.leave_empty == '':
+    #        message = copy_to_backup()
+    #        if not message:
+    #            message = 'Sorry, the backup failed.'
+    #elif form.errors:
+    #    message = BEAUTIFY(form.errors)
+    #return form, message
+
+
+REGEXP_ENGINES = ('sqlite', 'postgres', 'mysql')
+
+
+def iter_field_values(tablename, fieldnames, regex_str=None, exclude=None,
+                      filter_func=None, trans_func=None, unique=True, db=None):
+    """
+    Lazily yield the values of one or more db fields satisfying a regex.
+
+    Only the requested fields are selected, and rows are streamed from the
+    database with iterselect rather than loaded all at once. Where the
+    backend supports it (see REGEXP_ENGINES) the regex is applied to string
+    and text fields in the database with REGEXP. Otherwise values are matched
+    in Python with re.search (on str(value) for fields of other types), after
+    narrowing the rows of string and text fields with LIKE '%...%' if the
+    regex has no special characters. If 'unique' is True, duplicates are removed by the
+    database (SELECT DISTINCT) and again after any transformation.
+
+    The optional 'filter_func' (keep values for which it returns True) and
+    'trans_func' (alter each value) are applied in that order, before
+    duplicates are removed. Values in 'exclude' (any iterable; it is turned
+    into a set) are skipped.
+    """
+    db = current.db if db is None else db
+    table = db[tablename]
+    fieldnames = [fieldnames] if isinstance(fieldnames, str) else fieldnames
+    exclude = set(exclude or [])
+    seen = set()
+    for fieldname in fieldnames:
+        field = table[fieldname]
+        query = field != None
+        regex = None
+        is_text = field.type in ('string', 'text')
+        if regex_str and is_text and \
+                db._adapter.dbengine in REGEXP_ENGINES:
+            query &= field.regexp(regex_str)
+        elif regex_str:
+            regex = re.compile(regex_str)
+            if is_text and re.escape(regex_str) == regex_str:  # a substring
+                query &= field.contains(regex_str)
+        for row in db(query).iterselect(field, distinct=unique):
+            item = row[fieldname]
+            if regex and not regex.search(item if is_text else str(item)):
+                continue
+            if filter_func and not filter_func(item):
+                continue
+            if trans_func:
+                item = trans_func(item)
+            if item in exclude:
+                continue
+            if unique:
+                if item in seen:
+                    continue
+                seen.add(item)
+            yield item
+
+
+@util_action
+def gather_from_field(tablename=None, fieldname=None, regex_str=None,
+                      exclude=None, filter_func=None, unique=True):
     """
     Return a list of all strings satisfying the supplied regex.
 
-    The fieldnames argument should be a list, so that multiple target fields
-    can be searched at once.
+    The form's 'target_field' may name several fields of the target table,
+    separated by commas, so that multiple fields can be searched at once.
+    The 'tablename', 'fieldname', 'regex_str' and 'exclude' arguments only
+    supply the form's defaults.
 
     The optional 'unique' keyword argument determines whether duplicates will
-    be removed from the list. (Defaults to True.)
+    be removed from the list. (Defaults to True.) Values listed in 'exclude'
+    are left out.
+
+    The optional 'filter_func' (keep the strings for which it returns True)
+    and 'trans_func' (alter each string) are python expressions entered in
+    the form. The alteration happens before duplicate values are removed.
+    So, for example, the strings can be normalized for case or accent
+    characters if those variations are not significant.
 
-    The optional 'filterfunc' keyword argument allows a function to be passed
-    which which will be used to alter the gathered strings. This alteration will
-    happen before duplicate values are removed. So, for example, the strings
-    can be normalized for case or accent characters if those variations are
-    not significant.
+    The values are gathered by iter_field_values, which can also be used
+    directly (outside this form) to stream the values from large tables.
     """
 
-    db = current.db
-    form = SQLFORM.factory(Field('target_field'),
-                           Field('target_table'),
+    items = []
+    form = SQLFORM.factory(Field('target_field', default=fieldname),
+                           Field('target_table', default=tablename),
+                           Field('regex_str', default=regex_str),
+                           Field('exclude', 'list:string', default=exclude),
                            Field('filter_func'),
                            Field('trans_func'),
                            Field('write_table'),
                            Field('write_field'),
-                           Field('unique', 'boolean', default=True),
+                           Field('unique', 'boolean', default=unique),
                            Field('testing', 'boolean', default=True))
 
     if form.process().accepted:
         vv = form.vars
-        filter_func = eval(vv.filter_func) if vv.filter_func else None
+        filter_func = eval(vv.filter_func) if vv.filter_func else filter_func
         trans_func = eval(vv.trans_func) if vv.trans_func else None
 
-        items = []
-        rows = db(db[vv.target_table].id > 0).select()
-        for r in rows:
-            items.append(r['target_field'])
-
-        if filter_func:
-            items = filter(filter_func, items)
-        if trans_func:
-            items = [trans_func(i) for i in items]
-        if vv.unique:
-            items = list(set(items))
-        items = [i for i in items if i not in exclude]
+        items = list(iter_field_values(vv.target_table,
+                                       [f.strip() for f in
+                                        vv.target_field.split(',')],
+                                       regex_str=vv.regex_str or None,
+                                       exclude=vv.exclude or exclude,
+                                       filter_func=filter_func,
+                                       trans_func=trans_func,
+                                       unique=vv.unique))
 
     elif form.errors:
         items = BEAUTIFY(form.errors)
@@ -396,34 +1086,54 @@ def gather_from_field(tablename, fieldname, regex_str, exclude,
     return form, items
 
 
-def multiple_replace(string, key_values, return_unicode=True):
+def chunked_update(tablename, query, values, batch_size=1000, sample_size=20,
+                   preview=False, db=None):
     """
-    Perform multiple string replacements simultaneously and return a unicode str.
+    Apply db(query).update(**values) in batches of rows by primary key.
 
-    Because the replacements are simultaneous the results of one replacement
-    will not be seen in making other replacements. For example, if 're' is to
-    be replaced by 'in' and 'nt' is to be replaced by 'ch' (('re', 'in'),
-    ('int', 'ch')), the input string 'return' would become 'inturn' not 'churn'.
+    The matching rows are first counted. Each batch covers the next
+    'batch_size' matching ids (keyset pagination, so gaps in the ids do not
+    matter) and is committed on its own, so that other writers are only
+    blocked for the length of one batch. Only the first 'sample_size'
+    matching rows are selected back for display.
 
-    The key_values argument should be a dictionary pairing old values (keys)
-    with replacement values (values).
-
-    From http://stackoverflow.com/questions/6116978/python-replace-multiple-strings
+    If 'preview' is True nothing is updated; the count and the sample of the
+    rows that would be changed are returned instead.
 
+    Returns a dictionary with the number of rows 'matched' and 'updated', the
+    number of 'batches', the 'elapsed' time, and the 'sample' Rows.
     """
-    # TODO: Should this accept regexes as the keys? (currently doesn't)
-    rep = {re.escape(k): v for k, v in key_values.items()}
-    regexstr = "|".join(rep.keys())
-    pattern = re.compile(regexstr)
-    text = pattern.sub(lambda m: rep[re.escape(m.group(0))], string)
-    print('returning', type(text))
-
-    return text
-
-
+    db = current.db if db is None else db
+    table = db[tablename]
+    started = time.time()
+    matched = db(query).count()
+    sample_ids = [r.id for r in db(query).select(table.id, orderby=table.id,
+                                                 limitby=(0, sample_size))]
+    out = {'matched': matched, 'updated': 0, 'batches': 0,
+           'preview': preview}
+    last_id = 0
+    ids = iter_table(db, table, [], batch_size, query=query) \
+        if not preview else []
+    for batch in ids:
+        batch_query = query & (table.id > last_id) & \
+            (table.id <= batch.last().id)
+        out['updated'] += db(batch_query).update(**values) or 0
+        db.commit()
+        out['batches'] += 1
+        last_id = batch.last().id
+    out['sample'] = db(table.id.belongs(sample_ids)).select(orderby=table.id)
+    out['elapsed'] = time.time() - started
+    return out
+
+
+@util_action
 def bulk_update():
     """
     Controller function to perform a programmatic update to a field in one table.
+
+    The update is applied by chunked_update in batches of 'batch_size' rows,
+    each committed separately. With 'preview' checked (the default) the
+    matching rows are only counted and sampled, without being changed.
     """
     response = current.response
     db = current.db
@@ -432,15 +1142,23 @@ def bulk_update():
         Field('table', requires=IS_IN_SET(db.tables)),
         Field('field'),
         Field('query'),
-        Field('new_value'))
+        Field('new_value'),
+        Field('batch_size', 'integer', default=1000),
+        Field('sample_size', 'integer', default=20),
+        Field('preview', 'boolean', default=True))
     if form.process().accepted:
-        query = eval(form.vars.query)
+        vv = form.vars
+        query = eval(vv.query)
         try:
-            recs = db(query)
-            recs.update(**{form.vars.field: form.vars.new_value})
-            myrecs = recs.select()
-            response.flash = 'update succeeded'
+            myrecs = BEAUTIFY(chunked_update(vv.table, query,
+                                             {vv.field: vv.new_value},
+                                             batch_size=vv.batch_size or 1000,
+                                             sample_size=vv.sample_size or 20,
+                                             preview=vv.preview))
+            response.flash = 'preview only' if vv.preview \
+                else 'update succeeded'
         except Exception:
+            import traceback
             print(traceback.format_exc(5))
     elif form.errors:
         myrecs = BEAUTIFY(form.errors)
@@ -449,45 +1167,219 @@ def bulk_update():
     return form, myrecs
 
 
-def migrate_field():
+MIGRATE_FIELD_MAP = {'plugin_slider_slides': ('content', 'slide_content')}
+
+
+@util_action(form=False)
+def migrate_field(fields=None, transform=None, chunk_size=None,
+                  checkpoint=None, restart=False, time_limit=None, db=None):
     """
+    Copy the values of one field into another field of the same table.
+
+    The 'fields' argument is a dictionary pairing table names with a tuple of
+    (source_field, target_field). It defaults to MIGRATE_FIELD_MAP.
+
+    Without a 'transform' function the copy is pushed down to the database as
+    a single UPDATE statement per table (or, if 'chunk_size' is given, one
+    statement per chunk of chunk_size rows, each committed separately). If a
+    'transform' function is supplied it is applied to each source value in
+    Python and the rows are updated one at a time, in chunks of chunk_size
+    (default 1000) rows.
+
+    If a 'checkpoint' store is supplied (a CheckpointStore, or True to use the
+    default one) progress is recorded with each commit, so that a run which
+    stops (or hits 'time_limit' seconds) can be continued by calling again.
+    Pass restart=True to ignore any recorded progress.
+
+    Returns a dictionary with the number of records copied, whether the job
+    completed, and the elapsed time overall and per table.
     """
-    db = current.db
-    fields = {'plugin_slider_slides': ('content', 'slide_content')}
-    for t, f in fields.iteritems():
-        table = t
-        source_field = f[0]
-        target_field = f[1]
-        items = db(db[table].id > 0).select()
-        c = 0
+    db = current.db if db is None else db
+    fields = MIGRATE_FIELD_MAP if fields is None else fields
+    store = CheckpointStore(db) if checkpoint is True else checkpoint
+    started = time.time()
+    c = 0
+    complete = True
+    timings = {}
+    for table, (source_field, target_field) in fields.items():
+        table_started = time.time()
+        sig = job_signature('migrate_field', table=table, source=source_field,
+                            target=target_field, transform=transform)
+        start_id, done = store.resume_point(sig, restart) if store else (0, False)
+        if done:
+            continue
+        if transform:
+            copied, complete = _migrate_field_rows(db, table, source_field,
+                                                   target_field, transform,
+                                                   chunk_size or 1000,
+                                                   start_id, store, sig,
+                                                   started, time_limit)
+        else:
+            copied, complete = _migrate_field_sql(db, table, source_field,
+                                                  target_field, chunk_size,
+                                                  start_id, store, sig,
+                                                  started, time_limit)
+        c += copied
+        timings[table] = time.time() - table_started
+        if not complete:
+            break
+        if store:
+            store.save(sig, complete=True, job='migrate_field')
+        db.commit()
+
+    return {'records_copied': c,
+            'complete': complete,
+            'mode': 'rows' if transform else 'sql',
+            'elapsed': time.time() - started,
+            'table_elapsed': timings}
+
+
+def _migrate_field_sql(db, table, source_field, target_field, chunk_size,
+                       start_id, store, sig, started, time_limit):
+    """
+    Copy source_field to target_field with set-based UPDATE statements.
+
+    Returns a tuple of the number of rows updated and whether the whole
+    table was covered.
+    """
+    tbl = db[table]
+    values = {target_field: tbl[source_field]}
+    if not chunk_size:
+        return db(tbl.id > start_id).update(**values) or 0, True
+
+    copied = 0
+    lo = start_id
+    for ids in iter_table(db, tbl, [], chunk_size, start_id=start_id):
+        hi = ids.last().id
+        count = db((tbl.id > lo) & (tbl.id <= hi)).update(**values) or 0
+        copied += count
+        if store:
+            store.save(sig, hi, count, job='migrate_field')
+        db.commit()
+        lo = hi
+        if time_limit and time.time() - started > time_limit \
+                and len(ids) == chunk_size:
+            return copied, False
+    return copied, True
+
+
+def _migrate_field_rows(db, table, source_field, target_field, transform,
+                        chunk_size, start_id, store, sig, started, time_limit):
+    """
+    Copy transform(source_field) to target_field one row at a time.
+
+    Returns a tuple of the number of rows updated and whether the whole
+    table was covered.
+    """
+    tbl = db[table]
+    copied = 0
+    for items in iter_table(db, table, [source_field], chunk_size,
+                            start_id=start_id):
         for i in items:
-            values = {target_field: i[source_field]}
-            i.update_record(**values)
+            values = {target_field: transform(i[source_field])}
+            db(tbl.id == i.id).update(**values)
+            copied += 1
+        if store:
+            store.save(sig, items.last().id, len(items), job='migrate_field')
+        db.commit()
+        if time_limit and time.time() - started > time_limit:
+            return copied, False
+    return copied, True
+
+
+@util_action(form=False)
+def migrate_table(checkpoint=None, restart=False, time_limit=None,
+                  chunk_size=100, batch_size=500, db=None):
+    """
+    Create lessons records from the slides of each plugin_slider deck.
+
+    Decks are read in chunks of 'chunk_size' (in id order). For each chunk the
+    slides, the tag memberships and the already existing lessons are fetched
+    with a few set queries and indexed by id, the new lessons rows are
+    computed in memory, and they are written with bulk_insert in batches of
+    'batch_size'. As with update_or_insert, a lesson identical to one already
+    in the table is not inserted again. There is one commit per chunk of
+    decks.
+
+    If a 'checkpoint' store is supplied (a CheckpointStore, or True to use the
+    default one) the last finished deck is recorded with each commit so that
+    an interrupted run (or one that reaches 'time_limit' seconds) can be
+    continued by calling again.
+    """
+    db = current.db if db is None else db
+    store = CheckpointStore(db) if checkpoint is True else checkpoint
+    sig = job_signature('migrate_table', source='plugin_slider_decks',
+                        target='lessons')
+    start_id, done = store.resume_point(sig, restart) if store else (0, False)
+    started = time.time()
+    c = 0
+    inserted = 0
+    complete = True
+    if done:
+        return dict(records_moved=c, records_inserted=inserted,
+                    complete=complete)
+
+    deck_tags = {}
+    for t in db(db.tags.slides != None).select(db.tags.id, db.tags.slides):
+        for deck_id in t.slides or []:
+            deck_tags.setdefault(deck_id, []).append(t.id)
+
+    for decks in iter_table(db, 'plugin_slider_decks',
+                            ['deck_slides', 'deck_name', 'deck_position'],
+                            batch_size=chunk_size, start_id=start_id):
+        slide_ids = set(chain.from_iterable(d.deck_slides or [] for d in decks))
+        slides = {s.id: s for s in
+                  db(db.plugin_slider_slides.id.belongs(slide_ids)).select(
+                      db.plugin_slider_slides.id,
+                      db.plugin_slider_slides.slide_content,
+                      db.plugin_slider_slides.pdf)}
+        existing = {_lesson_key(r) for r in
+                    db(db.lessons.title.belongs({d.deck_name for d in decks})
+                       ).select(db.lessons.title, db.lessons.video_url,
+                                db.lessons.pdf, db.lessons.lesson_tags,
+                                db.lessons.lesson_position)}
+
+        newrows = []
+        for i in decks:
+            mytags = deck_tags.get(i.id, [])
+            for sid in sorted(set(i.deck_slides or [])):
+                if sid not in slides:
+                    continue
+                s = slides[sid]
+                row = {'title': i.deck_name,
+                       'video_url': s.slide_content,
+                       'pdf': s.pdf,
+                       'lesson_tags': list(mytags),
+                       'lesson_position': i.deck_position}
+                key = _lesson_key(row)
+                if key not in existing:
+                    existing.add(key)
+                    newrows.append(row)
             c += 1
 
-    return {'records_copied': c}
+        for start in range(0, len(newrows), batch_size):
+            db.lessons.bulk_insert(newrows[start:start + batch_size])
+        inserted += len(newrows)
+        if store:
+            store.save(sig, decks.last().id, len(decks), job='migrate_table')
+        db.commit()
+        if time_limit and time.time() - started > time_limit:
+            complete = False
+            break
+    if complete and store:
+        store.save(sig, complete=True, job='migrate_table')
+        db.commit()
 
+    return dict(records_moved=c, records_inserted=inserted, complete=complete,
+                elapsed=time.time() - started)
 
-def migrate_table():
-    db = current.db
-    items = db(db.plugin_slider_decks.id > 0).select()
-    c = 0
-    for i in items:
-        slides = db(db.plugin_slider_slides.id.belongs(i.deck_slides)
-                         ).select()
-        mytags = db(db.tags.slides.contains(i.id)).select()
-        for s in slides:
-            print([t.id for t in mytags])
-            myid = db.lessons.update_or_insert(**{'title': i.deck_name,
-                                                  'video_url': s.slide_content,
-                                                  'pdf': s.pdf,
-                                                  'lesson_tags': [t.id for t in mytags],
-                                                  'lesson_position': i.deck_position})
-            pprint(db.lessons(myid))
-            db.commit()
-        c += 1
 
-    return dict(records_moved=c)
+def _lesson_key(row):
+    """
+    Return a hashable tuple of the lessons values written by migrate_table.
+    """
+    return (row['title'], row['video_url'], row['pdf'],
+            tuple(row['lesson_tags'] or []), row['lesson_position'])
 
 
 # def migrate_back():
@@ -501,96 +1393,514 @@ def migrate_table():
 #     return dict(records_updated=c)
 
 
-def import_from_csv():
-    db = current.db
+CSV_NULL_VALUES = frozenset(['NULL', '', 'None'])
+
+
+def _csv_timestamp(value):
+    """
+    Convert a unix timestamp string to a datetime.datetime object.
+    """
+    return datetime.datetime.fromtimestamp(int(value))
+
+
+def _csv_title_part(index, title):
+    """
+    Return one dot-separated segment of a numbered title like '3.2.1'.
+    """
+    titlebits = title.split('.') if title else [None, None, None]
+    return titlebits[index] if len(titlebits) > index else 0
+
+
+def _csv_join(values):
+    """
+    Join a list of column values with '|', returning None if it is empty.
+    """
+    return '|'.join(values) if values else None
+
+
+def _resolve_csv_mapping(header, mapping):
+    """
+    Match a column-mapping spec against a csv header row.
+
+    Returns a list of (target_field, column indexes, is_multi, converter,
+    default) tuples and a list of target fields whose columns are missing.
+    """
+    positions = {name: idx for idx, name in enumerate(header)}
+    resolved = []
+    missing = []
+    for target, spec in mapping.items():
+        spec = tuple(spec) if isinstance(spec, (tuple, list)) else (spec,)
+        source, converter, default = spec + (None, _NO_DEFAULT)[len(spec) - 1:]
+        if isinstance(source, str):
+            if source not in positions:
+                missing.append(target)
+                continue
+            resolved.append((target, [positions[source]], False, converter,
+                             default))
+        else:  # a compiled regex selecting any number of columns
+            idxs = [idx for idx, name in enumerate(header)
+                    if source.match(name)]
+            resolved.append((target, idxs, True, converter, default))
+    return resolved, missing
+
+
+def iter_csv_records(path, mapping, stats=None, encoding='utf8',
+                     null_values=CSV_NULL_VALUES):
+    """
+    Yield one dictionary of field values for each data row of a csv file.
+
+    The 'mapping' argument pairs target field names with a source spec, which
+    may be:
+
+        - a column name,
+        - a compiled regex, selecting every matching column (the value is then
+          a list of the non-null values found in those columns),
+        - a tuple of (source, converter) or (source, converter, default).
+
+    The converter is a function applied to the raw value. If it raises a
+    ValueError or TypeError the row's error count is incremented and the
+    default is used instead (called first if it is callable); without a
+    default the field is left out. Null values (see CSV_NULL_VALUES) are
+    always left out.
+
+    The mapping is resolved against the header once per file, and columns
+    missing from the file are skipped. If a 'stats' dictionary is supplied it
+    is updated with 'rows', 'errors' and 'missing_columns' counts.
+    """
+    stats = {} if stats is None else stats
+    stats.setdefault('rows', 0)
+    stats.setdefault('errors', 0)
+    import csv
+
+    with open(path, newline='', encoding=encoding) as csfile:
+        reader = csv.reader(csfile)
+        header = next(reader, None)
+        if header is None:
+            return
+        resolved, stats['missing_columns'] = _resolve_csv_mapping(header,
+                                                                  mapping)
+        for line in reader:
+            record = {}
+            try:
+                for target, idxs, is_multi, converter, default in resolved:
+                    if is_multi:
+                        val = [line[i] for i in idxs
+                               if line[i] not in null_values]
+                    else:
+                        val = line[idxs[0]]
+                    if converter:
+                        try:
+                            val = converter(val)
+                        except (TypeError, ValueError):
+                            stats['errors'] += 1
+                            if default is _NO_DEFAULT:
+                                continue
+                            val = default() if callable(default) else default
+                    if val is None or (isinstance(val, str)
+                                       and val in null_values):
+                        continue
+                    record[target] = val
+            except IndexError:  # short or malformed line
+                stats['errors'] += 1
+                continue
+            stats['rows'] += 1
+            yield record
+
+
+_csv_queue = None
+
+
+def _init_csv_worker(queue):
+    global _csv_queue
+    _csv_queue = queue
+
+
+def _parse_csv_to_queue(task):
+    """
+    Parse one csv file in a worker process, feeding batches to the queue.
+
+    A final ('done', path, stats) message is always sent, even if parsing
+    fails part way through. Its 'elapsed' time runs from the start of this
+    file until its last batch was accepted by the (bounded) queue.
+    """
+    path, mapping, encoding, batch_size, batch_bytes = task
+    stats = {}
+    file_started = time.time()
     try:
-        db.paragraphs.truncate()
-    except:
-        print(traceback.format_exc(5))
-    mydir = '/home/ian/Dropbox/Downloads/Webdev/woh_export'
-    files = ['node-export(43-nodes).1335558252.csv',
-             'node-export(50-nodes).1335557844.csv',
-             'node-export(50-nodes).1335557890.csv',
-             'node-export(50-nodes).1335557934.csv',
-             'node-export(50-nodes).1335558015.csv',
-             'node-export(50-nodes).1335558056.csv',
-             'node-export(50-nodes).1335558115.csv',
-             'node-export(50-nodes).1335558151.csv',
-             'node-export(50-nodes).1335558186.csv'
-             ]
+        for batch in _csv_batches(iter_csv_records(path, mapping, stats,
+                                                   encoding=encoding),
+                                  batch_size, batch_bytes):
+            _csv_queue.put(('rows', path, batch))
+    except Exception:
+        import traceback
+        stats['failed'] = traceback.format_exc(5)
+    stats['elapsed'] = time.time() - file_started
+    _csv_queue.put(('done', path, stats))
+
+
+def _csv_batches(records, batch_size, batch_bytes=None):
+    """
+    Group csv records into batches by count, or also by size if batch_bytes.
+    """
+    if batch_bytes:
+        return chunked_by_bytes(records, batch_bytes, max_items=batch_size)
+    return chunked(records, batch_size)
+
+
+def _iter_parsed_csv_batches(files, mapping, batch_size, encoding, processes,
+                             queue_size, batch_bytes=None, grace=5):
+    """
+    Yield ('rows', path, batch) and ('done', path, stats) messages for files.
+
+    The files are parsed by a pool of 'processes' worker processes (0 for one
+    per cpu) which feed a queue of at most 'queue_size' batches, so that
+    memory use stays flat however far the parsers get ahead of the consumer.
+
+    If a worker process dies (e.g. killed for running out of memory) the
+    pool is broken and its remaining tasks fail. Once every task has ended
+    and the queue stays empty, each file that was never reported done gets a
+    'done' message with the reason under 'failed' (after 'grace' seconds for
+    files whose task seemed to succeed, in case their last messages are
+    still in transit), so the import never waits forever.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    queue = multiprocessing.Queue(maxsize=queue_size)
+    started = time.time()
+    executor = ProcessPoolExecutor(processes or None,
+                                   initializer=_init_csv_worker,
+                                   initargs=(queue,))
+    futures = {executor.submit(_parse_csv_to_queue,
+                               (path, mapping, encoding, batch_size,
+                                batch_bytes)): path
+               for path in files}
+    reported = set()
+    idle = 0
+    try:
+        while len(reported) < len(futures):
+            try:
+                message = queue.get(timeout=1)
+            except Empty:
+                if not all(f.done() for f in futures):
+                    continue
+                idle += 1
+                for future, path in futures.items():
+                    if path in reported or \
+                            (future.exception() is None and idle < grace):
+                        continue
+                    reported.add(path)
+                    yield ('done', path, {
+                        'failed': 'worker process ended before finishing '
+                                  'the file: {!r}'.format(future.exception()),
+                        'elapsed': time.time() - started})
+                continue
+            idle = 0
+            if message[0] == 'done':
+                reported.add(message[1])
+            yield message
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        while not all(f.done() for f in futures):  # unblock running workers
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+        executor.shutdown()
+
+
+def import_csv(files, tablename, mapping, batch_size=500, truncate=False,
+               encoding='utf8', db=None, processes=None, queue_size=8,
+               batch_bytes=None):
+    """
+    Stream rows from one or more csv files into a db table.
+
+    Each file is read lazily through iter_csv_records (see there for the
+    format of 'mapping') and the records are written with bulk_insert in
+    batches of 'batch_size', with one commit per batch. If 'batch_bytes' is
+    given a batch is also cut off once its values reach about that many
+    bytes (see chunked_by_bytes), which keeps memory flat when some rows
+    hold very long texts. If 'truncate' is True the table is emptied first.
+
+    If 'processes' is given (an integer, or 0 for one per cpu) the files are
+    parsed and converted in parallel by a process pool, while all db writes
+    are still made by this process alone. At most 'queue_size' parsed batches
+    wait between the two stages. In that case the converters and defaults in
+    'mapping' must be picklable (module-level functions, partials, compiled
+    regexes), not lambdas.
+
+    A file that cannot be read or parsed does not stop the import: its
+    traceback is recorded under 'failed' in its stats (the batches already
+    committed from it are kept) and the next file is imported, in both
+    modes. If a worker process dies, the files it left unfinished (and any
+    not yet started, since the pool is then broken) are marked failed the
+    same way.
+
+    Returns a dictionary with per-file row and error counts and elapsed
+    times, the total number of rows imported, and the overall elapsed time
+    and rows per second.
+    """
+    db = current.db if db is None else db
+    table = db[tablename]
+    if truncate:
+        table.truncate()
+        db.commit()
+    started = time.time()
+    out = {'files': {}, 'rows': 0}
+
+    def report(path, stats):
+        out['rows'] += stats['rows']
+        if stats.get('failed'):
+            print(clr('import_csv: {} failed\n{}'.format(path,
+                                                         stats['failed']),
+                      'red'))
+        print(clr('import_csv: {} rows from {} ({} errors, {:.1f} rows/s)'
+                  ''.format(stats['rows'], os.path.basename(path),
+                            stats['errors'],
+                            stats['rows'] / (stats['elapsed'] or 1e-9)),
+                  'lightcyan'))
+
+    if processes is None:
+        for path in files:
+            file_started = time.time()
+            stats = out['files'][path] = {'rows': 0, 'errors': 0}
+            try:
+                for batch in _csv_batches(iter_csv_records(path, mapping,
+                                                           stats,
+                                                           encoding=encoding),
+                                          batch_size, batch_bytes):
+                    table.bulk_insert(batch)
+                    db.commit()
+            except Exception:
+                import traceback
+                db.rollback()
+                stats['failed'] = traceback.format_exc(5)
+            stats['elapsed'] = time.time() - file_started
+            report(path, stats)
+    else:
+        for kind, path, payload in _iter_parsed_csv_batches(files, mapping,
+                                                            batch_size,
+                                                            encoding,
+                                                            processes,
+                                                            queue_size,
+                                                            batch_bytes):
+            if kind == 'rows':
+                table.bulk_insert(payload)
+                db.commit()
+            else:
+                payload.setdefault('rows', 0)
+                payload.setdefault('errors', 0)
+                out['files'][path] = payload
+                report(path, payload)
+
+    out['elapsed'] = time.time() - started
+    out['rows_per_sec'] = out['rows'] / out['elapsed'] if out['elapsed'] \
+        else None
+    return out
+
+
+WOH_CSV_DIR = '/home/ian/Dropbox/Downloads/Webdev/woh_export'
+WOH_CSV_FILES = ['node-export(43-nodes).1335558252.csv',
+                 'node-export(50-nodes).1335557844.csv',
+                 'node-export(50-nodes).1335557890.csv',
+                 'node-export(50-nodes).1335557934.csv',
+                 'node-export(50-nodes).1335558015.csv',
+                 'node-export(50-nodes).1335558056.csv',
+                 'node-export(50-nodes).1335558115.csv',
+                 'node-export(50-nodes).1335558151.csv',
+                 'node-export(50-nodes).1335558186.csv'
+                 ]
+WOH_CSV_MAPPING = {
+    'uid': 'uid',
+    'chapter': ('title', partial(_csv_title_part, 0)),
+    'section': ('title', partial(_csv_title_part, 1)),
+    'subsection': ('title', partial(_csv_title_part, 2)),
+    'display_title': 'field_displaytitle[\'0\'][\'value\']',
+    'status': 'status',
+    'changed': ('changed', _csv_timestamp, datetime.datetime.utcnow),
+    'created': ('created', _csv_timestamp, datetime.datetime.utcnow),
+    'body': 'body',
+    'pullquote': 'field_pullquote[\'0\'][\'value\']',
+    'audio': 'field_audiolink[\'0\'][\'value\']',
+    'image_id': 'field_images[\'0\'][\'fid\']',
+    'image_alt': 'field_images[\'0\'][\'data\'][\'alt\']',
+    'image_title': 'field_images[\'0\'][\'data\'][\'title\']',
+    'image_filename': 'field_images[\'0\'][\'filename\']',
+    'topics': (re.compile(r'.*taxonomy.*'), _csv_join),
+}
+
+
+@util_action(form=False)
+def import_from_csv(files=None, mydir=WOH_CSV_DIR, tablename='paragraphs',
+                    mapping=None, truncate=True, batch_size=500,
+                    processes=None):
+    """
+    Import the woh node export csv files into the paragraphs table.
+
+    This is a preset for import_csv, using WOH_CSV_FILES (in 'mydir') and
+    WOH_CSV_MAPPING unless other files or another mapping are supplied.
+    """
+    files = WOH_CSV_FILES if files is None else files
     #'node-export[](1-nodes).1335557290.export',
     fullfiles = [os.path.join(mydir, f) for f in files]
+    return import_csv(fullfiles, tablename,
+                      WOH_CSV_MAPPING if mapping is None else mapping,
+                      batch_size=batch_size, truncate=truncate,
+                      processes=processes)
+
+
+class _RowTransformer(object):
+    '''
+    Turn tuples of source values into target row dictionaries.
+
+    The filter and transform functions may be given as callables or as
+    strings of python source (e.g. "lambda x: x.lower()"), which are
+    evaluated here. Strings make the transformer safe to send to worker
+    processes, since they are evaluated again on the other side.
+
+    '''
+    def __init__(self, target_fields, filter_funcs=None, trans_funcs=None):
+        self.target_fields = list(target_fields)
+        self.specs = (list(filter_funcs or []), list(trans_funcs or []))
+        self.filter_funcs = [self._load(f) for f in self.specs[0]]
+        self.trans_funcs = [self._load(f) for f in self.specs[1]]
+
+    @staticmethod
+    def _load(func):
+        if isinstance(func, str):
+            return eval(func) if func.strip() else None
+        return func
+
+    def __getstate__(self):
+        return {'target_fields': self.target_fields, 'specs': self.specs}
+
+    def __setstate__(self, state):
+        self.__init__(state['target_fields'], *state['specs'])
+
+    def __call__(self, chunk):
+        out = []
+        filters, transforms = self.filter_funcs, self.trans_funcs
+        for vals in chunk:
+            trow = {}
+            for idx, val in enumerate(vals):
+                tval = transforms[idx](val) \
+                    if len(transforms) > idx and transforms[idx] else val
+                if len(filters) > idx and filters[idx]:
+                    if not filters[idx](tval):
+                        tval = None
+                if tval:
+                    trow[self.target_fields[idx]] = tval
+            if trow:
+                out.append(trow)
+        return out
 
-    for ff in fullfiles:
-        with open(ff, 'rU') as csfile:
-            rows = csv.DictReader(csfile)
-            for row in rows:
-                #pprint(row)
-                titlebits = row['title'].split('.') if row['title'] else [None, None, None]
-                taxes = [v for k, v in row.iteritems()
-                         if re.match(r'.*taxonomy.*', k)
-                         and v not in ['NULL', '', 0, 'None', None]]
-                topics = '|'.join(taxes) if taxes else None
-                pullquote = row['field_pullquote[\'0\'][\'value\']'] \
-                    if 'field_pullquote[\'0\'][\'value\']' in row.values() \
-                    else None
-                audio = row['field_audiolink[\'0\'][\'value\']'] \
-                    if 'field_audiolink[\'0\'][\'value\']' in row.values() \
-                    else None
-                image_id = row['field_images[\'0\'][\'fid\']'] \
-                    if 'field_images[\'0\'][\'fid\']' in row.values() \
-                    else None
-                image_alt = row['field_images[\'0\'][\'data\'][\'alt\']'] \
-                    if 'field_images[\'0\'][\'data\'][\'alt\']' \
-                    in row.values() else None
-                image_title = row['field_images[\'0\'][\'data\'][\'title\']'] \
-                    if 'field_images[\'0\'][\'data\'][\'title\']' \
-                    in row.values() else None
-                image_filename = row['field_images[\'0\'][\'filename\']'] \
-                    if 'field_images[\'0\'][\'filename\']' in row.values() \
-                    else None
-                times = {}
-                for k in ['changed', 'created']:
-                    errors = 0
-                    try:
-                        times[k] = datetime.datetime.fromtimestamp(int(row[k]))
-                    except (TypeError, ValueError):
-                        times[k] = datetime.datetime.utcnow()
-                        errors += 1
-                    print('{} errors: {}'.format(k, errors))
-
-                matches = {'uid': row['uid'],
-                           'chapter': titlebits[0],
-                           'section': titlebits[1] if len(titlebits) > 1 else 0,
-                           'subsection': titlebits[2] if len(titlebits) > 1 else 0,
-                           'display_title': row['field_displaytitle[\'0\'][\'value\']'],
-                           'status': row['status'],
-                           'changed': times['changed'],
-                           'created': times['created'],
-                           'body': row['body'],
-                           'pullquote': pullquote,
-                           'audio': audio,
-                           'image_id': image_id,
-                           'image_alt': image_alt,
-                           'image_title': image_title,
-                           'image_filename': image_filename,
-                           'topics': topics}
-                matches = {k: v for k, v in matches.iteritems()
-                           if v not in [None, 'NULL']}
-                num = db.paragraphs.insert(**matches)
-                print(num)
+
+class _BoundedSet(object):
+    '''
+    A set remembering at most 'maxsize' of the most recently added items.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def add(self, item):
+        """
+        Add item and return True if it was not already present.
+        """
+        if item in self.items:
+            self.items.move_to_end(item)
+            return False
+        self.items[item] = None
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+        return True
 
 
+def rows_from_field(source_table, target_table, source_fields, target_fields,
+                    filter_funcs=None, trans_funcs=None, unique=True,
+                    testing=True, chunk_size=1000, workers=None,
+                    processes=False, dedup_size=100000, batch_size=500,
+                    sample_size=100, db=None):
+    """
+    Create rows in target_table from the values of fields in source_table.
+
+    The source rows are read in chunks of 'chunk_size' rows (selecting only
+    the source fields) and each chunk is turned into target rows by applying
+    the filter and transform functions, which are aligned by index with the
+    source and target fields (see _RowTransformer). If 'workers' is given the
+    chunks are transformed in a pool of that many threads, or processes if
+    'processes' is True; only a few chunks are in flight at a time.
+
+    If 'unique' is True duplicate target rows are dropped, remembering the
+    last 'dedup_size' distinct rows (so duplicates further apart than that
+    may slip through on very large tables). Unless 'testing' is True, the
+    rows are written with bulk_insert in batches of 'batch_size', with one
+    commit per batch.
+
+    Returns a dictionary with the counts of source rows read and target rows
+    created, the elapsed time, and a sample of up to 'sample_size' rows.
+    """
+    db = current.db if db is None else db
+    started = time.time()
+    transformer = _RowTransformer(target_fields, filter_funcs, trans_funcs)
+    seen = _BoundedSet(dedup_size) if unique else None
+    out = {'rows_read': 0, 'rows_created': 0, 'sample': []}
+
+    def source_chunks():
+        for rows in iter_table(db, source_table, source_fields,
+                               chunk_size):
+            out['rows_read'] += len(rows)
+            yield [tuple(r[f] for f in source_fields) for r in rows]
+
+    def target_rows(executor):
+        for trows in _bounded_map(transformer, source_chunks(), executor,
+                                  inflight=(workers or 1) * 2):
+            for trow in trows:
+                if seen is not None:
+                    key = tuple(sorted((k, v if isinstance(v, Hashable)
+                                        else repr(v))
+                                       for k, v in trow.items()))
+                    if not seen.add(key):
+                        continue
+                yield trow
+
+    if workers:
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        executor = pool(max_workers=workers)
+    else:
+        executor = None
+    try:
+        for batch in chunked(target_rows(executor), batch_size):
+            if not testing:
+                db[target_table].bulk_insert(batch)
+                db.commit()
+            out['rows_created'] += len(batch)
+            room = sample_size - len(out['sample'])
+            if room > 0:
+                out['sample'].extend(batch[:room])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    out['elapsed'] = time.time() - started
+    return out
+
+
+@util_action
 def make_rows_from_field():
     """
     Use values from one table to create new records in another.
 
-    The strings provided for
+    The strings provided for filter_funcs and trans_funcs should be python
+    expressions evaluating to functions (e.g., "lambda x: x.lower()").
 
     The values for source_fields, target_fields, filter_funcs, and
     transform_funcs will be aligned by index.
+
+    The work is done by rows_from_field, which streams the source table in
+    chunks and can run the transforms in a thread or process pool.
     """
-    db = current.db
     out = []
     form = SQLFORM.factory(Field('target_table'),
                            Field('source_table'),
@@ -598,29 +1908,22 @@ def make_rows_from_field():
                            Field('target_fields', 'list:string'),
                            Field('filter_funcs', 'list:string'),
                            Field('trans_funcs', 'list:string'),
+                           Field('chunk_size', 'integer', default=1000),
+                           Field('workers', 'integer', default=0),
+                           Field('processes', 'boolean', default=False),
                            Field('unique', 'boolean', default=True),
                            Field('testing', 'boolean', default=True))
 
     if form.process().accepted:
         vv = form.vars
-        sourcerows = db(db[vv.target_table].id > 0).select()
-        out = []
-        for srow in sourcerows:
-            trow = []
-            for idx, f in enumerate(vv.source_fields):
-                tval = vv.trans_funcs[idx](srow[f]) \
-                    if len(vv.trans_funcs) > idx else srow[f]
-                if len(vv.filter_funcs) > idx:
-                    if not vv.filter_funcs[idx](tval):
-                        tval = None
-                if tval:
-                    trow[vv.target_fields[idx]] = tval
-            out.append(trow)
-
-        if vv.unique:
-            out = list(set(out))
-        if not vv.testing:
-            db[vv.target_table].bulk_insert(out)
+        out = rows_from_field(vv.source_table, vv.target_table,
+                              vv.source_fields, vv.target_fields,
+                              filter_funcs=vv.filter_funcs,
+                              trans_funcs=vv.trans_funcs,
+                              unique=vv.unique, testing=vv.testing,
+                              chunk_size=vv.chunk_size or 1000,
+                              workers=vv.workers or None,
+                              processes=vv.processes)
 
     elif form.errors:
         out = BEAUTIFY(form.errors)
@@ -628,43 +1931,164 @@ def make_rows_from_field():
     return form, out
 
 
+def iter_files(folder, recursive=True, pattern=None, regex=None):
+    """
+    Lazily yield an os.DirEntry for each file in a folder.
+
+    The folder is read with os.scandir, walking subfolders (if 'recursive')
+    with an explicit stack, and symlinked folders are not followed. Files can
+    be limited to names matching a glob 'pattern' (e.g. '*.mp3') and/or a
+    'regex' (a string or compiled regex, tested with search). The DirEntry
+    objects carry their file type and, once stat() has been called, their
+    stat result, so no further system calls are needed to read them.
+    """
+    regex = re.compile(regex) if isinstance(regex, str) else regex
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+                if pattern and not fnmatch(entry.name, pattern):
+                    continue
+                if regex and not regex.search(entry.name):
+                    continue
+                yield entry
+
+
+FILE_STAT_VALUES = {
+    'size': lambda st: st.st_size,
+    'mtime': lambda st: datetime.datetime.fromtimestamp(st.st_mtime),
+    'ctime': lambda st: datetime.datetime.fromtimestamp(st.st_ctime),
+}
+
+
+def rows_from_filenames(folder, tablename, fieldname, recursive=True,
+                        pattern=None, regex=None, filter_func=None,
+                        extra_fields=None, stat_fields=None,
+                        relative_paths=None, incremental=False, unique=True,
+                        testing=True, batch_size=500, sample_size=100,
+                        db=None):
+    """
+    Create one row in tablename for each file found in folder.
+
+    The file's path relative to folder (or, if 'relative_paths' is False,
+    just its name) is stored in 'fieldname'. By default relative paths are
+    used when walking subfolders, so that files with the same name in
+    different subfolders are kept apart. Files are found by iter_files (see
+    there for 'recursive', 'pattern' and 'regex') and can be further limited
+    by a 'filter_func' taking the stored name. The 'extra_fields' dictionary
+    pairs other field names with functions computing their value from the
+    stored name, and 'stat_fields' pairs field names with one of the keys of
+    FILE_STAT_VALUES (e.g. {'filesize': 'size', 'modified': 'mtime'}).
+
+    If 'incremental' is True the names already in the field are loaded with
+    a single query and those files are skipped, so only new files are added.
+    If 'unique' is True a name found a second time in this run is skipped
+    too. Unless 'testing' is True the rows are written with bulk_insert in
+    batches of 'batch_size', with one commit per batch.
+
+    Returns a dictionary with the counts of files found, skipped (filtered
+    out or already in the table), duplicate (skipped as repeated names) and
+    added, the elapsed time, and a sample of up to 'sample_size' rows.
+    """
+    db = current.db if db is None else db
+    table = db[tablename]
+    started = time.time()
+    relative_paths = recursive if relative_paths is None else relative_paths
+    known, seen = set(), set()
+    if incremental:
+        field = table[fieldname]
+        known = {r[fieldname] for r in
+                 db(field != None).iterselect(field, distinct=True)}
+    out = {'files_found': 0, 'files_skipped': 0, 'files_duplicate': 0,
+           'rows_created': 0, 'sample': []}
+
+    def file_rows():
+        for entry in iter_files(folder, recursive, pattern, regex):
+            out['files_found'] += 1
+            name = os.path.relpath(entry.path, folder) if relative_paths \
+                else entry.name
+            if name in known or (filter_func and not filter_func(name)):
+                out['files_skipped'] += 1
+                continue
+            if name in seen:
+                out['files_duplicate'] += 1
+                continue
+            if unique or incremental:
+                seen.add(name)
+            kwargs = {fieldname: name}
+            for xfield, xfunc in (extra_fields or {}).items():
+                kwargs[xfield] = xfunc(name)
+            if stat_fields:
+                mystat = entry.stat()
+                for sfield, key in stat_fields.items():
+                    kwargs[sfield] = FILE_STAT_VALUES[key](mystat)
+            yield kwargs
+
+    for batch in chunked(file_rows(), batch_size):
+        if not testing:
+            table.bulk_insert(batch)
+            db.commit()
+        out['rows_created'] += len(batch)
+        room = sample_size - len(out['sample'])
+        if room > 0:
+            out['sample'].extend(batch[:room])
+
+    out['elapsed'] = time.time() - started
+    return out
+
+
+@util_action
 def make_rows_from_filenames():
     """
-    TODO: unfinished
+    Create a row in the target table for each file in a folder.
+
+    The 'extra_fields' should each be a field name and a python expression
+    evaluating to a function (of the file name), separated by a comma. The
+    work is done by rows_from_filenames.
     """
-    db = current.db
     out = []
     form = SQLFORM.factory(Field('folder_path'),
                            Field('target_field'),
                            Field('target_table'),
                            Field('filter_func'),
+                           Field('pattern'),
                            Field('extra_fields', 'list:string'),
+                           Field('size_field'),
+                           Field('mtime_field'),
+                           Field('recursive', 'boolean', default=False),
+                           Field('relative_paths', 'boolean', default=True),
+                           Field('incremental', 'boolean', default=False),
                            Field('unique', 'boolean', default=True),
                            Field('testing', 'boolean', default=True))
 
     if form.process().accepted:
         vv = form.vars
-        mypath = vv.folder_path
-        fullpath = os.path.join()
-        dirpath, dirnames, filenames = os.walk(mypath).next()
-        xfield, xfunc = tuple([(x[0].strip(), x[1].strip()) for x in vv.extra_fields.split(',')])
-        if xfunc:
-            xfunc = eval(xfunc)
-        filter_func = eval(vv.filter_func)
+        extra_fields = {}
+        for x in vv.extra_fields or []:
+            xfield, xfunc = [i.strip() for i in x.split(',', 1)]
+            extra_fields[xfield] = eval(xfunc)
+        stat_fields = {}
+        if vv.size_field:
+            stat_fields[vv.size_field] = 'size'
+        if vv.mtime_field:
+            stat_fields[vv.mtime_field] = 'mtime'
+        filter_func = eval(vv.filter_func) if vv.filter_func else None
 
-        out = []
-        for f in filenames:
-            kwargs = {}
-            kwargs[vv.target_field] = f
-            if xfunc:
-                kwargs[xfield] = xfunc(f)
-            if filter_func and not filter_func(f):
-                kwargs = None
-            if kwargs:
-                out.append(kwargs)
-
-        if not vv.testing:
-            db[vv.target_table].bulk_insert(out)
+        out = rows_from_filenames(vv.folder_path, vv.target_table,
+                                  vv.target_field, recursive=vv.recursive,
+                                  pattern=vv.pattern or None,
+                                  filter_func=filter_func,
+                                  extra_fields=extra_fields,
+                                  stat_fields=stat_fields,
+                                  relative_paths=vv.relative_paths,
+                                  incremental=vv.incremental,
+                                  unique=vv.unique, testing=vv.testing)
 
     elif form.errors:
         out = BEAUTIFY(form.errors)
@@ -672,17 +2096,302 @@ def make_rows_from_filenames():
     return form, out
 
 
+def iter_table(db, table, fields=None, batch_size=1000, query=None,
+               start_id=0):
+    """
+    Yield successive Rows objects covering a table in ascending id order.
+
+    Each batch is fetched with its own small query (keyset pagination on the
+    id field, so gaps in the ids do not matter and there is no growing
+    OFFSET), so only one batch is ever held in memory and a table of any size
+    can be processed in constant memory. The 'table' may be a Table or a
+    table name, and 'fields' is a list of field names to select (the id
+    field is always included). The optional 'query' further restricts the
+    rows selected, and 'start_id' skips the rows up to and including that id.
+
+    The next batch is only fetched when asked for, so the rows of one batch
+    may be updated or deleted before the next is read.
+    """
+    table = db[table] if isinstance(table, str) else table
+    fields = [table[f] for f in (fields or []) if f != 'id']
+    last_id = start_id or 0
+    while True:
+        myquery = table.id > last_id
+        if query is not None:
+            myquery &= query
+        rows = db(myquery).select(table.id, *fields, orderby=table.id,
+                                  limitby=(0, batch_size))
+        if not rows:
+            break
+        yield rows
+        last_id = rows.last().id
+        if len(rows) < batch_size:
+            break
+
+
+CHECKPOINT_TABLE = 'plugin_utils_checkpoints'
+
+
+def _code_bytes(code):
+    """
+    Return the bytecode, names and constants of a code object as bytes.
+
+    Line numbers and file names are left out, so the same function source
+    gives the same bytes wherever it is defined.
+    """
+    consts = [_code_bytes(c) if hasattr(c, 'co_code') else repr(c)
+              for c in code.co_consts]
+    return code.co_code + repr([code.co_names, code.co_varnames,
+                                consts]).encode('utf8')
+
+
+def _signature_value(obj):
+    """
+    Return a json-serializable stand-in for obj in a job signature.
+
+    Callables are identified by their module and qualified name plus a hash
+    of their compiled code, default arguments and closure values (by repr),
+    so that two different lambdas (which share the name '<lambda>') never
+    produce the same signature. Other objects are represented by str().
+    """
+    if not callable(obj):
+        return str(obj)
+    if isinstance(obj, partial):
+        return [_signature_value(obj.func), [str(a) for a in obj.args],
+                {k: str(v) for k, v in obj.keywords.items()}]
+    code = getattr(obj, '__code__', None)
+    ident = [getattr(obj, '__module__', None),
+             getattr(obj, '__qualname__', type(obj).__qualname__)]
+    if code is not None:
+        cells = [c.cell_contents for c in obj.__closure__ or ()]
+        mybytes = _code_bytes(code) + repr(
+            [obj.__defaults__, obj.__kwdefaults__, cells]).encode('utf8')
+        ident.append(hashlib.sha1(mybytes).hexdigest())
+    elif not hasattr(obj, '__qualname__'):
+        ident.append(repr(obj))
+    return ident
+
+
+def job_signature(job, **params):
+    """
+    Return a short, stable string identifying one job and its parameters.
+
+    The parameters are serialized as json (with sorted keys) so the same job
+    run with the same arguments always produces the same signature. Any
+    callables among them are identified by their code (see
+    _signature_value), so a job run with a different function gets a
+    different signature.
+    """
+    mystring = json.dumps([job, params], sort_keys=True,
+                          default=_signature_value)
+    return hashlib.sha1(mystring.encode('utf8')).hexdigest()
+
+
+class CheckpointStore(object):
+    '''
+    Record the progress of long-running, chunked jobs in a small db table.
+
+    Each job is identified by a signature (see job_signature) and the store
+    keeps the last id processed, a running count of processed rows, and
+    whether the job has completed. The save() method does not commit. Callers
+    save the checkpoint just before committing each chunk so that the recorded
+    progress is written in the same transaction as the work itself, and a
+    job that is interrupted can always resume without repeating or skipping
+    rows.
+
+    '''
+    def __init__(self, db=None, tablename=CHECKPOINT_TABLE):
+        """
+        Initialize a CheckpointStore object, defining its table if necessary.
+        """
+        self.db = current.db if db is None else db
+        if tablename not in self.db.tables:
+            self.db.define_table(tablename,
+                                 Field('signature', length=64),
+                                 Field('job'),
+                                 Field('last_id', 'integer', default=0),
+                                 Field('processed', 'integer', default=0),
+                                 Field('complete', 'boolean', default=False),
+                                 Field('modified_on', 'datetime'))
+        self.table = self.db[tablename]
+
+    def load(self, signature):
+        """
+        Return the stored checkpoint row for a job signature, or None.
+        """
+        return self.db(self.table.signature == signature).select().first()
+
+    def resume_point(self, signature, restart=False):
+        """
+        Return a tuple of the last id processed and whether the job is done.
+
+        If 'restart' is True any stored checkpoint is discarded first.
+        """
+        if restart:
+            self.clear(signature)
+            return 0, False
+        row = self.load(signature)
+        if not row:
+            return 0, False
+        return row.last_id or 0, bool(row.complete)
+
+    def save(self, signature, last_id=None, processed=0, complete=False,
+             job=None):
+        """
+        Record progress for a job (without committing).
+
+        The 'processed' value is added to the running total already stored.
+        """
+        row = self.load(signature)
+        values = {'complete': complete,
+                  'modified_on': datetime.datetime.utcnow()}
+        if last_id is not None:
+            values['last_id'] = last_id
+        if job:
+            values['job'] = job
+        if row:
+            values['processed'] = (row.processed or 0) + processed
+            row.update_record(**values)
+        else:
+            values['processed'] = processed
+            self.table.insert(signature=signature, **values)
+
+    def clear(self, signature):
+        """
+        Remove any stored checkpoint for a job signature.
+        """
+        self.db(self.table.signature == signature).delete()
+
+
+DIFF_SAMPLE_SIZE = 100
+
+
+def replace_field_values(tablename, fieldname, key_values, chunk_size=1000,
+                         testing=True, diff_path=None, filter_func=None,
+                         db=None, checkpoint=None, restart=False,
+                         time_limit=None):
+    """
+    Apply multiple_replace to every value of one db field, chunk by chunk.
+
+    The table is read in chunks of 'chunk_size' rows (selecting only the id and
+    the target field) and only rows whose value actually changes are written.
+    Unless 'testing' is True, the writes for each chunk are committed together
+    as one transaction.
+
+    If 'diff_path' is given, every change is appended to that file as a line
+    of json ({"id": ..., "before": ..., "after": ...}); otherwise only the
+    first DIFF_SAMPLE_SIZE changes are kept and returned as 'pairs'.
+
+    If a 'checkpoint' store is supplied (a CheckpointStore, or True to use the
+    default one) and 'testing' is False, the last id processed is saved with
+    each chunk's commit. A run that is interrupted, or that stops after
+    'time_limit' seconds, then continues from that point when called again
+    with the same arguments, so rows are never replaced twice. Pass
+    restart=True to start again from the beginning.
+
+    Progress is printed after every chunk. Returns a dictionary of counts and
+    timings.
+    """
+    db = current.db if db is None else db
+    table = db[tablename]
+    replacer = get_replacer(key_values)
+    store = CheckpointStore(db) if checkpoint is True else checkpoint
+    store = None if testing else store
+    sig = job_signature('replace_in_field', table=tablename, field=fieldname,
+                        pairs=sorted(replacer.pairs.items()),
+                        filter_func=filter_func)
+    start_id, done = store.resume_point(sig, restart) if store else (0, False)
+    started = time.time()
+    scanned = 0
+    changed = 0
+    complete = True
+    pairs = {}
+    difffile = open(diff_path, 'a', encoding='utf8') \
+        if diff_path and not done else None
+    chunks = iter_table(db, tablename, [fieldname], chunk_size,
+                        start_id=start_id) if not done else []
+    try:
+        for rows in chunks:
+            for row in rows:
+                startval = row[fieldname]
+                if filter_func and not filter_func(startval):
+                    continue
+                endval = replacer(startval)
+                if endval == startval:
+                    continue
+                if not testing:
+                    db(table.id == row.id).update(**{fieldname: endval})
+                if difffile:
+                    difffile.write(json.dumps({'id': row.id,
+                                               'before': startval,
+                                               'after': endval},
+                                              ensure_ascii=False) + '\n')
+                elif len(pairs) < DIFF_SAMPLE_SIZE:
+                    pairs[startval] = endval
+                changed += 1
+            if store:
+                store.save(sig, rows.last().id, len(rows),
+                           job='replace_in_field')
+            if not testing:
+                db.commit()
+            if difffile:
+                difffile.flush()
+            scanned += len(rows)
+            elapsed = time.time() - started
+            print(clr('replace_in_field: {} rows scanned, {} changed '
+                      '({:.1f} rows/s)'.format(scanned, changed,
+                                               scanned / (elapsed or 1e-9)),
+                      'lightcyan'))
+            if time_limit and elapsed > time_limit:
+                complete = False
+                break
+    finally:
+        if difffile:
+            difffile.close()
+    if store and complete and not done:
+        store.save(sig, complete=True, job='replace_in_field')
+        db.commit()
+
+    elapsed = time.time() - started
+    out = {'records_scanned': scanned,
+           'records_updated': changed if not testing else 0,
+           'records_changed': changed,
+           'elapsed': elapsed,
+           'rows_per_sec': scanned / elapsed if elapsed else None,
+           'complete': complete}
+    if store:
+        out['resumed_from_id'] = start_id
+    if diff_path:
+        out['diff_file'] = diff_path
+    else:
+        out['pairs'] = pairs
+    return out
+
+
+@util_action
 def replace_in_field():
     """
     Make a systematic set of string replacements for all values of one
     db field.
+
+    The work is done by replace_field_values, which streams through the table
+    in chunks of 'chunk_size' rows and commits once per chunk. If a
+    'diff_path' is supplied the before/after value of every changed row is
+    written to that file instead of being displayed. If 'resumable' is
+    checked, progress is checkpointed so that a long job can be completed
+    over several submissions, each limited to 'time_limit' seconds.
     """
 
-    db = current.db
+    out = None
     form = SQLFORM.factory(Field('target_field'),
                            Field('target_table'),
                            Field('filter_func'),
                            Field('replacement_pairs', 'list:string'),
+                           Field('chunk_size', 'integer', default=1000),
+                           Field('diff_path'),
+                           Field('resumable', 'boolean', default=False),
+                           Field('restart', 'boolean', default=False),
+                           Field('time_limit', 'integer'),
                            Field('testing', 'boolean', default=True))
 
     if form.process().accepted:
@@ -693,20 +2402,16 @@ def replace_in_field():
             pieces = r.split(',')
             myset = (pieces[0].strip(), pieces[1].strip())
             myreps.append(myset)
+        filter_func = eval(vv.filter_func) if vv.filter_func else None
 
-        myrows = db(db[vv.target_table].id > 0).select()
-        count = 0
-        pairs = {}
-        for m in myrows:
-            startval = m[vv.target_field]
-            endval = multiple_replace(startval, myreps)
-            if not vv.testing:
-                m.update_record(**{vv.target_field: endval})
-            pairs[startval] = endval
-            count += 1
-
-        out = {'records_updated': count,
-               'pairs': pairs}
+        out = replace_field_values(vv.target_table, vv.target_field, myreps,
+                                   chunk_size=vv.chunk_size or 1000,
+                                   testing=vv.testing,
+                                   diff_path=vv.diff_path or None,
+                                   filter_func=filter_func,
+                                   checkpoint=bool(vv.resumable),
+                                   restart=vv.restart,
+                                   time_limit=vv.time_limit)
 
     elif form.errors:
         out = BEAUTIFY(form.errors)
@@ -714,56 +2419,221 @@ def replace_in_field():
     return form, out
 
 
-def print_sizes(object_dict, mylimit=10):
-    def sizeof_fmt(num, suffix='B'):
-        ''' by Fred Cirera,  https://stackoverflow.com/a/1094933/1870254, modified'''
-        for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-            if abs(num) < 1024.0:
-                return "%3.1f %s%s" % (num, unit, suffix)
-            num /= 1024.0
-        return "%.1f %s%s" % (num, 'Yi', suffix)
-
-    for name, size in sorted(((name, deep_getsizeof(value))
-            for name, value in object_dict.items()),
-            key= lambda x: -x[1])[:mylimit]:
-        print("{:>30}: {:>8}".format(name, sizeof_fmt(size)))
-
-
-
-def deep_getsizeof(obj, seen=None):
-    """
-    Find the memory footprint of a Python object
-
-    This is a recursive function that drills down a Python object graph
-    like a dictionary holding nested dictionaries with lists of lists
-    and tuples and sets.
-
-    The sys.getsizeof function does a shallow size of only. It counts each
-    object inside a container as pointer only regardless of how big it
-    really is.
-
-    :param o: the object
-    :param ids:
-    :return:
-    """
-    size = sys.getsizeof(obj)
-    if seen is None:
-        seen = set()
-    obj_id = id(obj)
-    if obj_id in seen:
-        return 0
-    # Important mark as seen *before* entering recursion to gracefully handle
-    # self-referential objects
-    seen.add(obj_id)
-    if isinstance(obj, dict):
-        size += sum([deep_getsizeof(v, seen) for v in obj.values()])
-        size += sum([deep_getsizeof(k, seen) for k in obj.keys()])
-    elif hasattr(obj, '__dict__'):
-        size += deep_getsizeof(obj.__dict__, seen)
-    elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
-        size += sum([deep_getsizeof(i, seen) for i in obj])
-    return size
-
-def grouper(iterable, n, fillvalue=None):
-    args = [iter(iterable)] * n
-    return zip_longest(*args, fillvalue=fillvalue)
\ No newline at end of file
+class Lazy(object):
+    '''
+    Mark a value in a MemoryMonitor namespace as computed at snapshot time.
+
+    Wraps a function taking no arguments, which the snapshot calls to get the
+    object to measure (e.g. Lazy(lambda: current.session) for an object that
+    changes between requests). No other callables are ever called.
+
+    '''
+    def __init__(self, func):
+        self.func = func
+
+
+class MemoryMonitor(object):
+    '''
+    Take periodic snapshots of the memory held by chosen namespaces.
+
+    Each snapshot measures a dictionary of named objects with estimate_sizeof
+    and is kept in a bounded history, so that consecutive snapshots can be
+    compared to find which objects are growing. Optionally the top
+    tracemalloc allocation sites (by growth since the previous snapshot) are
+    recorded as well. A MemoryMonitor kept at module level lives as long as
+    the web2py worker process, which makes it suitable for catching slow
+    leaks in long-lived workers.
+
+    '''
+    def __init__(self, history=20, max_depth=None, max_objects=200000,
+                 sample=100):
+        """
+        Initialize a MemoryMonitor object.
+
+        The 'max_depth', 'max_objects' and 'sample' arguments are passed on to
+        estimate_sizeof for each measured object.
+        """
+        self.history = deque(maxlen=history)
+        self.sizeof_args = {'max_depth': max_depth,
+                            'max_objects': max_objects,
+                            'sample': sample}
+        self._trace_snapshot = None
+        self._tracing = False
+
+    def snapshot(self, namespaces, top_allocations=0):
+        """
+        Measure each object in namespaces and store the result in the history.
+
+        The 'namespaces' argument is a dictionary pairing names with the
+        objects to be measured. A value may also be a Lazy wrapper around a
+        function taking no arguments, which is called at snapshot time
+        (useful for objects like current.session that change between
+        requests). Any other value, callable or not, is measured as it is.
+
+        If 'top_allocations' is greater than zero, tracemalloc is started (if
+        it was not already tracing) and that many of the allocation sites
+        which grew most since the last snapshot are included. The first such
+        snapshot has no allocations to compare with. Tracing slows down every
+        allocation, so it stays on only until stop_tracing is called.
+        """
+        sizes = {}
+        errors = {}
+        for name, obj in namespaces.items():
+            obj = obj.func() if isinstance(obj, Lazy) else obj
+            est = estimate_sizeof(obj, **self.sizeof_args)
+            sizes[name] = est.size
+            if est.error:
+                errors[name] = est.error
+        snap = {'time': datetime.datetime.now(),
+                'sizes': sizes,
+                'errors': errors,
+                'total': sum(sizes.values())}
+        if top_allocations:
+            snap['allocations'] = self._top_allocations(top_allocations)
+        self.history.append(snap)
+        return snap
+
+    def _top_allocations(self, limit):
+        """
+        Return the allocation sites that grew most since the last call.
+        """
+        import tracemalloc
+
+        if not self._tracing:
+            _start_tracing()
+            self._tracing = True
+        newsnap = tracemalloc.take_snapshot()
+        oldsnap, self._trace_snapshot = self._trace_snapshot, newsnap
+        if oldsnap is None:
+            return []
+        stats = newsnap.compare_to(oldsnap, 'lineno')[:limit]
+        return [{'location': str(stat.traceback),
+                 'size': stat.size,
+                 'size_diff': stat.size_diff,
+                 'count_diff': stat.count_diff} for stat in stats]
+
+    def stop_tracing(self):
+        """
+        Stop the allocation tracing started by snapshot, if it is running.
+
+        Tracing is shared with run_instrumented (see _start_tracing), so it
+        only really stops once no instrumented call is using it either, and
+        it is never stopped if it was started elsewhere. The next snapshot
+        with 'top_allocations' starts afresh, with nothing to compare.
+        """
+        if self._tracing:
+            _stop_tracing()
+            self._tracing = False
+        self._trace_snapshot = None
+
+    def diff(self, older=None, newer=None):
+        """
+        Return a list of (name, before, after, growth) tuples, largest first.
+
+        By default the two most recent snapshots are compared. Names missing
+        from one of the snapshots are treated as having size 0 there.
+        """
+        if newer is None:
+            newer = self.history[-1] if self.history else None
+        if older is None:
+            older = self.history[-2] if len(self.history) > 1 else None
+        if not newer:
+            return []
+        before = older['sizes'] if older else {}
+        after = newer['sizes']
+        rows = [(name, before.get(name, 0), after.get(name, 0),
+                 after.get(name, 0) - before.get(name, 0))
+                for name in set(before) | set(after)]
+        return sorted(rows, key=lambda x: -x[3])
+
+    def report(self, namespaces, top=10, top_allocations=0, printout=True):
+        """
+        Take a snapshot, compare it with the previous one, and return both.
+
+        Returns a dictionary with the new 'snapshot', the 'largest' objects
+        and the biggest 'growth' since the previous snapshot (each limited to
+        'top' entries). If 'printout' is True the same information is printed
+        to the console.
+        """
+        snap = self.snapshot(namespaces, top_allocations=top_allocations)
+        largest = sorted(snap['sizes'].items(), key=lambda x: -x[1])[:top]
+        growth = [g for g in self.diff() if g[3] > 0][:top] \
+            if len(self.history) > 1 else []
+        if printout:
+            print(clr('memory snapshot at {}: {} total'.format(
+                snap['time'], sizeof_fmt(snap['total'])), 'lightcyan'))
+            for name, size in largest:
+                print("{:>30}: {:>8}".format(name, sizeof_fmt(size)))
+            for name, before, after, change in growth:
+                print(clr("{:>30}: +{}".format(name, sizeof_fmt(change)),
+                          'orange'))
+            for alloc in snap.get('allocations', []):
+                print("{:>30}: {:+d} B".format(alloc['location'],
+                                              alloc['size_diff']))
+        return {'snapshot': snap, 'largest': largest, 'growth': growth}
+
+
+def module_namespaces(modnames):
+    """
+    Return a namespaces dictionary with the data globals of the named modules.
+
+    Each global is entered separately as 'module.name'. Modules and all
+    callables (functions, classes, partials, cached functions, etc.) are
+    skipped since they are not usually where memory leaks.
+    """
+    namespaces = {}
+    for modname in modnames:
+        module = sys.modules.get(modname)
+        if module is None:
+            continue
+        for name, val in vars(module).items():
+            if name.startswith('__') or callable(val) or \
+                    isinstance(val, type(sys)):
+                continue
+            namespaces['{}.{}'.format(modname, name)] = val
+    return namespaces
+
+
+MEMORY_MONITOR = MemoryMonitor()
+
+
+@util_action(trace_memory=False)
+def memory_report():
+    """
+    Controller function to snapshot memory use in the running web2py worker.
+
+    Sizes the globals of the listed modules and (optionally) the contents of
+    current.cache.ram and the current session, and compares them with the
+    previous snapshot taken through this form by the same worker process.
+
+    Listing the top allocation sites needs tracemalloc, which slows down the
+    whole worker. It is stopped again after the snapshot unless
+    'keep_tracing' is checked, which is needed to compare the allocations of
+    the next snapshot with this one.
+    """
+    out = None
+    form = SQLFORM.factory(Field('modules', 'list:string'),
+                           Field('include_cache', 'boolean', default=True),
+                           Field('include_session', 'boolean', default=False),
+                           Field('top', 'integer', default=10),
+                           Field('top_allocations', 'integer', default=0),
+                           Field('keep_tracing', 'boolean', default=False),
+                           Submit='Take snapshot')
+    if form.process().accepted:
+        vv = form.vars
+        namespaces = module_namespaces([m.strip() for m in vv.modules or []
+                                        if m.strip()])
+        cache = getattr(current, 'cache', None)
+        if vv.include_cache and cache is not None:
+            namespaces['cache.ram'] = getattr(cache.ram, 'storage', cache.ram)
+        if vv.include_session:
+            namespaces['session'] = Lazy(lambda: current.session)
+        out = BEAUTIFY(MEMORY_MONITOR.report(
+            namespaces, top=vv.top or 10,
+            top_allocations=vv.top_allocations or 0))
+        if not vv.keep_tracing:
+            MEMORY_MONITOR.stop_tracing()
+    elif form.errors:
+        out = BEAUTIFY(form.errors)
+
+    return form, out
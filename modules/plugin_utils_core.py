@@ -0,0 +1,1012 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+'''
+    File: plugin_utils_core.py
+    Author: Ian W. Scott
+    Description: The pure helper functions of plugin_utils, with no dependency
+    on gluon (or on any package outside the standard library).
+
+    Scripts and worker processes which only need these helpers can import them
+    cheaply, without loading web2py:
+
+        from plugin_utils_core import flatten, multiple_replace, make_json
+
+    Everything here is also importable from plugin_utils itself. Imports
+    needed by only a few functions are done inside those functions, and
+    tests/test_import_time.py checks that importing this module stays fast.
+
+    clr         :Surround a string with ansi color sequences for console output.
+    islist      :Ensure that an object is a list if it was not one already.
+    capitalize  :Capitalize a utf-8 string in a unicode-safe way.
+    lowercase   :Convert string to lower case in utf-8 safe way.
+    firstletter :Isolate the first letter of a byte-encoded unicode string.
+    normalize_many  :Apply one of the text helpers above to many strings,
+                     with a bounded cache (see also lowercase_many etc.).
+    flatten     :Convert an arbitrarily deep nested list into a single flat list.
+    iflatten    :Lazily yield the items of an arbitrarily deep nested list.
+    multiple_replace      :Perform several string replacements simultaneously.
+    multiple_replace_many :Lazily apply multiple_replace to many strings.
+    make_json   :Return a json object representing the provided dictionary, with
+                extra logic to handle dates, Decimals, sets and DAL rows.
+    iter_json   :Yield a json representation in chunks, streaming large lists.
+    dump_json   :Write a json representation to a file object in chunks.
+    load_json   :Parse json, optionally restoring dates and Decimals.
+    iter_json_records :Yield records one at a time from a json file.
+    deep_getsizeof  :Estimate the memory used by an object and its contents.
+    chunked     :Lazily split an iterable into lists of n items, without padding.
+    chunked_by_bytes:Lazily split an iterable into lists of about n bytes.
+    grouper     :Collect the items of an iterable into fixed-length groups.
+
+'''
+
+from collections import deque, namedtuple
+from collections.abc import Mapping, Iterable, Iterator
+import datetime
+from decimal import Decimal
+from functools import lru_cache
+from itertools import chain, islice, zip_longest
+import json
+import re
+import sys
+from unicodedata import combining
+
+_NO_DEFAULT = object()
+_orjson = _NO_DEFAULT
+
+
+def _load_orjson():
+    """
+    Return the optional orjson module (or None), importing it on first use.
+    """
+    global _orjson
+    if _orjson is _NO_DEFAULT:
+        try:
+            import orjson as _orjson
+        except ImportError:  # optional faster json backend
+            _orjson = None
+    return _orjson
+
+
+def islist(obj):
+    """
+    Return the supplied object converted to a list if it is not one already.
+    """
+    if isinstance(obj, (str, bytes, int, float)):
+        obj = [obj]
+    else:
+        obj = list(obj)
+    return obj
+
+
+def clr(string, mycol='white'):
+    """
+    Return a string surrounded by ansi colour escape sequences.
+
+    This function is intended to simplify colourizing terminal output.
+    The default color is white. The function can take any number of positional
+    arguments as component strings, which will be joined (space delimited)
+    before being colorized.
+    """
+    col = {'white': '\033[95m',
+           'blue': '\033[94m',
+           'green': '\033[92m',
+           'orange': '\033[93m',
+           'red': '\033[91m',
+           'lightblue': '\033[1;34m',
+           'lightgreen': '\033[1;32m',
+           'lightcyan': '\033[1;36m',
+           'lightred': '\033[1;31m',
+           'lightpurple': '\033[1;35m',
+           'white': '\033[1;37m',
+           'endc': '\033[0m'
+           }
+    thecol = col[mycol]
+    endc = col['endc']
+    if isinstance(string, list):
+        try:
+            string = ' '.join(string)
+        except TypeError:
+            string = ' '.join([str(s) for s in string])
+
+    newstring = '{}{}{}'.format(thecol, string, endc)
+    return newstring
+
+
+def makeutf8(rawstring):
+    """Return the string decoded as utf8 if it wasn't already."""
+    if isinstance(rawstring, str):
+        return rawstring
+    if isinstance(rawstring, (bytes, bytearray)):
+        try:
+            return rawstring.decode('utf8')
+        except UnicodeDecodeError:  # not utf8, so leave it alone
+            return rawstring
+    return 'None'  # NoneType and other non-strings
+
+
+def encodeutf8(rawstring):
+    """Return string encoded as bytestring from utf8 if it wasn't already."""
+    if isinstance(rawstring, str):
+        return rawstring.encode('utf8')
+    if isinstance(rawstring, (bytes, bytearray)):
+        return rawstring
+    return 'None'
+
+
+def capitalize(letter):
+    """
+    Convert string to upper case in utf-8 safe way.
+
+    Byte strings are decoded as utf8; a str is always returned.
+    """
+    if not isinstance(letter, str):
+        letter = makeutf8(letter)
+    return letter.upper()
+
+
+def capitalize_first(mystring):
+    """
+    Return the supplied string with its first letter capitalized.
+
+    The first letter is converted to titlecase rather than upper case, so
+    that (e.g.) a Greek letter with iota subscript stays a single letter.
+    """
+    if not isinstance(mystring, str):
+        mystring = makeutf8(mystring)
+    return mystring[:1].title() + mystring[1:]
+
+
+def lowercase(letter):
+    """
+    Convert string to lower case in utf-8 safe way.
+    """
+    if not isinstance(letter, str):
+        letter = makeutf8(letter)
+    return letter.lower()
+
+
+def firstletter(mystring):
+    """
+    Find the first letter of a byte-encoded unicode string.
+
+    Returns a tuple of the first letter and the rest of the string. Any
+    combining marks following the first character (as in decomposed
+    polytonic Greek) are kept with it.
+    """
+    if not isinstance(mystring, str):
+        mystring = makeutf8(mystring)
+    end = 1
+    if len(mystring) > 1 and mystring[1] >= '\u0300':
+        while end < len(mystring) and combining(mystring[end]):
+            end += 1
+    return mystring[:end], mystring[end:]
+
+
+TEXT_CACHE_SIZE = 8192
+
+
+def normalize_many(func, strings, cache_size=TEXT_CACHE_SIZE):
+    """
+    Lazily apply one of the text helpers to each of an iterable of strings.
+
+    Corpus vocabularies are highly repetitive, so unless 'cache_size' is 0
+    or None the results are memoized (for the duration of this call) in a
+    least-recently-used cache of that many strings.
+    """
+    if cache_size:
+        func = lru_cache(maxsize=cache_size)(func)
+    return map(func, strings)
+
+
+def capitalize_many(strings, cache_size=TEXT_CACHE_SIZE):
+    """Lazily apply capitalize to many strings (see normalize_many)."""
+    return normalize_many(capitalize, strings, cache_size)
+
+
+def capitalize_first_many(strings, cache_size=TEXT_CACHE_SIZE):
+    """Lazily apply capitalize_first to many strings (see normalize_many)."""
+    return normalize_many(capitalize_first, strings, cache_size)
+
+
+def lowercase_many(strings, cache_size=TEXT_CACHE_SIZE):
+    """Lazily apply lowercase to many strings (see normalize_many)."""
+    return normalize_many(lowercase, strings, cache_size)
+
+
+def firstletter_many(strings, cache_size=TEXT_CACHE_SIZE):
+    """Lazily apply firstletter to many strings (see normalize_many)."""
+    return normalize_many(firstletter, strings, cache_size)
+
+
+def iflatten(items, seqtypes=(list, tuple), max_depth=None):
+    """
+    Lazily yield the items of an arbitrarily deep nested list in order.
+
+    The structure is walked once, using an explicit stack of iterators rather
+    than recursion, so very deep nesting is safe. Only instances of 'seqtypes'
+    are expanded. If 'max_depth' is given, sequences nested more deeply than
+    that many levels are yielded as they are (max_depth=1 flattens one level).
+    """
+    stack = [iter(items)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, seqtypes) and \
+                    (max_depth is None or len(stack) <= max_depth):
+                stack.append(iter(item))
+                break
+            yield item
+        else:
+            stack.pop()
+
+
+def flatten(items, seqtypes=(list, tuple), max_depth=None):
+    """
+    Convert an arbitrarily deep nested list into a single flat list.
+    """
+    return list(iflatten(items, seqtypes=seqtypes, max_depth=max_depth))
+
+
+def _isoformat(obj):
+    return obj.isoformat()
+
+
+JSON_TYPE_ENCODERS = {datetime.datetime: _isoformat,
+                      datetime.date: _isoformat,
+                      datetime.time: _isoformat,
+                      Decimal: str,
+                      set: list,
+                      frozenset: list,
+                      bytes: lambda b: b.decode('utf8'),
+                      }
+
+
+JSON_TYPE_TAGS = {datetime.datetime: 'datetime',
+                  datetime.date: 'date',
+                  datetime.time: 'time',
+                  Decimal: 'decimal',
+                  }
+JSON_TYPE_DECODERS = {'datetime': datetime.datetime.fromisoformat,
+                      'date': datetime.date.fromisoformat,
+                      'time': datetime.time.fromisoformat,
+                      'decimal': Decimal,
+                      }
+
+
+def _json_default(obj):
+    """
+    Return a json-serializable version of obj (used as json's 'default').
+
+    Types are looked up (including base classes) in JSON_TYPE_ENCODERS, so
+    support for more types can be added there. DAL Rows and Row objects are
+    converted with their as_list() and as_dict() methods.
+    """
+    for cls in type(obj).__mro__:
+        encoder = JSON_TYPE_ENCODERS.get(cls)
+        if encoder:
+            return encoder(obj)
+    if hasattr(obj, 'as_list'):
+        return obj.as_list()
+    if hasattr(obj, 'as_dict'):
+        return obj.as_dict()
+    raise TypeError('Object of type {} is not JSON serializable'
+                    ''.format(type(obj).__name__))
+
+
+def _json_default_tagged(obj):
+    """
+    Like _json_default, but wrap values of the types in JSON_TYPE_TAGS in a
+    {"__type__": tag, "value": string} object so they can be restored.
+    """
+    for cls in type(obj).__mro__:
+        tag = JSON_TYPE_TAGS.get(cls)
+        if tag:
+            return {'__type__': tag, 'value': JSON_TYPE_ENCODERS[cls](obj)}
+    return _json_default(obj)
+
+
+def make_json(data, compact=False, tagged=False):
+    """
+    Return json object representing the data provided in dictionary "data".
+
+    By default the json is indented and its keys are sorted, for readability.
+    With compact=True there is no indentation, no sorting and no ascii
+    escaping, and the orjson library is used if it is installed. Dates,
+    times, Decimals, sets and DAL Row(s) objects are handled in both modes
+    (see JSON_TYPE_ENCODERS); any other unsupported type raises a TypeError.
+
+    With tagged=True, datetimes, dates, times and Decimals are written as
+    {"__type__": ..., "value": ...} objects, which load_json(tagged=True)
+    turns back into the original types.
+    """
+    default = _json_default_tagged if tagged else _json_default
+    if compact:
+        orjson = _load_orjson()
+        if orjson is not None:
+            try:
+                return orjson.dumps(data, default=default,
+                                    option=orjson.OPT_PASSTHROUGH_DATETIME |
+                                    orjson.OPT_NON_STR_KEYS).decode('utf8')
+            except TypeError:  # e.g. integers too large for orjson
+                pass
+        return json.dumps(data, default=default, ensure_ascii=False,
+                          separators=(',', ':'))
+    myjson = json.dumps(data,
+                        default=default,
+                        indent=4,
+                        sort_keys=True)
+    return myjson
+
+
+def iter_json(data, compact=True, chunk_size=500, tagged=False):
+    """
+    Yield the json representation of data as a series of string chunks.
+
+    A list, tuple, iterator/generator or DAL Rows object is encoded one item
+    at a time (joined into chunks of 'chunk_size' items) so that the whole
+    json string is never built in memory; DAL Rows objects are not converted
+    to a list first. Without 'compact' the items are indented just as
+    make_json would indent the whole list. Anything else is encoded
+    incrementally by the standard library encoder.
+    """
+    if isinstance(data, (list, tuple, Iterator)) or hasattr(data, 'as_list'):
+        first, sep, last = ('[', ',', ']') if compact \
+            else ('[\n    ', ',\n    ', '\n]')
+        parts = []
+        empty = True
+        for item in data:
+            parts.append(sep if not empty else first)
+            empty = False
+            text = make_json(item, compact=compact, tagged=tagged)
+            parts.append(text if compact else text.replace('\n', '\n    '))
+            if len(parts) >= chunk_size * 2:
+                yield ''.join(parts)
+                parts = []
+        parts.append('[]' if empty else last)
+        yield ''.join(parts)
+        return
+
+    encoder = json.JSONEncoder(default=_json_default_tagged if tagged
+                               else _json_default,
+                               ensure_ascii=not compact,
+                               separators=(',', ':') if compact else None,
+                               indent=None if compact else 4,
+                               sort_keys=not compact)
+    parts = []
+    for part in encoder.iterencode(data):
+        parts.append(part)
+        if len(parts) >= chunk_size:
+            yield ''.join(parts)
+            parts = []
+    if parts:
+        yield ''.join(parts)
+
+
+def dump_json(data, fp, compact=True, chunk_size=500, tagged=False):
+    """
+    Write the json representation of data to the file object fp in chunks.
+
+    See iter_json for how large lists and DAL Rows objects are streamed.
+    """
+    for chunk in iter_json(data, compact=compact, chunk_size=chunk_size,
+                           tagged=tagged):
+        fp.write(chunk)
+
+
+def _json_object_hook(schema=None, tagged=False):
+    """
+    Return an object_hook restoring typed values as each object is parsed.
+
+    The 'schema' argument pairs keys with a type name from
+    JSON_TYPE_DECODERS (or any function taking the string value).
+    """
+    decoders = {key: JSON_TYPE_DECODERS.get(val, val)
+                for key, val in (schema or {}).items()}
+
+    def hook(obj):
+        if tagged and '__type__' in obj and len(obj) == 2 \
+                and obj['__type__'] in JSON_TYPE_DECODERS:
+            return JSON_TYPE_DECODERS[obj['__type__']](obj['value'])
+        for key, decoder in decoders.items():
+            val = obj.get(key)
+            if isinstance(val, str):
+                obj[key] = decoder(val)
+        return obj
+
+    return hook if (schema or tagged) else None
+
+
+def load_json(data, schema=None, tagged=False):
+    """
+    Return a dictionary representing the supplied json string "data".
+
+    Values written as plain iso strings by make_json can be restored by
+    passing a 'schema' dictionary pairing keys with a type name ('datetime',
+    'date', 'time' or 'decimal', see JSON_TYPE_DECODERS) or a conversion
+    function; any string value under that key, at any level, is converted.
+    With tagged=True the {"__type__": ..., "value": ...} objects written by
+    make_json(tagged=True) are restored. Both conversions happen while the
+    json is parsed, not in a second pass.
+    """
+    hook = _json_object_hook(schema, tagged)
+    myjson = json.loads(data, object_hook=hook) if hook else json.loads(data)
+    return myjson
+
+
+def iter_json_records(fp, schema=None, tagged=False, read_size=65536):
+    """
+    Yield records one at a time from a file object holding json data.
+
+    The file may contain either one large top-level json array (as written
+    by dump_json) or newline-delimited json with one record per line. Only
+    the record being parsed is held in memory, along with a read buffer of
+    about 'read_size' characters. The 'schema' and 'tagged' arguments work as
+    for load_json.
+    """
+    decoder = json.JSONDecoder(object_hook=_json_object_hook(schema, tagged))
+    buf = fp.read(read_size)
+    while buf and not buf.strip():
+        more = fp.read(read_size)
+        if not more:
+            break
+        buf += more
+    start = len(buf) - len(buf.lstrip())
+    if not buf[start:start + 1] == '[':
+        for line in _join_split_lines(buf, fp):
+            line = line.strip()
+            if line:
+                yield decoder.decode(line)
+        return
+
+    pos = start + 1
+    eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                raise ValueError('unterminated json array')
+            more = fp.read(read_size)
+            eof = not more
+            buf, pos = buf[pos:] + more, 0
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = None
+        if end is None or (end == len(buf) and not eof):
+            # the record may continue past the buffer, so read more
+            more = fp.read(max(read_size, len(buf) - pos))
+            eof = not more
+            buf, pos = buf[pos:] + more, 0
+            continue
+        yield record
+        pos = end
+
+
+def _join_split_lines(buf, fp):
+    """
+    Yield the complete lines of buf followed by the lines remaining in fp.
+    """
+    lines = buf.split('\n')
+    tail = lines.pop()
+    for line in lines:
+        yield line
+    for line in fp:
+        yield tail + line
+        tail = ''
+    if tail:
+        yield tail
+
+
+REPLACER_CACHE_SIZE = 64
+TRIE_THRESHOLD = 200
+
+
+class Replacer(object):
+    '''
+    A compiled matcher for performing many simultaneous string replacements.
+
+    A Replacer is built once from a set of replacement pairs and can then be
+    applied to any number of strings without recompiling. Matching is
+    leftmost-longest: at each position the longest key that matches is
+    replaced, and replaced text is never re-scanned.
+
+    Two engines are available. The 'regex' engine compiles a single
+    alternation (longest keys first) and is fastest for small dictionaries.
+    The 'trie' engine walks a character trie from each candidate position and
+    scales much better for dictionaries of hundreds or thousands of pairs. By
+    default the engine is chosen from the number of pairs (see TRIE_THRESHOLD).
+
+    '''
+    def __init__(self, key_values, engine=None):
+        """
+        Initialize a Replacer object.
+
+        The key_values argument may be a dictionary pairing old values (keys)
+        with replacement values (values), or any iterable of (old, new) pairs.
+        Empty keys are ignored.
+
+        """
+        pairs = dict(key_values.items() if isinstance(key_values, Mapping)
+                     else key_values)
+        self.pairs = {k: v for k, v in pairs.items() if k}
+        self.first_chars = frozenset(k[0] for k in self.pairs)
+        if engine is None:
+            engine = 'trie' if len(self.pairs) >= TRIE_THRESHOLD else 'regex'
+        if engine not in ('regex', 'trie'):
+            raise ValueError('unknown Replacer engine: {}'.format(engine))
+        self.engine = engine
+
+        if engine == 'regex':
+            keys = sorted(self.pairs, key=len, reverse=True)
+            self._pattern = re.compile('|'.join(re.escape(k) for k in keys))
+        else:
+            self._trie = {}
+            for key, val in self.pairs.items():
+                node = self._trie
+                for char in key:
+                    node = node.setdefault(char, {})
+                node[''] = val  # single chars are never '', so safe as marker
+            self._first_re = re.compile('[{}]'.format(
+                ''.join(re.escape(c) for c in sorted(self.first_chars)))) \
+                if self.first_chars else None  # replace() returns early
+
+    def __call__(self, string):
+        return self.replace(string)
+
+    def __repr__(self):
+        return '<Replacer {} pairs, {} engine>'.format(len(self.pairs),
+                                                       self.engine)
+
+    def replace(self, string):
+        """
+        Return the supplied string with all replacements applied.
+        """
+        if not string or not self.pairs:
+            return string
+        if self.engine == 'regex':
+            pairs = self.pairs
+            return self._pattern.sub(lambda m: pairs[m.group(0)], string)
+        return self._replace_trie(string)
+
+    def _replace_trie(self, string):
+        """
+        Apply the replacements by walking the key trie from each position
+        where a key could start.
+        """
+        trie = self._trie
+        search = self._first_re.search
+        strlen = len(string)
+        out = []
+        last = 0
+        found = search(string)
+        while found:
+            start = found.start()
+            node = trie[string[start]]
+            end, val = (start + 1, node['']) if '' in node else (None, None)
+            pos = start + 1
+            while pos < strlen:
+                node = node.get(string[pos])
+                if node is None:
+                    break
+                pos += 1
+                if '' in node:
+                    end, val = pos, node['']
+            if end is None:
+                found = search(string, start + 1)
+                continue
+            out.append(string[last:start])
+            out.append(val)
+            last = end
+            found = search(string, end)
+        if not out:
+            return string
+        out.append(string[last:])
+        return ''.join(out)
+
+
+@lru_cache(maxsize=REPLACER_CACHE_SIZE)
+def _cached_replacer(frozen_pairs, engine):
+    return Replacer(frozen_pairs, engine=engine)
+
+
+def get_replacer(key_values, engine=None):
+    """
+    Return a (cached) Replacer object for the supplied replacement pairs.
+
+    Replacers are kept in a bounded LRU cache keyed by the set of pairs, so
+    repeated calls with the same pairs (e.g., once per row of a table) reuse
+    the already compiled matcher. If key_values is already a Replacer it is
+    returned unchanged.
+    """
+    if isinstance(key_values, Replacer):
+        return key_values
+    pairs = key_values if isinstance(key_values, Mapping) \
+        else dict(key_values)  # later duplicate keys win, as in a dict
+    return _cached_replacer(frozenset(pairs.items()), engine)
+
+
+def multiple_replace(string, key_values, return_unicode=True, engine=None):
+    """
+    Perform multiple string replacements simultaneously and return a unicode str.
+
+    Because the replacements are simultaneous the results of one replacement
+    will not be seen in making other replacements. For example, if 're' is to
+    be replaced by 'in' and 'nt' is to be replaced by 'ch' (('re', 'in'),
+    ('int', 'ch')), the input string 'return' would become 'inturn' not 'churn'.
+    Where several keys match at the same position the longest one wins.
+
+    The key_values argument should be a dictionary pairing old values (keys)
+    with replacement values (values). A list of (old, new) pairs or a
+    pre-built Replacer object are also accepted. The compiled matcher is
+    cached (see get_replacer), so calling this repeatedly with the same pairs
+    does not recompile it.
+
+    From http://stackoverflow.com/questions/6116978/python-replace-multiple-strings
+
+    """
+    # TODO: Should this accept regexes as the keys? (currently doesn't)
+    return get_replacer(key_values, engine=engine).replace(string)
+
+
+_worker_replacer = None
+
+
+def _init_replace_worker(replacer):
+    global _worker_replacer
+    _worker_replacer = replacer
+
+
+def _replace_in_worker(strings):
+    return [_prefiltered_replace(_worker_replacer, s) for s in strings]
+
+
+def _bounded_map(func, iterable, executor=None, inflight=4):
+    """
+    Yield func(item) for each item in order, keeping few items in flight.
+
+    Unlike Executor.map, which submits the whole iterable at once, at most
+    'inflight' items are submitted to the executor ahead of the consumer. With
+    no executor func is simply called in this thread.
+    """
+    if executor is None:
+        for item in iterable:
+            yield func(item)
+        return
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= inflight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _prefiltered_replace(replacer, string):
+    """
+    Apply replacer to string unless none of its keys can possibly occur.
+    """
+    if not string or replacer.first_chars.isdisjoint(string):
+        return string
+    return replacer.replace(string)
+
+
+def multiple_replace_many(strings, key_values, engine=None, processes=None,
+                          chunksize=1000):
+    """
+    Lazily yield the result of multiple_replace for each string in strings.
+
+    The strings argument may be any iterable, including a generator. The
+    matcher is compiled only once for the whole run and strings which do not
+    contain the first character of any key are passed through untouched
+    without being scanned.
+
+    If 'processes' is given (an integer, or 0 for one per cpu) the strings are
+    spread across a process pool in batches of 'chunksize'. Results are still
+    yielded lazily and in input order, and only two batches per process are
+    read from 'strings' ahead of the consumer, so memory use does not grow
+    with the size of the input. This only pays off for large inputs, since
+    each worker process has to be started and sent the matcher.
+    """
+    replacer = get_replacer(key_values, engine=engine)
+    if processes is None:
+        for string in strings:
+            yield _prefiltered_replace(replacer, string)
+        return
+
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers, initializer=_init_replace_worker,
+                             initargs=(replacer,)) as executor:
+        for batch in _bounded_map(_replace_in_worker,
+                                  chunked(strings, chunksize), executor,
+                                  inflight=2 * workers):
+            yield from batch
+
+
+def sizeof_fmt(num, suffix='B'):
+    ''' by Fred Cirera,  https://stackoverflow.com/a/1094933/1870254, modified'''
+    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f %s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f %s%s" % (num, 'Yi', suffix)
+
+
+def print_sizes(object_dict, mylimit=10, max_depth=None, max_objects=None,
+                sample=None):
+    """
+    Print the names and deep sizes of the largest objects in object_dict.
+
+    The optional 'max_depth', 'max_objects' and 'sample' arguments are passed
+    on to estimate_sizeof (see there) and keep this usable on very large live
+    objects. Sampled sizes are printed with their estimated error.
+    """
+    estimates = ((name, estimate_sizeof(value, max_depth=max_depth,
+                                        max_objects=max_objects,
+                                        sample=sample))
+                 for name, value in object_dict.items())
+    for name, est in sorted(estimates, key=lambda x: -x[1].size)[:mylimit]:
+        mysize = sizeof_fmt(est.size)
+        if est.error:
+            mysize += ' ± {}'.format(sizeof_fmt(est.error))
+        if est.truncated:
+            mysize += ' (truncated)'
+        print("{:>30}: {:>8}".format(name, mysize))
+
+
+SizeEstimate = namedtuple('SizeEstimate', ['size', 'error', 'objects',
+                                           'truncated'])
+
+_ATOMIC_TYPES = (str, bytes, bytearray, int, float, complex, bool, range,
+                 type(None))
+_SAMPLED_TYPES = (list, tuple, set, frozenset, deque, dict)
+
+
+def _sizeof_children(obj):
+    """
+    Return the shallow size of obj and a list (or iterable) of its referents.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, _ATOMIC_TYPES):
+        return size, ()
+    if isinstance(obj, memoryview):
+        return size, (obj.obj,)
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, int) and hasattr(obj, 'dtype'):  # numpy arrays
+        return max(size, nbytes), ()
+
+    if isinstance(obj, Mapping):
+        return size, chain.from_iterable(obj.items())
+    children = []
+    if hasattr(obj, '__dict__'):
+        children.append(obj.__dict__)
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get('__slots__', ())
+        for slot in (slots,) if isinstance(slots, str) else slots:
+            if slot not in ('__dict__', '__weakref__'):
+                val = getattr(obj, slot, _NO_DEFAULT)
+                if val is not _NO_DEFAULT:
+                    children.append(val)
+    if children or hasattr(obj, '__dict__'):
+        return size, children
+    if isinstance(obj, Iterable) and not isinstance(obj, Iterator):
+        return size, obj
+    return size, ()
+
+
+def estimate_sizeof(obj, seen=None, max_depth=None, max_objects=None,
+                    sample=None):
+    """
+    Estimate the memory footprint of a Python object and everything in it.
+
+    Returns a SizeEstimate namedtuple of (size, error, objects, truncated),
+    where 'objects' is the number of objects actually measured.
+
+    The object graph is walked iteratively with an explicit stack, so deep
+    nesting cannot hit the recursion limit, and each object is only counted
+    once (self-referential objects are fine). The walk stops descending below
+    'max_depth' levels and stops altogether after 'max_objects' objects; in
+    either case 'truncated' is True and the size is a lower bound.
+
+    If 'sample' is an integer, any list, tuple, set, dict or deque with more
+    than that many items is measured by taking the deep size of 'sample'
+    randomly chosen items and extrapolating to the whole container. The
+    'error' value is then the standard error of that extrapolation (summed in
+    quadrature over all the sampled containers). This makes it practical to
+    size huge, homogeneous containers such as the records of a DAL Rows
+    object. Objects shared between many items are over-counted by sampling.
+
+    Instances with __slots__, buffers (bytes, bytearray, memoryview) and
+    NumPy arrays (via their nbytes) are handled. Iterators and generators are
+    not iterated, so measuring never consumes them.
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    variance = 0.0
+    count = 0
+    truncated = False
+    stack = [(obj, 0)]
+    while stack:
+        current_obj, depth = stack.pop()
+        obj_id = id(current_obj)
+        if obj_id in seen:
+            continue
+        if max_objects is not None and count >= max_objects:
+            truncated = True
+            break
+        # mark as seen before descending to handle self-referential objects
+        seen.add(obj_id)
+        count += 1
+        mysize, children = _sizeof_children(current_obj)
+        size += mysize
+        if not children:
+            continue
+        if max_depth is not None and depth >= max_depth:
+            truncated = True
+            continue
+        if sample and isinstance(current_obj, _SAMPLED_TYPES) \
+                and len(current_obj) > sample:
+            est = _estimate_sampled(current_obj, sample, seen, depth,
+                                    max_depth,
+                                    None if max_objects is None
+                                    else max_objects - count)
+            size += est.size
+            variance += est.error ** 2
+            count += est.objects
+            truncated = truncated or est.truncated
+            continue
+        stack.extend((child, depth + 1) for child in children)
+
+    return SizeEstimate(size, variance ** 0.5, count, truncated)
+
+
+def _sample_items(container, sample):
+    """
+    Yield 'sample' randomly chosen items of a container in a single pass.
+
+    Random (rather than evenly spaced) positions avoid aliasing with periodic
+    data. The generator is seeded from the container length so repeated
+    measurements of the same container agree.
+    """
+    import random
+
+    positions = sorted(random.Random(len(container)).sample(
+        range(len(container)), sample))
+    if isinstance(container, (list, tuple)):
+        for pos in positions:
+            yield container[pos]
+        return
+    iterator = iter(container.items() if isinstance(container, dict)
+                    else container)
+    prev = -1
+    for pos in positions:
+        yield next(islice(iterator, pos - prev - 1, None))
+        prev = pos
+
+
+def _estimate_sampled(container, sample, seen, depth, max_depth, max_objects):
+    """
+    Estimate the deep size of a large container's items from a sample.
+    """
+    total = len(container)
+    child_depth = None if max_depth is None else max_depth - depth - 1
+    sizes = []
+    variance = 0.0
+    count = 0
+    truncated = False
+    for item in _sample_items(container, sample):
+        budget = None if max_objects is None else max(max_objects - count, 0)
+        # a dict item tuple is not itself stored, so measure its parts
+        parts = item if isinstance(container, dict) else (item,)
+        itemsize = 0
+        for part in parts:
+            est = estimate_sizeof(part, seen, child_depth, budget, sample)
+            itemsize += est.size
+            variance += est.error ** 2
+            count += est.objects
+            truncated = truncated or est.truncated
+        sizes.append(itemsize)
+
+    num = len(sizes)
+    mean = sum(sizes) / num
+    spread = sum((s - mean) ** 2 for s in sizes) / (num - 1) if num > 1 else 0
+    # standard error of the extrapolated total, with finite population
+    # correction, plus the (scaled) error of any nested sampled estimates
+    sample_var = total ** 2 * spread / num * (1 - num / total)
+    nested_var = variance * (total / num) ** 2
+    return SizeEstimate(int(round(mean * total)), (sample_var + nested_var) ** 0.5,
+                        count, truncated)
+
+
+def deep_getsizeof(obj, seen=None, max_depth=None, max_objects=None,
+                   sample=None):
+    """
+    Find the memory footprint of a Python object
+
+    This drills down a Python object graph like a dictionary holding nested
+    dictionaries with lists of lists and tuples and sets, and returns the
+    total size in bytes. See estimate_sizeof for the optional budgets and
+    sampling mode, and for the error estimate that goes with sampling.
+
+    The sys.getsizeof function does a shallow size of only. It counts each
+    object inside a container as pointer only regardless of how big it
+    really is.
+
+    :param obj: the object
+    :param seen: a set of ids of objects already counted (to be skipped)
+    :return: the size in bytes
+    """
+    return estimate_sizeof(obj, seen, max_depth=max_depth,
+                           max_objects=max_objects, sample=sample).size
+
+
+def chunked(iterable, n):
+    """
+    Lazily yield lists of up to n items from iterable, without padding.
+
+    Unlike grouper, the last list is simply shorter if the items run out,
+    and only one chunk is held in memory at a time.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, n))
+        if not batch:
+            return
+        yield batch
+
+
+def payload_size(item):
+    """
+    Return a rough estimate of the bytes needed to store or send item.
+
+    Strings count their length, numbers 8 bytes, and dictionaries, lists and
+    tuples (such as the rows passed to bulk_insert) the sum of their keys and
+    values. This is much cheaper than deep_getsizeof, and closer to the size
+    of the data written to a db or a json file than to its memory footprint.
+    """
+    if isinstance(item, (str, bytes, bytearray)):
+        return len(item)
+    if isinstance(item, Mapping):
+        return sum(payload_size(k) + payload_size(v) for k, v in item.items())
+    if isinstance(item, (list, tuple, set, frozenset)):
+        return sum(payload_size(i) for i in item) or 1
+    return 8
+
+
+def chunked_by_bytes(iterable, max_bytes, max_items=None, sizeof=payload_size):
+    """
+    Lazily yield lists of items from iterable of up to about max_bytes each.
+
+    Each list is cut off when the next item would take its estimated size
+    (as measured by the 'sizeof' function) over 'max_bytes', or when it
+    reaches 'max_items' items if that is given. An item larger than
+    'max_bytes' by itself is yielded alone.
+    """
+    batch, total = [], 0
+    for item in iterable:
+        size = sizeof(item)
+        if batch and (total + size > max_bytes or len(batch) == max_items):
+            yield batch
+            batch, total = [], 0
+        batch.append(item)
+        total += size
+    if batch:
+        yield batch
+
+
+def grouper(iterable, n, fillvalue=None):
+    """
+    Collect the items of iterable into tuples of n, padding with fillvalue.
+
+    Kept for backwards compatibility; chunked does not pad.
+    """
+    args = [iter(iterable)] * n
+    return zip_longest(*args, fillvalue=fillvalue)
@@ -0,0 +1,21 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+ Shared fixtures for the plugin_utils tests
+
+"""
+
+import pytest
+from gluon import current, DAL
+
+
+@pytest.fixture
+def db():
+    """
+    A pytest fixture providing an empty in-memory sqlite DAL as current.db.
+    """
+    mydb = DAL('sqlite:memory')
+    current.db = mydb
+    yield mydb
+    mydb.close()
+    current.db = None
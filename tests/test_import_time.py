@@ -0,0 +1,106 @@
+#! /usr/bin/python
+# -*- coding: UTF-8 -*-
+"""
+ Import-time budget tests for the plugin_utils modules
+
+ Each import is measured in a fresh interpreter with python -X importtime,
+ taking the best of a few runs to smooth out noise. Since absolute times
+ depend on the machine and its load, each module is budgeted as a multiple
+ of the time taken, in the same run, to import the modules it builds on
+ (the stdlib modules it imports, plus gluon for plugin_utils). The ratios
+ are generous, meant to catch an expensive new top-level import rather than
+ small fluctuations; test_core_defers_heavy_imports is the exact check.
+ run with py.test -xvs path/to/tests/dir
+
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+MODULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'modules')
+CORE_BASELINE = ['collections', 'datetime', 'decimal', 'functools',
+                 'itertools', 'json', 're', 'unicodedata']
+FULL_BASELINE = CORE_BASELINE + ['gluon', 'hashlib', 'queue', 'threading']
+CORE_RATIO = 3
+FULL_RATIO = 2
+DEFERRED_MODULES = ['gluon', 'kitchen', 'csv', 'pprint', 'traceback', 'ast',
+                    'multiprocessing', 'concurrent.futures', 'orjson',
+                    'random']
+
+
+def run_python(args, tmp_path):
+    """
+    Run python with the modules folder on the path, returning the process.
+
+    Bytecode is cached in tmp_path so that compiling is not measured.
+    """
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=str(tmp_path))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [MODULES] + [p for p in [os.environ.get('PYTHONPATH')] if p])
+    return subprocess.run([sys.executable] + args, env=env,
+                          capture_output=True, text=True)
+
+
+def import_time(modnames, tmp_path, runs=3):
+    """
+    Return the best total import time of the modules, in microseconds.
+
+    The total is the sum of the cumulative times of the top-level imports,
+    so modules already loaded by the interpreter at startup count as zero.
+    """
+    times = []
+    for _ in range(runs + 1):  # the first run writes the bytecode cache
+        proc = run_python(['-X', 'importtime', '-c',
+                           'import {}'.format(', '.join(modnames))], tmp_path)
+        assert proc.returncode == 0, proc.stderr
+        total = 0
+        for line in proc.stderr.splitlines():
+            cols = line.split('|')
+            if len(cols) == 3 and cols[2].startswith(' ') and \
+                    not cols[2].startswith('  ') and cols[1].strip().isdigit():
+                total += int(cols[1])
+        times.append(total)
+    return min(times[1:])
+
+
+def import_ratio(modname, baseline, tmp_path):
+    """
+    Return the import time of modname as a multiple of that of baseline.
+    """
+    base = import_time(baseline, tmp_path)
+    return import_time([modname], tmp_path) / max(base, 1)
+
+
+def test_core_import_time(tmp_path):
+    """
+    Importing plugin_utils_core should cost less than CORE_RATIO times its
+    stdlib imports.
+    """
+    assert import_ratio('plugin_utils_core', CORE_BASELINE,
+                        tmp_path) < CORE_RATIO
+
+
+def test_core_defers_heavy_imports(tmp_path):
+    """
+    Importing plugin_utils_core should not load gluon or the deferred modules.
+    """
+    proc = run_python(['-c', 'import sys, plugin_utils_core; '
+                       'print(" ".join(sorted(sys.modules)))'], tmp_path)
+    assert proc.returncode == 0, proc.stderr
+    loaded = set(proc.stdout.split())
+    assert not loaded.intersection(DEFERRED_MODULES)
+
+
+def test_full_import_time(tmp_path):
+    """
+    Importing plugin_utils should cost less than FULL_RATIO times gluon and
+    its other imports.
+    """
+    if run_python(['-c', 'import gluon'], tmp_path).returncode:
+        pytest.skip('gluon is not importable')
+    assert import_ratio('plugin_utils', FULL_BASELINE, tmp_path) < FULL_RATIO
@@ -9,7 +9,17 @@
 
 """
 
+import datetime
+from decimal import Decimal
+from gluon import Field, SQLFORM
+import json
+import os
+import pickle
 import pytest
+import re
+import sys
+import time
+from types import SimpleNamespace
 import plugin_utils
 
 
@@ -91,3 +101,1025 @@ def test_multiple_replace(string_in, equivs, string_out):
     print('expected', string_out)
     print('equivs', equivs)
     assert actual == string_out
+
+
+@pytest.mark.parametrize('engine', ['regex', 'trie'])
+@pytest.mark.parametrize('string_in,equivs,string_out',
+                         [('happiness',
+                           {'h': 'd',
+                            'a': 'i',
+                            'p': 'z'},
+                           'dizziness'),
+                          ('ἀποκρινομαι',
+                           {'οκ': 'εκ',
+                            'ρ': 'δ',
+                            'ιν': 'εχ'},
+                           'ἀπεκδεχομαι'),
+                          ('return',
+                           [('re', 'in'),
+                            ('nt', 'ch')],
+                           'inturn'),
+                          ('abcabd',
+                           {'a': '1',
+                            'ab': '2',
+                            'abd': '3'},
+                           '2c3'),
+                          ('nothing here',
+                           {'xyz': 'q'},
+                           'nothing here'),
+                          ('no pairs', {}, 'no pairs'),
+                          ('empty keys', {'': 'x'}, 'empty keys'),
+                          ])
+def test_replacer_engines(engine, string_in, equivs, string_out):
+    """
+    Unit test for the Replacer class with both matching engines.
+    """
+    replacer = plugin_utils.Replacer(equivs, engine=engine)
+    assert replacer(string_in) == string_out
+    assert plugin_utils.multiple_replace(string_in, equivs,
+                                         engine=engine) == string_out
+
+
+def test_get_replacer_cache():
+    """
+    Unit test for the get_replacer() LRU cache.
+    """
+    first = plugin_utils.get_replacer({'a': 'b', 'c': 'd'})
+    second = plugin_utils.get_replacer([('c', 'd'), ('a', 'b')])
+    assert first is second
+    assert plugin_utils.get_replacer(first) is first
+    # duplicate keys follow dict semantics (the last pair wins) whatever
+    # order the cache was populated in
+    plugin_utils.multiple_replace('abc', [('a', '1'), ('a', '2')])
+    assert plugin_utils.multiple_replace('abc', [('a', '2'), ('a', '1')]) \
+        == '1bc'
+
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_multiple_replace_many(processes):
+    """
+    Unit test for multiple_replace_many() utility function.
+    """
+    strings = (s for s in ['happiness', 'xyz', '', None, 'hap'])
+    actual = plugin_utils.multiple_replace_many(strings,
+                                                {'h': 'd', 'a': 'i',
+                                                 'p': 'z'},
+                                                processes=processes,
+                                                chunksize=2)
+    assert list(actual) == ['dizziness', 'xyz', '', None, 'diz']
+
+
+def test_multiple_replace_many_bounded():
+    """
+    The process pool should only read a few batches ahead of the consumer.
+    """
+    consumed = []
+
+    def strings():
+        for i in range(100000):
+            consumed.append(i)
+            yield 'happy'
+
+    results = plugin_utils.multiple_replace_many(strings(), {'h': 'd'},
+                                                 processes=2, chunksize=100)
+    assert next(results) == 'dappy'
+    assert len(consumed) <= 100 * 2 * 2 + 100
+    results.close()
+
+
+def test_iter_csv_records(tmp_path):
+    """
+    Unit test for iter_csv_records() csv streaming function.
+    """
+    path = tmp_path / 'export.csv'
+    path.write_text('uid,title,created,tax_1,tax_2\n'
+                    '1,3.2,1335558252,a,NULL\n'
+                    '2,,oops,b,c\n'
+                    'short\n', encoding='utf8')
+    mapping = {'uid': 'uid',
+               'chapter': ('title', lambda t: t.split('.')[0]),
+               'created': ('created', int, 0),
+               'topics': (re.compile(r'tax_'), '|'.join),
+               'missing': 'no_such_column'}
+    stats = {}
+    actual = list(plugin_utils.iter_csv_records(str(path), mapping, stats))
+    assert actual == [{'uid': '1', 'chapter': '3', 'created': 1335558252,
+                       'topics': 'a'},
+                      {'uid': '2', 'created': 0, 'topics': 'b|c'}]
+    assert stats == {'rows': 2, 'errors': 2, 'missing_columns': ['missing']}
+
+
+@pytest.mark.parametrize('mydata,mydepth,myexpected', [
+    ([1, [2, [3, [4]]], (5,)], None, [1, 2, 3, 4, 5]),
+    ([1, [2, [3, [4]]], (5,)], 1, [1, 2, [3, [4]], 5]),
+    ([1, [2, [3, [4]]], (5,)], 0, [1, [2, [3, [4]]], (5,)]),
+    ([[], ['ab', []], 'cd'], None, ['ab', 'cd']),
+])
+def test_iflatten(mydata, mydepth, myexpected):
+    """
+    Unit test for iflatten() utility function.
+    """
+    actual = plugin_utils.iflatten(mydata, max_depth=mydepth)
+    assert not isinstance(actual, list)
+    assert list(actual) == myexpected
+
+
+def test_flatten_deep():
+    """
+    Unit test for flatten() on nesting deeper than the recursion limit.
+    """
+    data = [0]
+    for i in range(1, sys.getrecursionlimit() * 2):
+        data = [data, i]
+    actual = plugin_utils.flatten(data)
+    assert actual == list(range(sys.getrecursionlimit() * 2))
+
+
+def test_deep_getsizeof():
+    """
+    Unit test for deep_getsizeof() and estimate_sizeof() utility functions.
+    """
+    getsizeof = sys.getsizeof
+    data = {'a': ['x' * 100, 'y' * 100]}
+    data['self'] = data
+    expected = sum(getsizeof(o) for o in [data, 'a', 'self', data['a'],
+                                          data['a'][0], data['a'][1]])
+    assert plugin_utils.deep_getsizeof(data) == expected
+
+    nested = [0]
+    for i in range(sys.getrecursionlimit() * 2):
+        nested = [nested]
+    assert plugin_utils.deep_getsizeof(nested) > 0
+
+    truncated = plugin_utils.estimate_sizeof(data, max_objects=2)
+    assert truncated.truncated and truncated.objects == 2
+
+    big = ['z' * (i % 100) for i in range(10000)]
+    exact = plugin_utils.deep_getsizeof(big)
+    estimate = plugin_utils.estimate_sizeof(big, sample=200)
+    assert estimate.objects < 300
+    assert abs(estimate.size - exact) < 4 * estimate.error
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_make_json(compact):
+    """
+    Unit test for make_json() with temporal, Decimal and set values.
+    """
+    data = {'when': datetime.datetime(2020, 1, 2, 3, 4, 5),
+            'day': datetime.date(2020, 1, 2),
+            'time': datetime.time(3, 4),
+            'amount': Decimal('1.10'),
+            'ids': {7},
+            'word': 'ἀποκρινομαι'}
+    actual = plugin_utils.make_json(data, compact=compact)
+    assert json.loads(actual) == {'when': '2020-01-02T03:04:05',
+                                  'day': '2020-01-02',
+                                  'time': '03:04:00',
+                                  'amount': '1.10',
+                                  'ids': [7],
+                                  'word': 'ἀποκρινομαι'}
+    assert ('\n' in actual) is not compact
+    with pytest.raises(TypeError):
+        plugin_utils.make_json({'bad': object()}, compact=compact)
+
+
+def test_dump_json():
+    """
+    Unit test for iter_json() and dump_json() streaming of a generator.
+    """
+    from io import StringIO
+    chunks = list(plugin_utils.iter_json(({'n': i} for i in range(5)),
+                                         chunk_size=2))
+    assert len(chunks) > 1
+    myfile = StringIO()
+    plugin_utils.dump_json(({'n': i} for i in range(5)), myfile)
+    assert ''.join(chunks) == myfile.getvalue()
+    assert json.loads(myfile.getvalue()) == [{'n': i}
+                                             for i in range(5)]
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    [{'n': 1, 'nested': {'b': [1, 2], 'a': 'ä'}}, [3, {'x': None}], 'end'],
+    [{'n': i} for i in range(7)],
+])
+def test_dump_json_indented(data):
+    """
+    Indented iter_json() output of a generator should match make_json().
+    """
+    chunks = list(plugin_utils.iter_json(iter(data), compact=False,
+                                         chunk_size=2))
+    assert ''.join(chunks) == plugin_utils.make_json(data) == \
+        json.dumps(data, indent=4, sort_keys=True)
+    assert ''.join(plugin_utils.iter_json(tuple(data), compact=False)) == \
+        plugin_utils.make_json(data)
+
+
+@pytest.mark.parametrize('read_size', [3, 65536])
+def test_json_round_trip(read_size):
+    """
+    Unit test for load_json() and iter_json_records() typed decoding.
+    """
+    from io import StringIO
+    records = [{'id': i,
+                'when': datetime.datetime(2020, 1, 2, 3, 4, i),
+                'day': datetime.date(2020, 1, i + 1),
+                'amount': Decimal('{}.10'.format(i))}
+               for i in range(5)]
+    schema = {'when': 'datetime', 'day': 'date', 'amount': 'decimal'}
+
+    tagged = plugin_utils.make_json(records, tagged=True)
+    assert plugin_utils.load_json(tagged, tagged=True) == records
+    assert plugin_utils.load_json(plugin_utils.make_json(records),
+                                  schema=schema) == records
+
+    myfile = StringIO()
+    plugin_utils.dump_json(records, myfile, tagged=True)
+    myfile.seek(0)
+    assert list(plugin_utils.iter_json_records(myfile, tagged=True,
+                                               read_size=read_size)) == records
+
+    ndjson = StringIO(''.join(plugin_utils.make_json(r, compact=True) + '\n'
+                              for r in records))
+    assert list(plugin_utils.iter_json_records(ndjson, schema=schema,
+                                               read_size=read_size)) == records
+
+
+def test_report_queue(tmp_path):
+    """
+    Unit test for background, batched ErrorReport delivery via ReportQueue.
+    """
+    mailer = plugin_utils.LocalMailer(fail_times=2)
+    queue = plugin_utils.ReportQueue(mailer, spool_dir=str(tmp_path),
+                                     batch_window=0.2, backoff=0.01)
+    reporter = plugin_utils.ErrorReport(mail=mailer, queue=queue)
+    for i in range(3):
+        assert reporter.send_report('MyClass', 'method{}'.format(i),
+                                    traceback='Traceback...')
+    queue.flush()
+    assert mailer.attempts == 3
+    assert len(mailer.sent) == 1
+    to, subject, body = mailer.sent[0]
+    assert to == 'errors@localhost'
+    assert '3 reports' in subject
+    assert all('MyClass.method{}'.format(i) in body for i in range(3))
+    assert queue.sent == 3
+    assert not list(tmp_path.iterdir())
+
+
+def test_report_queue_shared_spool(tmp_path):
+    """
+    Queues sharing a spool folder should each send a spooled report once.
+    """
+    for i in range(6):
+        (tmp_path / '{}.json'.format(i)).write_text(json.dumps(
+            {'title': 'old {}'.format(i), 'body': 'body', 'time': ''}))
+    (tmp_path / 'corrupt.json').write_text('{not json')
+    stale = tmp_path / 'stale.json.1-2.sending'
+    stale.write_text('{"title": "stale", "body": "body"}')
+    os.utime(str(stale), (0, 0))
+    (tmp_path / 'gone.json').write_text('{}')
+
+    mailers = [plugin_utils.LocalMailer() for _ in range(2)]
+    queues = [plugin_utils.ReportQueue(m, spool_dir=str(tmp_path),
+                                       batch_window=0.05)
+              for m in mailers]
+    (tmp_path / 'gone.json').unlink()  # sent by another process meanwhile
+    for queue in queues:
+        queue.flush()
+    bodies = ''.join(body for m in mailers for to, subject, body in m.sent)
+    titles = [subject for m in mailers for to, subject, body in m.sent]
+    assert sum(q.sent for q in queues) == 7
+    assert all(bodies.count('old {}'.format(i)) + titles.count(
+        'old {}'.format(i)) == 1 for i in range(6))
+    assert sum(q.corrupt for q in queues) == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['corrupt.json.bad']
+
+
+def test_report_throttle():
+    """
+    Unit test for fingerprinted de-duplication of ErrorReport emails.
+    """
+    tb = ('Traceback (most recent call last):\n'
+          '  File "app.py", line {}, in step\n'
+          'KeyError: {}\n')
+    first = plugin_utils.report_fingerprint('C', 'm', tb.format(10, "'a'"))
+    assert first == plugin_utils.report_fingerprint('C', 'm',
+                                                    tb.format(12, "'b'"))
+    assert first != plugin_utils.report_fingerprint('C', 'n',
+                                                    tb.format(10, "'a'"))
+
+    mailer = plugin_utils.LocalMailer()
+    throttle = plugin_utils.ReportThrottle(window=60)
+    reporter = plugin_utils.ErrorReport(mail=mailer, throttle=throttle)
+    results = [reporter.send_report('C', 'm', traceback=tb.format(i, i))
+               for i in range(5)]
+    assert results == [True, False, False, False, False]
+    assert len(mailer.sent) == 1
+    summary = throttle.pop_summary(force=True)
+    assert '4 more occurrence(s) of the error in C.m' in summary
+    assert throttle.pop_summary(force=True) is None
+    throttle.stop_timer()
+
+
+def test_report_throttle_timer():
+    """
+    The summary of suppressed reports should be sent without a new report.
+    """
+    mailer = plugin_utils.LocalMailer()
+    throttle = plugin_utils.ReportThrottle(window=60, summary_interval=0.05)
+    reporter = plugin_utils.ErrorReport(mail=mailer, throttle=throttle)
+    for _ in range(3):
+        reporter.send_report('C', 'm', traceback='KeyError')
+    try:
+        for _ in range(100):  # the storm has stopped; wait for the timer
+            if len(mailer.sent) > 1:
+                break
+            time.sleep(0.01)
+    finally:
+        throttle.stop_timer()
+    assert len(mailer.sent) == 2
+    to, subject, body = mailer.sent[1]
+    assert subject == plugin_utils.SUMMARY_TITLE
+    assert '2 more occurrence(s) of the error in C.m' in body
+
+
+def test_iter_files(tmp_path):
+    """
+    Unit test for the iter_files scandir walk.
+    """
+    (tmp_path / 'sub' / 'deeper').mkdir(parents=True)
+    for mydir in [tmp_path, tmp_path / 'sub', tmp_path / 'sub' / 'deeper']:
+        (mydir / 'a.mp3').write_text('x')
+        (mydir / 'b.txt').write_text('x')
+
+    found = list(plugin_utils.iter_files(str(tmp_path)))
+    assert len(found) == 6
+    assert all(e.is_file() for e in found)
+    shallow = list(plugin_utils.iter_files(str(tmp_path), recursive=False))
+    assert sorted(e.name for e in shallow) == ['a.mp3', 'b.txt']
+    mp3s = list(plugin_utils.iter_files(str(tmp_path), pattern='*.mp3'))
+    assert [e.name for e in mp3s] == ['a.mp3'] * 3
+    txts = list(plugin_utils.iter_files(str(tmp_path), regex=r'^b\.'))
+    assert [e.name for e in txts] == ['b.txt'] * 3
+
+
+def test_util_action_registry():
+    """
+    Unit test for util_action registration and util_interface dispatch.
+    """
+    @plugin_utils.util_action(name='test_action')
+    def myaction():
+        return 'form', [0] * 10000
+
+    try:
+        assert plugin_utils.UTIL_ACTIONS['test_action'] is myaction
+        form, output, stats = plugin_utils.util_interface('test_action')
+        assert 'peak_memory' not in stats
+        form, output, stats = plugin_utils.util_interface('test_action',
+                                                          trace_memory=True)
+        assert (form, len(output)) == ('form', 10000)
+        assert stats['action'] == 'test_action'
+        assert stats['wall_time'] >= stats['query_time'] == 0
+        assert stats['peak_memory'] >= 80000
+        assert plugin_utils.ACTION_STATS[-1] is stats
+    finally:
+        del plugin_utils.UTIL_ACTIONS['test_action']
+    for name in ['bulk_update', 'migrate_table', 'replace_in_field']:
+        assert name in plugin_utils.UTIL_ACTIONS
+    assert 'memory_report' in plugin_utils.UNTRACED_ACTIONS
+
+
+@pytest.mark.parametrize('traced_before', [False, True])
+def test_run_instrumented_threads(traced_before):
+    """
+    Overlapping run_instrumented calls should share tracemalloc safely.
+    """
+    import threading
+    import tracemalloc
+
+    if traced_before:
+        tracemalloc.start()
+    started, release = threading.Event(), threading.Event()
+    nodb, results = SimpleNamespace(_timings=[]), {}
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return [0] * 10000
+
+    def run_slow():
+        results['slow'] = plugin_utils.run_instrumented(slow, db=nodb,
+                                                        trace_memory=True)
+
+    try:
+        thread = threading.Thread(target=run_slow)
+        thread.start()
+        assert started.wait(5)
+        out, stats = plugin_utils.run_instrumented(lambda: 'quick', db=nodb,
+                                                   trace_memory=True)
+        assert out == 'quick' and stats['peak_memory'] >= 0
+        assert tracemalloc.is_tracing()  # still in use by the other thread
+        release.set()
+        thread.join(5)
+        assert results['slow'][1]['peak_memory'] >= 80000
+        assert tracemalloc.is_tracing() == traced_before
+        assert plugin_utils._TRACING['users'] == 0
+    finally:
+        release.set()
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize('mydata,myexpected', [
+    ('λόγος',
+     ('ΛΌΓΟΣ', 'Λόγος', 'λόγος', ('λ', 'όγος'))),
+    ('ᾠδή'.encode('utf8'),
+     ('ὨΙΔΉ', 'ᾨδή', 'ᾠδή', ('ᾠ', 'δή'))),
+    ('\u03b1\u0313\u0301\u03bd',  # decomposed (NFD) alpha with accents
+     ('\u0391\u0313\u0301\u039d', '\u0391\u0313\u0301\u03bd',
+      '\u03b1\u0313\u0301\u03bd', ('\u03b1\u0313\u0301', '\u03bd'))),
+    ('Word',
+     ('WORD', 'Word', 'word', ('W', 'ord'))),
+    ('',
+     ('', '', '', ('', '')))
+])
+def test_text_helpers(mydata, myexpected):
+    """
+    Unit test for capitalize, capitalize_first, lowercase and firstletter.
+    """
+    funcs = [plugin_utils.capitalize, plugin_utils.capitalize_first,
+             plugin_utils.lowercase, plugin_utils.firstletter]
+    assert tuple(f(mydata) for f in funcs) == myexpected
+    batches = [plugin_utils.capitalize_many, plugin_utils.capitalize_first_many,
+               plugin_utils.lowercase_many, plugin_utils.firstletter_many]
+    for batch, expected in zip(batches, myexpected):
+        assert list(batch([mydata] * 3)) == [expected] * 3
+        assert list(batch([mydata], cache_size=0)) == [expected]
+
+
+@pytest.mark.parametrize('fieldtype,value,expected', [
+    ('integer', ' 12 ', 12),
+    ('reference auth_user', '3', 3),
+    ('double', '1.5', 1.5),
+    ('decimal(10,2)', '1.50', Decimal('1.50')),
+    ('boolean', 'True', True),
+    ('boolean', 'no', False),
+    ('date', '2020-01-02', datetime.date(2020, 1, 2)),
+    ('list:integer', '7', 7),
+    ('string', "'quoted'", 'quoted'),
+    ('text', 'plain', 'plain'),
+    ('integer', 'None', None),
+])
+def test_coerce_field_value(fieldtype, value, expected):
+    """
+    Unit test for coerce_field_value().
+    """
+    field = Field('myfield', fieldtype)
+    assert plugin_utils.coerce_field_value(field, value) == expected
+
+
+def make_things(db):
+    """
+    Define an things table in db with 8 rows, 6 of them of kind 'x'.
+
+    Rows 2 and 5 are of kind 'y', and every third row is tagged 'red'.
+    """
+    db.define_table('things', Field('kind'), Field('num', 'integer'),
+                    Field('tags', 'list:string'))
+    for i in range(1, 9):
+        db.things.insert(kind='y' if i in (2, 5) else 'x', num=i * 10,
+                         tags=['red'] if i % 3 == 0 else ['blue'])
+    db.commit()
+
+
+def test_field_query(db):
+    """
+    Unit test for field_query(), including list: fields.
+    """
+    make_things(db)
+    query = plugin_utils.field_query(db.things, 'num', ' 30 ')
+    assert [r.id for r in db(query).select()] == [3]
+    query = plugin_utils.field_query(db.things, 'tags', 'red')
+    assert [r.id for r in db(query).select(orderby=db.things.id)] == [3, 6]
+    query = plugin_utils.field_query(db.things, 'kind', 'None')
+    assert db(query).count() == 0
+
+
+def test_iter_query_dicts(db):
+    """
+    Unit test for iter_query_dicts() column selection and after_id.
+    """
+    make_things(db)
+    rows = list(plugin_utils.iter_query_dicts('things', 'kind', 'x',
+                                              fields=['num'], page_size=2,
+                                              after_id=3, db=db))
+    assert rows == [{'id': i, 'num': i * 10} for i in (4, 6, 7, 8)]
+    rows = list(plugin_utils.iter_query_dicts('things', 'kind', 'y', db=db))
+    assert [r['id'] for r in rows] == [2, 5]
+    assert set(rows[0]) == {'id', 'kind', 'num', 'tags'}
+
+
+@pytest.mark.parametrize('page_size,pages', [
+    (6, [[1, 3, 4, 6, 7, 8]]),  # exactly page_size rows: no next page
+    (5, [[1, 3, 4, 6, 7], [8]]),
+    (2, [[1, 3], [4, 6], [7, 8]]),
+])
+def test_query_page(db, page_size, pages):
+    """
+    Walking query_page() by its next ids should visit each row once.
+    """
+    make_things(db)
+    seen, after_id = [], 0
+    while after_id is not None:
+        rows, after_id = plugin_utils.query_page('things', 'kind', 'x',
+                                                 fields=['kind'],
+                                                 page_size=page_size,
+                                                 after_id=after_id, db=db)
+        seen.append([r['id'] for r in rows])
+        if after_id is not None:
+            assert after_id == rows[-1]['id']
+    assert seen == pages
+
+
+def test_export_query_json(db, tmp_path):
+    """
+    Unit test for export_query_json().
+    """
+    make_things(db)
+    path = str(tmp_path / 'things.json')
+    count = plugin_utils.export_query_json('things', 'tags', 'red', path,
+                                           fields=['num', 'tags'],
+                                           page_size=1, db=db)
+    assert count == 2
+    with open(path, encoding='utf8') as fp:
+        assert json.load(fp) == [{'id': 3, 'num': 30, 'tags': ['red']},
+                                 {'id': 6, 'num': 60, 'tags': ['red']}]
+    empty = str(tmp_path / 'empty.json')
+    assert plugin_utils.export_query_json('things', 'kind', 'z', empty,
+                                          db=db) == 0
+    with open(empty, encoding='utf8') as fp:
+        assert json.load(fp) == []
+
+
+def test_chunked():
+    """
+    Unit test for chunked() and grouper().
+    """
+    assert list(plugin_utils.chunked(range(7), 3)) == [[0, 1, 2], [3, 4, 5],
+                                                       [6]]
+    assert list(plugin_utils.chunked([], 3)) == []
+    assert list(plugin_utils.grouper(range(4), 3)) == [(0, 1, 2),
+                                                       (3, None, None)]
+    chunks = plugin_utils.chunked(iter(range(10 ** 9)), 2)  # lazy
+    assert next(chunks) == [0, 1]
+
+
+def test_chunked_by_bytes():
+    """
+    Unit test for chunked_by_bytes() and payload_size().
+    """
+    rows = [{'text': 'x' * n} for n in (10, 20, 30, 200, 5, 5, 5)]
+    assert plugin_utils.payload_size(rows[0]) == 14
+    chunks = list(plugin_utils.chunked_by_bytes(rows, 70))
+    assert [len(c) for c in chunks] == [2, 1, 1, 3]
+    assert sum(chunks, []) == rows
+    chunks = list(plugin_utils.chunked_by_bytes(rows, 1000, max_items=3))
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert list(plugin_utils.chunked_by_bytes(['ab', 'cd'], 3,
+                                              sizeof=len)) == [['ab'], ['cd']]
+
+
+def make_docs(db, count=10):
+    """
+    Define a docs table in db holding count rows with bodies 'a0', 'a1', etc.
+    """
+    db.define_table('docs', Field('body'),
+                    Field('body_copy'))
+    for i in range(count):
+        db.docs.insert(body='a{}'.format(i))
+    db.commit()
+
+
+def test_replace_field_values_resume(db):
+    """
+    An interrupted replace_field_values should resume without repeating rows.
+
+    The replacement ('a' -> 'aa') is not idempotent, so a row replaced twice
+    or skipped would show up in the final values.
+    """
+    make_docs(db)
+
+    def fail_once(value):  # interrupt the second run part way through a chunk
+        if value == 'a4' and fail_once.armed:
+            fail_once.armed = False
+            raise RuntimeError('interrupted')
+        return True
+
+    fail_once.armed = False  # an attribute, so the job signature is stable
+    store = plugin_utils.CheckpointStore(db)
+    kwargs = dict(chunk_size=3, testing=False, checkpoint=store,
+                  filter_func=fail_once)
+
+    first = plugin_utils.replace_field_values('docs', 'body', {'a': 'aa'},
+                                              time_limit=1e-9, **kwargs)
+    assert (first['complete'], first['records_scanned']) == (False, 3)
+
+    fail_once.armed = True
+    with pytest.raises(RuntimeError):
+        plugin_utils.replace_field_values('docs', 'body', {'a': 'aa'},
+                                          **kwargs)
+    db.rollback()
+
+    second = plugin_utils.replace_field_values('docs', 'body', {'a': 'aa'},
+                                               **kwargs)
+    assert second['complete'] is True
+    assert second['resumed_from_id'] == 3
+    assert second['records_scanned'] == 7
+    assert [r.body for r in db(db.docs).select(orderby=db.docs.id)] == \
+        ['aa{}'.format(i) for i in range(10)]
+
+    again = plugin_utils.replace_field_values('docs', 'body', {'a': 'aa'},
+                                              **kwargs)
+    assert (again['records_scanned'], again['records_updated']) == (0, 0)
+    assert db(db.docs.body.startswith('aaa')).count() == 0
+
+
+@pytest.mark.parametrize('transform', [None, str.upper])
+def test_migrate_field_resume(db, transform):
+    """
+    An interrupted migrate_field should resume, then do nothing once complete.
+    """
+    make_docs(db)
+    db(db.docs.id == 5).delete()  # a gap in the ids
+    db.commit()
+    store = plugin_utils.CheckpointStore(db)
+    kwargs = dict(fields={'docs': ('body', 'body_copy')}, transform=transform,
+                  chunk_size=3, checkpoint=store)
+
+    first = plugin_utils.migrate_field(time_limit=1e-9, **kwargs)
+    assert first['complete'] is False
+    assert db(db.docs.body_copy != None).count() == first['records_copied']
+
+    second = plugin_utils.migrate_field(**kwargs)
+    assert second['complete'] is True
+    assert first['records_copied'] + second['records_copied'] == 9
+    expected = transform or (lambda v: v)
+    assert all(r.body_copy == expected(r.body) for r in db(db.docs).select())
+    checkpoint = db(store.table).select().first()
+    assert (checkpoint.processed, checkpoint.complete) == (9, True)
+
+    db(db.docs.id > 0).update(body_copy=None)
+    again = plugin_utils.migrate_field(**kwargs)
+    assert (again['records_copied'], again['complete']) == (0, True)
+    assert db(db.docs.body_copy != None).count() == 0
+
+
+def test_checkpoint_signature_callables(db):
+    """
+    Jobs differing only in an anonymous function must not share checkpoints.
+    """
+    make_docs(db)
+    store = plugin_utils.CheckpointStore(db)
+    kwargs = dict(fields={'docs': ('body', 'body_copy')}, checkpoint=store)
+    first = plugin_utils.migrate_field(transform=lambda v: v.upper(),
+                                       **kwargs)
+    assert (first['records_copied'], first['complete']) == (10, True)
+    second = plugin_utils.migrate_field(transform=lambda v: v + '!', **kwargs)
+    assert (second['records_copied'], second['complete']) == (10, True)
+    assert db.docs[1].body_copy == 'a0!'
+
+    kwargs = dict(chunk_size=3, testing=False, checkpoint=store)
+    only_a1 = plugin_utils.replace_field_values(
+        'docs', 'body', {'a': 'b'}, filter_func=lambda v: v == 'a1', **kwargs)
+    assert (only_a1['records_updated'], only_a1['complete']) == (1, True)
+    rest = plugin_utils.replace_field_values('docs', 'body', {'a': 'b'},
+                                             **kwargs)
+    assert (rest['records_updated'], rest['complete']) == (9, True)
+    assert db(db.docs.body.startswith('b')).count() == 10
+
+    sig = plugin_utils.job_signature
+    assert sig('job', f=lambda v: v.upper()) != sig('job', f=lambda v: v)
+    assert sig('job', f=str.upper) == sig('job', f=str.upper)
+    assert sig('job', f=lambda v: v.upper()) == \
+        sig('job', f=lambda v: v.upper())
+
+
+def test_migrate_table_resume(db):
+    """
+    An interrupted migrate_table should resume without duplicating lessons.
+    """
+    db.define_table('plugin_slider_slides', Field('slide_content'),
+                    Field('pdf'))
+    db.define_table('plugin_slider_decks', Field('deck_name'),
+                    Field('deck_slides', 'list:integer'),
+                    Field('deck_position', 'integer'))
+    db.define_table('tags', Field('tag'), Field('slides', 'list:integer'))
+    db.define_table('lessons', Field('title'), Field('video_url'),
+                    Field('pdf'), Field('lesson_tags', 'list:integer'),
+                    Field('lesson_position', 'integer'))
+    for deck in range(5):
+        slides = [db.plugin_slider_slides.insert(
+            slide_content='video{}-{}'.format(deck, i), pdf='pdf')
+            for i in range(2)]
+        deck_id = db.plugin_slider_decks.insert(
+            deck_name='deck{}'.format(deck), deck_slides=slides,
+            deck_position=deck)
+    db.tags.insert(tag='last', slides=[deck_id])
+    db.commit()
+    store = plugin_utils.CheckpointStore(db)
+
+    first = plugin_utils.migrate_table(checkpoint=store, chunk_size=2,
+                                       time_limit=1e-9, db=db)
+    assert (first['complete'], first['records_moved']) == (False, 2)
+    assert db(db.lessons).count() == 4
+
+    second = plugin_utils.migrate_table(checkpoint=store, chunk_size=2, db=db)
+    assert (second['complete'], second['records_moved']) == (True, 3)
+    assert db(db.lessons).count() == 10
+    assert db(db.lessons.lesson_tags.contains(1)).count() == 2
+
+    again = plugin_utils.migrate_table(checkpoint=store, chunk_size=2, db=db)
+    assert (again['records_moved'], again['complete']) == (0, True)
+    assert db(db.lessons).count() == 10
+
+
+def test_migrate_field_sparse_ids(db):
+    """
+    Chunked migrate_field should issue one UPDATE per chunk of existing rows.
+    """
+    make_docs(db, 0)
+    for myid in (1, 2, 3, 10000, 20000, 1000000):
+        db.docs.insert(id=myid, body='b{}'.format(myid))
+    db.commit()
+    mark = db._timings[-1] if db._timings else None
+    out = plugin_utils.migrate_field(fields={'docs': ('body', 'body_copy')},
+                                     chunk_size=2, db=db)
+    queries, truncated = plugin_utils._timings_since(db._timings, mark)
+    assert not truncated
+    updates = [q for q, t in queries if q.startswith('UPDATE')]
+    assert (out['records_copied'], len(updates)) == (6, 3)
+    assert db(db.docs.body_copy == db.docs.body).count() == 6
+
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_import_csv_failed_file(db, tmp_path, processes):
+    """
+    import_csv should record an unreadable file and go on, in both modes.
+    """
+    db.define_table('paragraphs', Field('title'))
+    good = tmp_path / 'good.csv'
+    good.write_text('title\n' + ''.join('t{}\n'.format(i) for i in range(5)),
+                    encoding='utf8')
+    missing = str(tmp_path / 'missing.csv')
+    out = plugin_utils.import_csv([missing, str(good)], 'paragraphs',
+                                  {'title': 'title'}, batch_size=2, db=db,
+                                  processes=processes)
+    assert out['rows'] == db(db.paragraphs).count() == 5
+    assert 'FileNotFoundError' in out['files'][missing]['failed']
+    assert 'failed' not in out['files'][str(good)]
+    for stats in out['files'].values():
+        assert 0 <= stats['elapsed'] <= out['elapsed']
+
+
+def exit_worker(value):
+    """
+    A csv converter that kills the worker process, as an OOM kill would.
+    """
+    if value == 't3':
+        os._exit(1)
+    return value
+
+
+def test_import_csv_dead_worker(db, tmp_path):
+    """
+    import_csv should mark a file failed when its worker process dies.
+    """
+    db.define_table('paragraphs', Field('title'))
+    paths = []
+    for name in ['bad', 'good']:
+        path = tmp_path / '{}.csv'.format(name)
+        path.write_text('title\nt{}\n'.format(3 if name == 'bad' else 1),
+                        encoding='utf8')
+        paths.append(str(path))
+    out = plugin_utils.import_csv(paths, 'paragraphs',
+                                  {'title': ('title', exit_worker)},
+                                  db=db, processes=1)
+    assert 'BrokenProcessPool' in out['files'][paths[0]]['failed']
+    assert set(out['files']) == set(paths)
+    assert out['rows'] == db(db.paragraphs).count()
+
+
+def test_memory_monitor_module_namespaces():
+    """
+    MemoryMonitor should measure module data without calling any callables.
+    """
+    import plugin_utils_core  # noqa: F401
+    namespaces = plugin_utils.module_namespaces(['plugin_utils_core', 're'])
+    assert 'plugin_utils_core.JSON_TYPE_ENCODERS' in namespaces
+    assert 'plugin_utils_core._cached_replacer' not in namespaces
+    assert not any(callable(v) for v in namespaces.values())
+    calls = []
+    namespaces['lazy'] = plugin_utils.Lazy(lambda: calls.append(1) or [0] * 9)
+    namespaces['func'] = lambda: calls.append(2)
+    monitor = plugin_utils.MemoryMonitor()
+    snap = monitor.snapshot(namespaces)
+    assert calls == [1]
+    assert snap['sizes']['lazy'] > \
+        snap['sizes']['plugin_utils_core.TRIE_THRESHOLD']
+    assert 'func' in snap['sizes']
+
+
+def test_memory_monitor_stop_tracing():
+    """
+    Allocation tracing started by a snapshot should stop with stop_tracing.
+    """
+    import tracemalloc
+
+    assert not tracemalloc.is_tracing()
+    monitor = plugin_utils.MemoryMonitor()
+    try:
+        assert monitor.snapshot({'x': 1}, top_allocations=3)[
+            'allocations'] == []
+        junk = [str(i) for i in range(10000)]  # noqa: F841
+        assert monitor.snapshot({'x': 1}, top_allocations=3)['allocations']
+        assert tracemalloc.is_tracing()
+        monitor.stop_tracing()
+        assert not tracemalloc.is_tracing()
+        assert plugin_utils._TRACING['users'] == 0
+        assert monitor.snapshot({'x': 1}, top_allocations=3)[
+            'allocations'] == []
+    finally:
+        monitor.stop_tracing()
+    assert not tracemalloc.is_tracing()
+
+
+def make_words(db):
+    """
+    Define a words table in db with two fields of repeated words.
+    """
+    db.define_table('words', Field('word'),
+                    Field('gloss'))
+    for word, gloss in [('cat', 'a cat'), ('Cat', 'dog'), ('cattle', None),
+                        ('cat', 'bird'), ('dog', 'catfish'), ('bat', 'cat')]:
+        db.words.insert(word=word, gloss=gloss)
+    db.commit()
+
+
+def last_queries(db, mark):
+    """
+    Return the sql of the queries run by db since the timings entry mark.
+    """
+    return [q for q, t in plugin_utils._timings_since(db._timings, mark)[0]]
+
+
+@pytest.mark.parametrize('pushdown', [True, False])
+def test_iter_field_values(db, monkeypatch, pushdown):
+    """
+    Unit test for iter_field_values(), with and without REGEXP in sql.
+    """
+    make_words(db)
+    if not pushdown:
+        monkeypatch.setattr(plugin_utils, 'REGEXP_ENGINES', ())
+    mark = db._timings[-1] if db._timings else None
+    values = list(plugin_utils.iter_field_values('words', 'word', 'cat'))
+    assert sorted(values) == ['cat', 'cattle']  # case-sensitive, distinct
+    sql = ' '.join(last_queries(db, mark))
+    assert 'DISTINCT' in sql
+    assert ('REGEXP' in sql) is pushdown
+    assert ('LIKE' in sql) is not pushdown
+
+    values = plugin_utils.iter_field_values('words', ['word', 'gloss'],
+                                            r'^[cb]at', exclude=['bat'])
+    assert sorted(values) == ['cat', 'catfish', 'cattle']
+    values = plugin_utils.iter_field_values('words', 'word', 'at$',
+                                            unique=False,
+                                            trans_func=str.upper)
+    assert sorted(values) == ['BAT', 'CAT', 'CAT', 'CAT']
+    values = plugin_utils.iter_field_values(
+        'words', ['word', 'gloss'], filter_func=lambda v: len(v) == 3,
+        trans_func=str.lower)
+    assert sorted(values) == ['bat', 'cat', 'dog']
+
+    db.define_table('counts', Field('num', 'integer'))
+    for num in (1, 12, 21, 12, 3):
+        db.counts.insert(num=num)
+    for regex_str in ['^1', '1']:  # a regex, and a plain substring
+        values = plugin_utils.iter_field_values('counts', 'num', regex_str)
+        assert sorted(values) == ([1, 12] if regex_str == '^1'
+                                  else [1, 12, 21])
+
+
+def test_gather_from_field(db, monkeypatch):
+    """
+    Unit test for the gather_from_field form action.
+    """
+    make_words(db)
+
+    class AcceptedForm(object):
+        def __init__(self, *fields, **kwargs):
+            myvars = {f.name: f.default for f in fields}
+            myvars.update(target_field='word, gloss', filter_func='',
+                          trans_func='lambda v: v.lower()')
+            self.vars = SimpleNamespace(**myvars)
+
+        def process(self):
+            self.accepted, self.errors = True, None
+            return self
+
+    monkeypatch.setattr(SQLFORM, 'factory', AcceptedForm,
+                        raising=False)
+    form, items = plugin_utils.gather_from_field(
+        tablename='words', regex_str='at', exclude=['bat'])
+    assert sorted(items) == ['a cat', 'cat', 'catfish', 'cattle']
+
+
+def test_chunked_update(db):
+    """
+    Unit test for chunked_update(), including a self-invalidating query.
+    """
+    make_docs(db)
+    db(db.docs.id.belongs([2, 5])).update(body='skip')
+    db.commit()
+    query = db.docs.body.startswith('a')  # updated rows stop matching
+
+    preview = plugin_utils.chunked_update('docs', query, {'body': 'b'},
+                                          batch_size=3, sample_size=2,
+                                          preview=True, db=db)
+    assert (preview['matched'], preview['updated'], preview['batches']) == \
+        (8, 0, 0)
+    assert [r.id for r in preview['sample']] == [1, 3]
+    assert db(query).count() == 8
+
+    out = plugin_utils.chunked_update('docs', query, {'body': 'b'},
+                                      batch_size=3, db=db)
+    assert (out['matched'], out['updated'], out['batches']) == (8, 8, 3)
+    assert all(r.body == 'b' for r in out['sample'])
+    db.rollback()  # everything was already committed batch by batch
+    assert db(db.docs.body == 'b').count() == 8
+    assert db(db.docs.body == 'skip').count() == 2
+
+
+def test_row_transformer_pickle():
+    """
+    A _RowTransformer built from strings should survive pickling.
+    """
+    transformer = plugin_utils._RowTransformer(
+        ['lemma', 'note'], ['', 'lambda v: "cat" in v'],
+        ['lambda v: v.lower()', None])
+    clone = pickle.loads(pickle.dumps(transformer))
+    assert clone.specs == transformer.specs
+    chunk = [('Cat', 'a cat'), ('Dog', 'bird'), ('', 'catfish')]
+    assert clone(chunk) == transformer(chunk) == \
+        [{'lemma': 'cat', 'note': 'a cat'}, {'lemma': 'dog'},
+         {'note': 'catfish'}]
+
+
+@pytest.mark.parametrize('workers,processes',
+                         [(None, False), (2, False), (2, True)])
+@pytest.mark.parametrize('unique,expected',
+                         [(True, ['cat', 'cattle', 'dog']),
+                          (False, ['cat', 'cat', 'cattle', 'cat', 'dog'])])
+def test_rows_from_field(db, workers, processes, unique, expected):
+    """
+    Unit test for rows_from_field() with and without thread/process pools.
+    """
+    make_words(db)
+    db.define_table('lemmas', Field('lemma'))
+    out = plugin_utils.rows_from_field(
+        'words', 'lemmas', ['word'], ['lemma'],
+        filter_funcs=['lambda v: v != "bat"'],
+        trans_funcs=['lambda v: v.lower()'], unique=unique, testing=False,
+        chunk_size=2, workers=workers, processes=processes, batch_size=2,
+        sample_size=2, db=db)
+    assert out['rows_read'] == 6
+    assert out['rows_created'] == len(expected)
+    assert out['sample'] == [{'lemma': x} for x in expected[:2]]
+    assert [r.lemma for r in db(db.lemmas).select(orderby=db.lemmas.id)] \
+        == expected
+
+
+@pytest.mark.parametrize('relative_paths,names,duplicate',
+                         [(None, ['a.mp3', 'b.mp3', 'sub/a.mp3'], 0),
+                          (False, ['a.mp3', 'b.mp3'], 1)])
+def test_rows_from_filenames(db, tmp_path, relative_paths, names, duplicate):
+    """
+    Same-named files in subfolders are kept apart unless only names are used.
+    """
+    (tmp_path / 'sub').mkdir()
+    for path in ['a.mp3', 'b.mp3', 'notes.txt', 'sub/a.mp3']:
+        (tmp_path / path).write_text(path)
+    db.define_table('files', Field('name'))
+    out = plugin_utils.rows_from_filenames(
+        str(tmp_path), 'files', 'name', relative_paths=relative_paths,
+        filter_func=lambda n: n.endswith('.mp3'), testing=False, db=db)
+    assert (out['files_found'], out['files_skipped'],
+            out['files_duplicate']) == (4, 1, duplicate)
+    assert out['rows_created'] == len(names)
+    assert sorted(r.name for r in db(db.files).select()) == names
+
+    again = plugin_utils.rows_from_filenames(
+        str(tmp_path), 'files', 'name', relative_paths=relative_paths,
+        filter_func=lambda n: n.endswith('.mp3'), incremental=True,
+        testing=False, db=db)
+    assert (again['files_skipped'], again['rows_created']) == (4, 0)